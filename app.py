@@ -5,95 +5,179 @@ Also includes template management functionality and basic authentication.
 """
 
 # Import necessary libraries
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session, flash
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for, session, flash, stream_with_context
 import os
 import json
+import base64
+import logging
+import math
+import time
+from datetime import datetime
 from dotenv import load_dotenv
-from models import db, init_db, Template, Tag
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import load_only, selectinload
+from models import db, database_url, engine_options, init_db, Template, Tag
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import generate_password_hash
 import functools
-import re
+import sys
+import click
 
-# Import our direct API module
-from direct_api import direct_openai_call
+# Import our generation and transport modules
+from auth import check_credentials, login_throttle, password_hash
+from batch import BATCH_CONCURRENCY, completed_ids, parse_batch_lines, run_batch
+from compaction import compact_email
+from completion_cache import completion_cache
+from drafts import load_draft
+from generation import (GenerationError, generate, generate_stream, generation_result, parse_generation_request,
+                        resolve_draft)
+from hedging import hedge_stats
+from jobs import JOBS_DB_PATH, JobQueue, QueueFullError
+from migrations import DB_AUTO_MIGRATE, LATEST_VERSION, schema_is_current, upgrade_schema
+from observability import configure_logging, metrics_authorized, record_request, registry, span, start_trace
+from pipeline import pipeline_stats
+from rate_limiter import rate_limiter
+from recommend import SUGGEST_LIMIT, SUGGEST_MAX_LIMIT, recommender
+from replies import approve_reply, reply_stats
+from singleflight import draft_requests, single_flight
+from transport import transport
+from usage_stats import usage_stats
+from template_io import detect_format, export_templates, import_templates, read_records, resolve_tags, tag_list
+import search_index
 
 # Load environment variables from .env file (for local development)
 load_dotenv()
 
+# Structured log lines for every module (LOG_LEVEL, LOG_FORMAT)
+configure_logging()
+logger = logging.getLogger(__name__)
+
 # Initialize Flask application
 app = Flask(__name__)
 
 # Set a secret key for session management
 app.secret_key = os.environ.get('SECRET_KEY', 'default-dev-key-change-in-production')
 
-# Configure database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///email_assistant.db'
+# Behind a reverse proxy (e.g. 1 on Render), take the client address from X-Forwarded-For
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+
+# Configure database (DATABASE_URL; SQLite in the instance folder by default)
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-# Initialize the database
+# Initialize the database; the schema is migrated here unless a release step does it
 init_db(app)
+if DB_AUTO_MIGRATE:
+    upgrade_schema(app)
+    schema_ready = True
+else:
+    schema_ready = schema_is_current(app)
+    if not schema_ready:
+        logger.warning("Database schema is out of date, run: flask --app app db-upgrade")
 
-# Authentication credentials (in a real app, this would be in a database)
-# The password is hashed for security
-USERNAME = os.environ.get('APP_USERNAME', 'admin')
-# Default password is 'peptideservice' - you should change this in your .env file
-PASSWORD_HASH = generate_password_hash(os.environ.get('APP_PASSWORD', 'peptideservice'))
-
-# System prompt for the AI (instructions on how to respond)
-SYSTEM_PROMPT = """
-You are a helpful customer service assistant for a peptide distribution company.
-Our company sells lab-grade peptides strictly for research purposes. We are NOT medical professionals.
-You MUST NOT provide any dosage information, medical advice, or suggestions for human/animal consumption or use. If asked directly about these topics, politely state that you cannot provide that type of information, and pivot to offering allowed information like product specifications (purity, sequence if available), storage guidelines, or order/shipping status if relevant to the query.
-Your tone should be professional, helpful, and polite.
-Do not explicitly state *why* you cannot provide medical advice (e.g., don't say 'Due to regulations...' or 'We cannot legally...'). Simply decline to provide the restricted information politely as described above.
-Focus on answering the customer's query accurately within the allowed boundaries (e.g., product information, availability, purity, storage, order status, general research context where appropriate).
-
-IMPORTANT FORMATTING INSTRUCTION: Do not use em dash characters (—) in your response. Use hyphens (-) sparingly or other appropriate punctuation instead.
-"""
-
-REFINING_PROMPT = """
-You are a customer service language expert for a peptide distribution company.
-Your task is to reword technical responses to make them more customer-friendly while preserving the technical accuracy.
-Keep the same information but make the tone warmer, more approachable, and easier to understand.
-Maintain all the technical information and policies mentioned in the original response.
-Remember that we sell lab-grade peptides strictly for research purposes and are NOT medical professionals.
-We cannot provide dosage information, medical advice, or suggestions for human/animal consumption or use.
+# Template suggestions: the index is saved in the instance folder and shared by all workers
+recommender.configure(os.path.join(app.instance_path, 'template_index.npz'))
 
-IMPORTANT: Provide ONLY the final reworded response with no introductory text like "Here's a reworded version" or "Certainly!"
-Do not include any meta-commentary or prefatory remarks. Start directly with the customer service response.
+# The template search and suggestion indexes need the tables. Workers that leave
+# schema work to the release step only attach to the search index; suggestions
+# are loaded on first use
+if schema_ready:
+    if DB_AUTO_MIGRATE:
+        search_index.init_search_index(app)
+    else:
+        search_index.attach_search_index(app)
+    recommender.init_app(app, lazy=True)
 
-IMPORTANT FORMATTING INSTRUCTION: Do not use em dash characters (—) in your response. Use hyphens (-) sparingly or other appropriate punctuation instead.
-"""
+# Authentication credentials (APP_USERNAME, and APP_PASSWORD_HASH or APP_PASSWORD) are in auth.py;
+# the password is hashed for security, on first use rather than at startup
 
 # Get OpenAI API key from environment variables
 openai_api_key = os.environ.get('OPENAI_API_KEY')
 
-# Helper function to clean up responses
-def clean_response(response):
-    """Clean up the response by removing common prefatory text and em dashes"""
-    # List of common prefatory patterns to remove
-    prefatory_patterns = [
-        r"^Certainly!.*?\n\n",
-        r"^Sure!.*?\n\n",
-        r"^Here's.*?(\n\n|\n---\n)",
-        r"^I've.*?\n\n",
-        r"^Here is.*?\n\n",
-        r"^Below is.*?\n\n",
-        r"^The following.*?\n\n"
-    ]
-    
-    # Apply all patterns
-    for pattern in prefatory_patterns:
-        response = re.sub(pattern, "", response, flags=re.DOTALL)
-    
-    # Remove any "---" dividers at the beginning
-    response = re.sub(r"^---\n", "", response)
-    
-    # Replace em dashes with regular hyphens or en dashes
-    response = response.replace("—", "-")  # Replace em dash with hyphen
-    response = response.replace("–", "-")  # Replace en dash with hyphen too
-    
-    return response.strip()
+# Page sizes for template listings
+TEMPLATE_PAGE_SIZE = 50
+TEMPLATE_MAX_PAGE_SIZE = 200
+
+# Rate limit budgets are shared by all workers through a file in the instance folder
+rate_limiter.configure(os.path.join(app.instance_path, 'ratelimits.db'))
+
+# Background job queue so generation does not hold a request worker
+job_queue = JobQueue(JOBS_DB_PATH or os.path.join(app.instance_path, 'jobs.db'))
+
+def run_generation_job(payload):
+    """Run a queued generation job (called from a job worker thread)"""
+    # Job threads run outside of a request, so they need their own app context
+    with app.app_context():
+        params = parse_generation_request(payload)
+        return generation_result(params, generate(openai_api_key, params))
+
+job_queue.register('generate', run_generation_job)
+
+def generate_batch_item(data):
+    """Generate the response of one batch item and note a reused reply (called from a batch worker thread)"""
+    with app.app_context():
+        params = parse_generation_request(data)
+        return generate(openai_api_key, params, keep_draft=False), params['reused']
+
+@app.before_request
+def start_job_workers():
+    """Start the job threads in each worker process (no-op once running)"""
+    job_queue.start()
+
+@app.before_request
+def start_request_trace():
+    """Start timing the request and collecting its spans"""
+    start_trace()
+    request.environ['email_assistant.started'] = time.perf_counter()
+
+@app.after_request
+def finish_request_trace(response):
+    """Record the request duration and log it once the body (possibly a stream) is sent"""
+    started = request.environ.get('email_assistant.started')
+    if started is None:
+        return response
+    method = request.method
+    path = request.path
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    status = response.status_code
+
+    def record():
+        record_request(method, path, endpoint, status, time.perf_counter() - started)
+
+    response.call_on_close(record)
+    return response
+
+# Helper function to format a server-sent event
+def format_sse(event, data):
+    """Format an event for a text/event-stream response"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Helper functions for paginated template listings
+def summary_query():
+    """Template query for list views: no content column, tags loaded in one extra query"""
+    return Template.query.options(
+        load_only(Template.id, Template.title, Template.updated_at),
+        selectinload(Template.tags)
+    )
+
+def encode_cursor(position):
+    """Encode a page position as an opaque cursor string"""
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def decode_cursor(cursor):
+    """Decode a cursor from encode_cursor (None if not given); raises ValueError if invalid"""
+    if not cursor:
+        return None
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(position, dict):
+        raise ValueError("Invalid cursor")
+    return position
 
 # Login required decorator
 def login_required(view):
@@ -111,11 +195,22 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
         
-        if username == USERNAME and check_password_hash(PASSWORD_HASH, password):
+        # Clients with too many failed logins are turned away before the (slow) password check.
+        # The name is part of the key, so failures under other names from a shared address (e.g. a proxy
+        # not in TRUSTED_PROXIES) do not lock out the real login
+        client = (username or '', request.remote_addr)
+        retry_after = login_throttle.retry_after(client)
+        if retry_after:
+            flash(f'Too many failed logins. Please try again in {math.ceil(retry_after / 60)} minutes.')
+            return render_template('login.html'), 429, {'Retry-After': str(math.ceil(retry_after))}
+        
+        if check_credentials(username, password):
+            login_throttle.succeeded(client)
             session['logged_in'] = True
             session['username'] = username
             return redirect(url_for('index'))
         else:
+            login_throttle.failed(client)
             flash('Invalid username or password')
     
     return render_template('login.html')
@@ -143,146 +238,252 @@ def generate_response():
     if not openai_api_key:
         return jsonify({"error": "OpenAI API key is not configured. Please check your environment variables."}), 500
     
+    params = None
     try:
-        # Get JSON data from the request
-        data = request.json
-        
-        # Extract data from the request
-        customer_email = data.get('customer_email', '')
-        previous_response = data.get('previous_response', '')  # Will be empty for initial request
-        modification_request = data.get('modification_request', '')  # Will be empty for initial request
-        template_id = data.get('template_id')  # Optional template ID
-        customer_notes = data.get('customer_notes', '')  # Get the customer notes
-        
-        # Get model selection and token limit
-        model = data.get('model', 'gpt-4.1')  # Default to gpt-4.1 if not specified
-        token_limit = int(data.get('token_limit', 1000))  # Default to 1000 if not specified
-        
-        # Log the received parameters
-        print(f"Received request with model: {model}, token_limit: {token_limit}")
-        
-        # Check if technical hybrid mode is selected
-        is_technical_mode = model == 'technical'
-        
-        # If technical mode, we'll use o4-mini first, then gpt-4.1
-        if is_technical_mode:
-            technical_first_model = 'o4-mini'  # Use correct model name without gpt- prefix
-            technical_second_model = 'gpt-4.1'
-            # Ensure higher token limit for technical mode
-            token_limit = max(token_limit, 2000)
-            print(f"Technical mode enabled. Using models: {technical_first_model} -> {technical_second_model}")
+        # Extract and validate the parameters from the request
+        params = parse_generation_request(request.json)
         
-        # Validate customer email is provided
-        if not customer_email:
-            return jsonify({"error": "Customer email is required"}), 400
+        # A newer request for the same draft cancels this one
+        params['cancel'] = draft_requests.begin(params['draft_id'])
         
-        # Initialize messages list with the system prompt
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT}
-        ]
+        # Generate and clean up the response
+        ai_response = generate(openai_api_key, params)
         
-        # Get template if provided
-        template_content = ""
-        if template_id:
-            try:
-                template = Template.query.get(template_id)
-                if template:
-                    template_content = template.content
-            except Exception as e:
-                print(f"Error retrieving template: {e}")
-                # Continue without the template
-        
-        # Construct messages for the API call based on whether it's an initial request or a modification
-        if not previous_response:
-            # Initial request
-            user_content = f"Customer Email:\n{customer_email}\n\n"
-
-            if customer_notes:
-                user_content += f"IMPORTANT NOTES: {customer_notes}\n\n"
-            
-            # Add template if available
-            if template_content:
-                user_content += f"Please use the following template as a starting point for your response:\n\n---TEMPLATE START---\n{template_content}\n---TEMPLATE END---\n\n"
-            
-            user_content += "Draft a suitable response:"
-            
-            messages.append({
-                "role": "user", 
-                "content": user_content
-            })
-        else:
-            # Modification request
-            messages.extend([
-                {"role": "user", "content": f"Original Customer Email:\n{customer_email}"},
-                {"role": "assistant", "content": previous_response},
-                {"role": "user", "content": f"Original Important Notes:\n{customer_notes}"},
-                {"role": "user", "content": f"Please modify the above response based on this request: {modification_request}"}
-            ])
-        
-        # Generate the response
-        if is_technical_mode:
-            # Technical hybrid mode: first generate with o4-mini
-            print(f"Step 1: Generating with {technical_first_model}")
-            first_response = direct_openai_call(
-                api_key=openai_api_key,
-                messages=messages,
-                model=technical_first_model,
-                max_tokens=token_limit // 2  # Use half the tokens for the first step
-            )
-            
-            print(f"Initial technical response length: {len(first_response)}")
-            print(f"Initial response starts with: {first_response[:100]}...")
-            
-            # Then refine with gpt-4.1 for better customer service language
-            print(f"Step 2: Refining with {technical_second_model}")
-            refining_messages = [
-                {"role": "system", "content": REFINING_PROMPT},
-                {"role": "user", "content": f"Here is a technical response to a customer email:\n\n{first_response}\n\nReword this to be more customer-friendly while maintaining all the technical information. Start directly with the reworded response without any introduction or prefatory text."}
-            ]
-            
-            ai_response = direct_openai_call(
-                api_key=openai_api_key,
-                messages=refining_messages,
-                model=technical_second_model,
-                max_tokens=token_limit // 2  # Use the remaining tokens for refinement
-            )
-        else:
-            # Standard mode: use the selected model directly
-            print(f"Using model: {model} with token limit: {token_limit}")
-            ai_response = direct_openai_call(
-                api_key=openai_api_key,
-                messages=messages,
-                model=model,
-                max_tokens=token_limit
-            )
-        
-        # Clean up the response to remove any prefatory text
-        original_length = len(ai_response)
-        ai_response = clean_response(ai_response)
-        print(f"Response cleanup: {original_length} chars -> {len(ai_response)} chars")
-        print(f"Final response starts with: {ai_response[:100]}...")
-        
-        # Return the AI-generated response
-        return jsonify({"response": ai_response})
+        # Return the AI-generated response with the tokens saved by compaction, stage timings,
+        # the draft id to send with modification requests and the reply id to approve it with
+        with span('serialization'):
+            return jsonify(generation_result(params, ai_response))
     
+    except GenerationError as e:
+        return jsonify({"error": e.message}), e.status_code
     except Exception as e:
         # Handle errors and return appropriate error messages
-        print(f"Error generating response: {str(e)}")
+        logger.exception("Error generating response")
         return jsonify({"error": f"Error generating response: {str(e)}"}), 500
+    finally:
+        if params is not None and params.get('cancel'):
+            draft_requests.end(params['draft_id'], params['cancel'])
+
+# Streaming variant of the endpoint above - now protected
+@app.route('/generate_response/stream', methods=['POST'])
+@login_required
+def generate_response_stream():
+    """Handle POST requests to generate AI responses, streamed as server-sent events"""
+    
+    # Check if OpenAI API key is configured
+    if not openai_api_key:
+        return jsonify({"error": "OpenAI API key is not configured. Please check your environment variables."}), 500
+    
+    # Validate the request before the stream starts so errors get a proper status code
+    try:
+        params = parse_generation_request(request.json)
+        resolve_draft(params)
+    except GenerationError as e:
+        return jsonify({"error": e.message}), e.status_code
+    
+    def event_stream():
+        # A newer request for the same draft cancels this one; a client that
+        # disconnects closes this generator, which closes the API stream
+        params['cancel'] = draft_requests.begin(params['draft_id'])
+        try:
+            for event, data in generate_stream(openai_api_key, params):
+                with span('serialization'):
+                    chunk = format_sse(event, data)
+                yield chunk
+        except GenerationError as e:
+            yield format_sse("error", {"error": e.message})
+        except Exception as e:
+            # Headers are already sent, so the error is reported as an event
+            logger.exception("Error streaming response")
+            yield format_sse("error", {"error": f"Error generating response: {str(e)}"})
+        finally:
+            draft_requests.end(params['draft_id'], params['cancel'])
+    
+    return Response(
+        stream_with_context(event_stream()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Disable proxy buffering so chunks arrive immediately
+        }
+    )
+
+# API endpoints for background generation jobs - now protected
+
+@app.route('/api/jobs', methods=['POST'])
+@login_required
+def submit_job():
+    """Queue a generation request and return immediately with a job id"""
+    
+    # Check if OpenAI API key is configured
+    if not openai_api_key:
+        return jsonify({"error": "OpenAI API key is not configured. Please check your environment variables."}), 500
+    
+    data = request.json
+    
+    # Validate now so the client gets errors without polling
+    try:
+        parse_generation_request(data)
+    except GenerationError as e:
+        return jsonify({"error": e.message}), e.status_code
+    
+    try:
+        job_id = job_queue.submit('generate', data)
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503
+    
+    job = job_queue.get(job_id)
+    response = jsonify(job)
+    response.headers['Location'] = url_for('get_job', job_id=job_id)
+    return response, 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    """Get the status of a job, including its result once finished"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/drafts/<draft_id>', methods=['GET'])
+@login_required
+def get_draft(draft_id):
+    """Get a draft session's revision count and prompt cache usage"""
+    draft = load_draft(draft_id)
+    if draft is None:
+        return jsonify({'error': 'Draft not found or expired'}), 404
+    return jsonify(draft.to_dict())
+
+@app.route('/api/replies/<int:reply_id>/approve', methods=['POST'])
+@login_required
+def approve_reply_endpoint(reply_id):
+    """Store the final version of a reply so near-duplicate emails get it back"""
+    data = request.json or {}
+    response = data.get('response')
+    if not isinstance(response, str) or not response.strip():
+        return jsonify({'error': 'response is required'}), 400
+    try:
+        reply = approve_reply(reply_id, response.strip())
+    except Exception as e:
+        db.session.rollback()
+        logger.exception("Error approving reply")
+        return jsonify({'error': f"Error approving reply: {str(e)}"}), 500
+    if reply is None:
+        return jsonify({'error': 'Reply not found'}), 404
+    return jsonify(reply.to_dict())
+
+# API endpoint for batch generation - now protected
+
+@app.route('/api/batch', methods=['POST'])
+@login_required
+def batch_generate():
+    """
+    Generate responses for many emails at once.
+    
+    Accepts JSONL either as the request body or as an uploaded "file". An
+    optional uploaded "partial" file with results from an interrupted run
+    skips emails that already succeeded. Results are streamed back as JSONL
+    in the order they finish.
+    """
+    
+    # Check if OpenAI API key is configured
+    if not openai_api_key:
+        return jsonify({"error": "OpenAI API key is not configured. Please check your environment variables."}), 500
+    
+    try:
+        concurrency = int(request.args.get('concurrency', BATCH_CONCURRENCY))
+    except ValueError:
+        return jsonify({'error': 'concurrency must be an integer'}), 400
+    
+    # Read the input now; the request body is not available once streaming starts
+    if 'file' in request.files:
+        lines = request.files['file'].read().decode('utf-8').splitlines()
+    else:
+        lines = request.get_data(as_text=True).splitlines()
+    if not any(line.strip() for line in lines):
+        return jsonify({'error': 'No emails provided'}), 400
+    
+    skip_ids = set()
+    if 'partial' in request.files:
+        skip_ids = completed_ids(request.files['partial'].read().decode('utf-8').splitlines())
+    
+    def result_stream():
+        for result in run_batch(parse_batch_lines(lines), generate_batch_item, concurrency, skip_ids):
+            yield json.dumps(result) + "\n"
+    
+    return Response(
+        stream_with_context(result_stream()),
+        mimetype='application/x-ndjson',
+        headers={'X-Accel-Buffering': 'no'}
+    )
 
 # API endpoints for template management - now protected
 
 @app.route('/api/templates', methods=['GET'])
 @login_required
 def get_templates():
-    """Get all templates or search for templates"""
+    """
+    List or search templates, one page at a time.
+    
+    Returns lightweight summaries (no content); use /api/templates/<id> for
+    the full template. Pass the returned next_cursor as ?cursor= to get the
+    next page.
+    """
     search_term = request.args.get('search', '')
     tag_filter = request.args.get('tag', '')
     
-    # Start with all templates
-    query = Template.query
+    try:
+        limit = min(max(int(request.args.get('limit', TEMPLATE_PAGE_SIZE)), 1), TEMPLATE_MAX_PAGE_SIZE)
+        cursor = decode_cursor(request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
     
-    # Apply search filter if provided
+    # Resolve the tag filter if provided
+    tag = None
+    if tag_filter:
+        tag = Tag.query.filter_by(name=tag_filter).first()
+    
+    # Ranked full-text search when the index is available
+    if search_term and search_index.fts_enabled():
+        # Search results are ranked, so the cursor is an offset into the ranking
+        try:
+            offset = max(int(cursor.get('o', 0)), 0) if cursor else 0
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid limit or cursor'}), 400
+        
+        tag_id = tag.id if tag else None
+        
+        # Only this page is ranked out of SQLite and snippeted
+        page = search_index.search_templates(search_term, limit=limit, offset=offset, tag_id=tag_id)
+        total = search_index.count_matches(search_term, tag_id=tag_id)
+        templates_by_id = {
+            template.id: template
+            for template in summary_query().filter(Template.id.in_([match[0] for match in page])).all()
+        }
+        
+        # Keep the BM25 order and attach the score and snippet to each result
+        results = []
+        for template_id, score, snippet in page:
+            template = templates_by_id.get(template_id)
+            if template is None:
+                continue
+            result = template.to_summary_dict()
+            result['score'] = score
+            result['snippet'] = snippet
+            results.append(result)
+        
+        next_cursor = encode_cursor({'o': offset + limit}) if offset + limit < total else None
+        return jsonify({'templates': results, 'next_cursor': next_cursor, 'total': total})
+    
+    # Most recently updated first
+    query = summary_query().order_by(Template.updated_at.desc(), Template.id.desc())
+    
+    # Apply tag filter if provided
+    if tag:
+        query = query.filter(Template.tags.contains(tag))
+    
+    # Apply search filter if provided (fallback when the search index is unavailable)
     if search_term:
         query = query.filter(
             # Search in title or content
@@ -290,16 +491,113 @@ def get_templates():
              Template.content.ilike(f'%{search_term}%'))
         )
     
-    # Apply tag filter if provided
-    if tag_filter:
-        tag = Tag.query.filter_by(name=tag_filter).first()
-        if tag:
-            query = query.filter(Template.tags.contains(tag))
+    # Keyset pagination: continue after the last row of the previous page
+    if cursor:
+        try:
+            last_updated = datetime.fromisoformat(cursor['u'])
+            last_id = int(cursor['i'])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'error': 'Invalid limit or cursor'}), 400
+        query = query.filter(or_(
+            Template.updated_at < last_updated,
+            and_(Template.updated_at == last_updated, Template.id < last_id)
+        ))
     
-    # Execute query and convert results to dictionaries
-    templates = [template.to_dict() for template in query.all()]
+    # Fetch one extra row to find out whether there is another page
+    templates = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(templates) > limit:
+        templates = templates[:limit]
+        last = templates[-1]
+        next_cursor = encode_cursor({'u': last.updated_at.isoformat(), 'i': last.id})
     
-    return jsonify(templates)
+    return jsonify({
+        'templates': [template.to_summary_dict() for template in templates],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/templates/suggest', methods=['POST'])
+@login_required
+def suggest_templates():
+    """
+    Suggest templates for a customer email, best match first.
+    
+    Returns summaries (no content) with the BM25 score and the words of the
+    email that matched each template.
+    """
+    data = request.get_json(silent=True) or {}
+    customer_email = data.get('customer_email')
+    if not isinstance(customer_email, str) or not customer_email.strip():
+        return jsonify({'error': 'Customer email is required'}), 400
+    try:
+        limit = min(max(int(data.get('limit', SUGGEST_LIMIT)), 1), SUGGEST_MAX_LIMIT)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid limit'}), 400
+    if not recommender.ensure_loaded():
+        return jsonify({'error': 'Template suggestions are not available'}), 503
+    
+    # Quoted history and signatures would match templates on unrelated words
+    compacted, _ = compact_email(customer_email)
+    with span('suggest'):
+        matches = recommender.suggest(compacted, limit)
+    templates_by_id = {
+        template.id: template
+        for template in summary_query().filter(Template.id.in_([match[0] for match in matches])).all()
+    } if matches else {}
+    
+    results = []
+    for template_id, score, matched in matches:
+        template = templates_by_id.get(template_id)
+        if template is None:
+            continue
+        result = template.to_summary_dict()
+        result['score'] = score
+        result['matched'] = matched
+        results.append(result)
+    return jsonify({'templates': results})
+
+@app.route('/api/templates/export', methods=['GET'])
+@login_required
+def export_templates_file():
+    """Download every template as JSONL (default) or CSV (?format=csv), streamed"""
+    try:
+        file_format = detect_format(requested=request.args.get('format', 'jsonl'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    filename = f"templates-{datetime.utcnow():%Y%m%d}.{file_format}"
+    return Response(
+        stream_with_context(export_templates(file_format)),
+        mimetype='text/csv' if file_format == 'csv' else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/templates/import', methods=['POST'])
+@login_required
+def import_templates_file():
+    """
+    Create or update templates (matched by title) from JSONL or CSV.
+    
+    Accepts the file as the request body or as an uploaded "file". The
+    format comes from ?format=, else the uploaded file name (default JSONL).
+    Each record needs a title and content and may have tags (a list, or a
+    comma-separated string in CSV).
+    """
+    upload = request.files.get('file')
+    try:
+        file_format = detect_format(upload.filename if upload else None, request.args.get('format'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # The body is read as a stream, so large files are not held in memory
+    stream = upload.stream if upload else request.stream
+    try:
+        summary = import_templates(read_records(stream, file_format))
+    except UnicodeDecodeError:
+        return jsonify({'error': 'The file must be UTF-8 encoded'}), 400
+    except Exception as e:
+        logger.exception("Error importing templates")
+        return jsonify({'error': f"Error importing templates: {str(e)}"}), 500
+    return jsonify(summary)
 
 @app.route('/api/templates/<int:template_id>', methods=['GET'])
 @login_required
@@ -324,19 +622,17 @@ def create_template():
         content=data['content']
     )
     
-    # Process tags
-    tag_names = data.get('tags', [])
-    for tag_name in tag_names:
-        # Find existing tag or create new one
-        tag = Tag.query.filter_by(name=tag_name).first()
-        if not tag:
-            tag = Tag(name=tag_name)
-            db.session.add(tag)
-        template.tags.append(tag)
-    
-    # Save to database
+    # Process tags (existing ones are looked up in one query, missing ones created)
+    tag_names = tag_list(data.get('tags', []))
+    tags = resolve_tags(tag_names)
+    template.tags = [tags[tag_name] for tag_name in tag_names]
+    
+    # Save to database (flush first so the search index gets the new id)
     db.session.add(template)
+    db.session.flush()
+    search_index.index_template(template)
     db.session.commit()
+    recommender.update_template(template)
     
     return jsonify(template.to_dict()), 201
 
@@ -355,20 +651,15 @@ def update_template(template_id):
     
     # Update tags if provided
     if 'tags' in data:
-        # Remove all existing tags
-        template.tags = []
-        
-        # Add new tags
-        tag_names = data['tags']
-        for tag_name in tag_names:
-            tag = Tag.query.filter_by(name=tag_name).first()
-            if not tag:
-                tag = Tag(name=tag_name)
-                db.session.add(tag)
-            template.tags.append(tag)
-    
-    # Save changes
+        # Replace the tags (looked up in one query, missing ones created)
+        tag_names = tag_list(data['tags'])
+        tags = resolve_tags(tag_names)
+        template.tags = [tags[tag_name] for tag_name in tag_names]
+    
+    # Save changes along with the search index entry
+    search_index.index_template(template)
     db.session.commit()
+    recommender.update_template(template)
     
     return jsonify(template.to_dict())
 
@@ -378,9 +669,11 @@ def delete_template(template_id):
     """Delete a template"""
     template = Template.query.get_or_404(template_id)
     
-    # Remove template from database
+    # Remove template from database and the search index
+    search_index.remove_template(template.id)
     db.session.delete(template)
     db.session.commit()
+    recommender.remove_template(template_id)
     
     return jsonify({'message': 'Template deleted successfully'})
 
@@ -391,6 +684,234 @@ def get_tags():
     tags = [tag.to_dict() for tag in Tag.query.all()]
     return jsonify(tags)
 
+# API endpoints for runtime statistics - now protected
+
+@app.route('/api/stats/transport', methods=['GET'])
+@login_required
+def get_transport_stats():
+    """Get connection pool and retry statistics for OpenAI API calls (this worker only)"""
+    return jsonify(transport.stats())
+
+@app.route('/api/stats/cache', methods=['GET'])
+@login_required
+def get_cache_stats():
+    """Get completion cache hit/miss statistics (this worker only)"""
+    return jsonify(completion_cache.stats())
+
+@app.route('/api/stats/jobs', methods=['GET'])
+@login_required
+def get_job_stats():
+    """Get job queue depth and wait time statistics"""
+    return jsonify(job_queue.stats())
+
+@app.route('/api/stats/pipelines', methods=['GET'])
+@login_required
+def get_pipeline_stats():
+    """Get run counts and latencies per pipeline stage (this worker only)"""
+    return jsonify(pipeline_stats())
+
+@app.route('/api/stats/usage', methods=['GET'])
+@login_required
+def get_usage_stats():
+    """Get token usage and prompt cache hit rates per model (this worker only)"""
+    return jsonify(usage_stats.stats())
+
+@app.route('/api/stats/recommend', methods=['GET'])
+@login_required
+def get_recommend_stats():
+    """Template suggestion index size and search latency (this worker only)"""
+    return jsonify(recommender.stats())
+
+@app.route('/api/stats/inflight', methods=['GET'])
+@login_required
+def get_inflight_stats():
+    """Return coalesced and cancelled OpenAI calls (this worker only)"""
+    return jsonify(single_flight.stats())
+
+@app.route('/api/stats/hedging', methods=['GET'])
+@login_required
+def get_hedging_stats():
+    """Return hedged and fallback calls and the current hedge delays (this worker only)"""
+    return jsonify(hedge_stats())
+
+@app.route('/api/stats/replies', methods=['GET'])
+@login_required
+def get_reply_stats():
+    """Return near-duplicate lookups, reused and approved replies (this worker only)"""
+    return jsonify(reply_stats())
+
+@app.route('/api/stats/logins', methods=['GET'])
+@login_required
+def get_login_stats():
+    """Return failed and refused logins (this worker only)"""
+    return jsonify(login_throttle.stats())
+
+@app.route('/api/stats/ratelimits', methods=['GET'])
+@login_required
+def get_ratelimit_stats():
+    """Get the remaining request/token budget per model (shared by all workers)"""
+    return jsonify(rate_limiter.stats())
+
+# Prometheus metrics: scrapers cannot log in, so they authenticate with METRICS_TOKEN instead
+
+def collect_runtime_metrics():
+    """Report the counters of the cache, transport, in-flight calls, hedges, replies and job queue as metric families"""
+    cache = completion_cache.stats()
+    transport_stats = transport.stats()
+    jobs = job_queue.stats()
+    flights = single_flight.stats()
+    hedges = hedge_stats()
+    replies = reply_stats()
+    return [
+        ('email_assistant_completion_cache_lookups_total', 'counter',
+         'Completion cache lookups by result',
+         [({'result': 'memory_hit'}, cache['memory_hits']), ({'result': 'disk_hit'}, cache['disk_hits']),
+          ({'result': 'miss'}, cache['misses'])]),
+        ('email_assistant_openai_retries_total', 'counter',
+         'OpenAI API attempts that were retried', [({}, transport_stats['retries'])]),
+        ('email_assistant_openai_failures_total', 'counter',
+         'OpenAI API calls that failed after all retries', [({}, transport_stats['failures'])]),
+        ('email_assistant_openai_coalesced_total', 'counter',
+         'Requests that shared an identical OpenAI call already in progress',
+         [({'stream': 'false'}, flights['coalesced']), ({'stream': 'true'}, flights['coalesced_streams'])]),
+        ('email_assistant_openai_cancelled_total', 'counter',
+         'OpenAI calls stopped because nobody was waiting for them any more',
+         [({}, flights['cancelled_calls'])]),
+        ('email_assistant_openai_hedges_total', 'counter',
+         'Calls also sent to a fallback model, by reason and the model that answered',
+         [({'outcome': 'hedge_won'}, hedges['hedge_won']), ({'outcome': 'primary_won'}, hedges['primary_won']),
+          ({'outcome': 'fallback_on_error'}, hedges['fallbacks'])]),
+        ('email_assistant_openai_hedge_saved_seconds_total', 'counter',
+         'Estimated time to first token (or response) saved by hedged calls', [({}, hedges['saved_seconds'])]),
+        ('email_assistant_reply_lookups_total', 'counter',
+         'Near-duplicate lookups for approved replies, by result',
+         [({'result': 'reused'}, replies['reused']), ({'result': 'miss'}, replies['lookups'] - replies['reused']),
+          ({'result': 'skipped'}, replies['skipped'])]),
+        ('email_assistant_replies_approved_total', 'counter',
+         'Replies approved by an agent', [({}, replies['approved'])]),
+        ('email_assistant_superseded_requests_total', 'counter',
+         'Generations cancelled by a newer request for the same draft', [({}, flights['superseded'])]),
+        ('email_assistant_jobs', 'gauge', 'Background jobs by status',
+         [({'status': 'queued'}, jobs['queue_depth'])]
+         + [({'status': status}, jobs[status]) for status in ('running', 'completed', 'failed')]),
+    ]
+
+registry.register_collector(collect_runtime_metrics)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Latency histograms, token usage and cost in the Prometheus text format (this worker only)"""
+    if not (metrics_authorized(request.headers) or 'logged_in' in session):
+        return Response("Unauthorized\n", status=401, mimetype='text/plain')
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+# Process lifecycle hooks for gunicorn's preload_app (see gunicorn.conf.py)
+
+def preload():
+    """Do the startup work every worker would repeat, once in the master before it forks"""
+    password_hash()
+    if schema_ready:
+        recommender.ensure_loaded()
+
+def after_fork():
+    """Drop the database connections a worker inherited from the master"""
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+# Command-line interface (run with "flask --app app <command>")
+
+@app.cli.command('batch-generate')
+@click.argument('input_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output_path', type=click.Path(dir_okay=False))
+@click.option('--concurrency', default=BATCH_CONCURRENCY, show_default=True,
+              help='Number of emails generated at the same time.')
+def batch_generate_command(input_path, output_path, concurrency):
+    """Generate responses for a JSONL file of emails.
+
+    Results are appended to OUTPUT_PATH as they finish. If OUTPUT_PATH already
+    has results from an interrupted run, those emails are skipped.
+    """
+    if not openai_api_key:
+        raise click.ClickException("OpenAI API key is not configured. Please check your environment variables.")
+    
+    # Resume from an existing output file
+    skip_ids = set()
+    needs_newline = False
+    if os.path.exists(output_path):
+        with open(output_path, encoding='utf-8') as f:
+            content = f.read()
+        skip_ids = completed_ids(content.splitlines())
+        # A line cut off by the interruption must not run into the next result
+        needs_newline = bool(content) and not content.endswith("\n")
+        if skip_ids:
+            click.echo(f"Resuming: {len(skip_ids)} emails already done", err=True)
+    
+    counts = {'ok': 0, 'error': 0}
+    with open(input_path, encoding='utf-8') as input_file, open(output_path, 'a', encoding='utf-8') as output_file:
+        if needs_newline:
+            output_file.write("\n")
+        for result in run_batch(parse_batch_lines(input_file), generate_batch_item, concurrency, skip_ids):
+            output_file.write(json.dumps(result) + "\n")
+            output_file.flush()
+            counts[result['status']] += 1
+            click.echo(f"{result['id']}: {result['status']}", err=True)
+    
+    click.echo(f"Done: {counts['ok']} succeeded, {counts['error']} failed", err=True)
+    if counts['error']:
+        sys.exit(1)
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Apply pending database migrations (run once per deploy with DB_AUTO_MIGRATE=0)."""
+    applied = upgrade_schema(app)
+    if applied:
+        click.echo(f"Applied migrations {', '.join(map(str, applied))} (schema version {LATEST_VERSION})", err=True)
+    else:
+        click.echo(f"Schema is up to date (version {LATEST_VERSION})", err=True)
+    # Create and sync the indexes here, so workers with DB_AUTO_MIGRATE=0 start without writing
+    search_index.init_search_index(app)
+    recommender.init_app(app)
+
+@app.cli.command('hash-password')
+@click.password_option()
+def hash_password_command(password):
+    """Print the hash of a password, for APP_PASSWORD_HASH."""
+    click.echo(generate_password_hash(password))
+
+@app.cli.command('rebuild-suggestions')
+def rebuild_suggestions_command():
+    """Rebuild the template suggestion index from the database."""
+    recommender.rebuild()
+    if not recommender.enabled:
+        raise click.ClickException("Template suggestions need NumPy (pip install numpy).")
+    stats = recommender.stats()
+    click.echo(f"Indexed {stats['templates']} templates ({stats['terms']} terms)", err=True)
+
+@app.cli.command('import-templates')
+@click.argument('input_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['jsonl', 'csv']),
+              help='File format (default: from the file extension).')
+def import_templates_command(input_path, file_format):
+    """Create or update templates (matched by title) from a JSONL or CSV file."""
+    with open(input_path, 'rb') as f:
+        summary = import_templates(read_records(f, detect_format(input_path, file_format)))
+    for error in summary['errors']:
+        click.echo(f"Line {error['line']}: {error['error']}", err=True)
+    click.echo(f"Done: {summary['created']} created, {summary['updated']} updated, "
+               f"{summary['unchanged']} unchanged, {summary['invalid']} invalid", err=True)
+    if summary['invalid']:
+        sys.exit(1)
+
+@app.cli.command('export-templates')
+@click.argument('output_path', type=click.Path(dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['jsonl', 'csv']),
+              help='File format (default: from the file extension).')
+def export_templates_command(output_path, file_format):
+    """Write every template to a JSONL or CSV file."""
+    with open(output_path, 'w', encoding='utf-8', newline='') as f:
+        for chunk in export_templates(detect_format(output_path, file_format)):
+            f.write(chunk)
+
 # Run the app if this file is executed directly
 if __name__ == '__main__':
     # Use environment variable for port if available (for deployment), otherwise use 5000
@@ -0,0 +1,386 @@
+"""
+ASGI entry point with async generation endpoints.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 8000 --workers 2
+
+POST /generate_response and /generate_response/stream are served on the
+event loop: while a generation waits on OpenAI it holds a coroutine and a
+pooled connection instead of a thread, so one process can keep hundreds of
+generations in flight. Every other route (pages, login, templates, jobs,
+batch, stats) is passed unchanged to the Flask app, which runs in a bounded
+thread pool like gunicorn's gthread workers. Both share the session cookie.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+
+from itsdangerous import BadSignature
+
+from app import app, format_sse, openai_api_key
+from async_api import async_transport
+from generation import (GenerationError, _in_app_context, agenerate, agenerate_stream, generation_result,
+                        parse_generation_request, resolve_draft)
+from observability import record_request, start_trace, span
+from singleflight import draft_requests
+
+logger = logging.getLogger(__name__)
+
+# Threads for the Flask (WSGI) routes per process
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 8))
+
+# Generations allowed in flight per process before new ones get 503
+ASYNC_MAX_IN_FLIGHT = int(os.environ.get('ASYNC_MAX_IN_FLIGHT', 500))
+
+# Request bodies larger than this are spooled to a temporary file
+MAX_MEMORY_BODY = 1024 * 1024
+
+API_KEY_MISSING = "OpenAI API key is not configured. Please check your environment variables."
+
+
+async def _read_body(receive, spool=False):
+    """Read the whole request body (into a temporary file if spool is set)"""
+    body = tempfile.SpooledTemporaryFile(max_size=MAX_MEMORY_BODY) if spool else bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError("Client disconnected")
+        if spool:
+            body.write(message.get('body', b''))
+        else:
+            body.extend(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    if spool:
+        body.seek(0)
+    return body
+
+
+def _header(scope, name):
+    for key, value in scope.get('headers', []):
+        if key == name:
+            return value.decode('latin1')
+    return None
+
+
+def _build_environ(scope, body):
+    """Translate an ASGI HTTP scope into a WSGI environ"""
+    script_name = scope.get('root_path', '')
+    path = scope['path']
+    if script_name and path.startswith(script_name):
+        path = path[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name.encode('utf8').decode('latin1'),
+        'PATH_INFO': path.encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class WSGIBridge:
+    """
+    Serve a WSGI app under ASGI. Each request runs in a thread of a bounded
+    pool; response chunks are sent as they are produced, so streamed Flask
+    responses (e.g. batch results) keep streaming.
+    """
+
+    def __init__(self, wsgi_app, threads=WSGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        body = await _read_body(receive, spool=True)
+        environ = _build_environ(scope, body)
+        loop = asyncio.get_running_loop()
+
+        def send_from_thread(message):
+            # Blocks the thread until the chunk is handed to the server (back-pressure)
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            response_start = {}
+
+            def start_response(status, headers, exc_info=None):
+                response_start.update(type='http.response.start', status=int(status.split(' ', 1)[0]),
+                                      headers=[(name.lower().encode('latin1'), value.encode('latin1'))
+                                               for name, value in headers])
+                return lambda data: None  # The write() callable is not used by Flask
+
+            result = self.wsgi_app(environ, start_response)
+            try:
+                started = False
+                for chunk in result:
+                    if not chunk:
+                        continue
+                    if not started:
+                        send_from_thread(response_start)
+                        started = True
+                    send_from_thread({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                if not started:
+                    send_from_thread(response_start)
+                send_from_thread({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+                body.close()
+
+        await loop.run_in_executor(self.executor, run)
+
+
+def _logged_in(scope):
+    """Check the Flask session cookie, as login_required does"""
+    cookies = SimpleCookie(_header(scope, b'cookie') or '')
+    morsel = cookies.get(app.config['SESSION_COOKIE_NAME'])
+    if morsel is None:
+        return False
+    serializer = app.session_interface.get_signing_serializer(app)
+    try:
+        session = serializer.loads(morsel.value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return False
+    return 'logged_in' in session
+
+
+async def _send_json(send, status, data):
+    body = json.dumps(data).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _redirect_to_login(send):
+    await send({'type': 'http.response.start', 'status': 302,
+                'headers': [(b'location', b'/login'), (b'content-length', b'0')]})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _cancel_on_disconnect(receive, task):
+    """Cancel a generation when the client goes away, so it stops waiting on OpenAI"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            task.cancel()
+            return
+
+
+def _superseded(params):
+    """Return the error message for a generation cancelled by a newer request for its draft, or None"""
+    token = params.get('cancel')
+    return f"Request cancelled: {token.reason}" if token is not None and token.cancelled else None
+
+
+class AsyncGenerationApp:
+    """ASGI app: async generation endpoints, everything else handled by Flask"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WSGIBridge(flask_app.wsgi_app)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.rejected = 0
+        self.routes = {
+            ('POST', '/generate_response'): self.generate_response,
+            ('POST', '/generate_response/stream'): self.generate_response_stream,
+            ('GET', '/api/stats/async'): self.async_stats,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        handler = self.routes.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+        if handler is None:
+            return await self.wsgi(scope, receive, send)
+
+        start_trace()
+        started = time.perf_counter()
+        status = 500
+        try:
+            if not _logged_in(scope):
+                status = 302
+                return await _redirect_to_login(send)
+            status = await handler(scope, receive, send)
+        finally:
+            record_request(scope['method'], scope['path'], scope['path'], status, time.perf_counter() - started)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await async_transport.aclose()
+                self.wsgi.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _parse(self, receive):
+        """Read and validate a generation request; raises GenerationError"""
+        body = await _read_body(receive)
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            raise GenerationError("Request body must be JSON")
+        return parse_generation_request(data)
+
+    def _watch(self, task, receive, params):
+        """
+        Cancel a generation task when its client disconnects or a newer request
+        for the same draft arrives; returns the disconnect watcher task.
+        """
+        loop = asyncio.get_running_loop()
+        params['cancel'] = draft_requests.begin(params['draft_id'])
+        # The newer request may be served by a Flask thread, so cancel through the loop
+        params['cancel'].add_callback(lambda: loop.call_soon_threadsafe(task.cancel))
+        return asyncio.ensure_future(_cancel_on_disconnect(receive, task))
+
+    def _admit(self):
+        """Count a new generation in flight; False if the process is at ASYNC_MAX_IN_FLIGHT"""
+        if self.in_flight >= ASYNC_MAX_IN_FLIGHT:
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return True
+
+    async def generate_response(self, scope, receive, send):
+        """Async version of app.generate_response"""
+        if not openai_api_key:
+            await _send_json(send, 500, {"error": API_KEY_MISSING})
+            return 500
+        try:
+            params = await self._parse(receive)
+        except GenerationError as e:
+            await _send_json(send, e.status_code, {"error": e.message})
+            return e.status_code
+        if not self._admit():
+            await _send_json(send, 503, {"error": "Too many generations in progress, please retry"})
+            return 503
+
+        task = asyncio.ensure_future(agenerate(self.flask_app, openai_api_key, params))
+        watcher = self._watch(task, receive, params)
+        try:
+            ai_response = await task
+            with span('serialization'):
+                result = generation_result(params, ai_response)
+            status = 200
+        except asyncio.CancelledError:
+            if not _superseded(params):
+                # The client disconnected; nobody is left to answer
+                return 499
+            result, status = {"error": _superseded(params)}, 409
+        except GenerationError as e:
+            result, status = {"error": e.message}, e.status_code
+        except Exception as e:
+            logger.exception("Error generating response")
+            result, status = {"error": f"Error generating response: {str(e)}"}, 500
+        finally:
+            watcher.cancel()
+            draft_requests.end(params['draft_id'], params['cancel'])
+            self.in_flight -= 1
+        await _send_json(send, status, result)
+        return status
+
+    async def generate_response_stream(self, scope, receive, send):
+        """Async version of app.generate_response_stream (server-sent events)"""
+        if not openai_api_key:
+            await _send_json(send, 500, {"error": API_KEY_MISSING})
+            return 500
+        # Validate the request before the stream starts so errors get a proper status code
+        try:
+            params = await self._parse(receive)
+            await _in_app_context(self.flask_app, resolve_draft, params)
+        except GenerationError as e:
+            await _send_json(send, e.status_code, {"error": e.message})
+            return e.status_code
+        if not self._admit():
+            await _send_json(send, 503, {"error": "Too many generations in progress, please retry"})
+            return 503
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),  # Disable proxy buffering so chunks arrive immediately
+        ]})
+
+        async def stream():
+            try:
+                async for event, data in agenerate_stream(self.flask_app, openai_api_key, params):
+                    with span('serialization'):
+                        chunk = format_sse(event, data).encode()
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            except asyncio.CancelledError:
+                raise
+            except GenerationError as e:
+                error = format_sse("error", {"error": e.message}).encode()
+                await send({'type': 'http.response.body', 'body': error, 'more_body': True})
+            except Exception as e:
+                # Headers are already sent, so the error is reported as an event
+                logger.exception("Error streaming response")
+                error = format_sse("error", {"error": f"Error generating response: {str(e)}"}).encode()
+                await send({'type': 'http.response.body', 'body': error, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+        task = asyncio.ensure_future(stream())
+        watcher = self._watch(task, receive, params)
+        try:
+            await task
+        except asyncio.CancelledError:
+            # The client disconnected or the draft got a newer request; the API
+            # stream was closed with the generator
+            if _superseded(params):
+                error = format_sse("error", {"error": _superseded(params)}).encode()
+                await send({'type': 'http.response.body', 'body': error, 'more_body': True})
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            watcher.cancel()
+            draft_requests.end(params['draft_id'], params['cancel'])
+            self.in_flight -= 1
+        return 200
+
+    async def async_stats(self, scope, receive, send):
+        """Generations in flight and async transport statistics (this process only)"""
+        await _send_json(send, 200, {
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'max_allowed': ASYNC_MAX_IN_FLIGHT,
+            'rejected': self.rejected,
+            'wsgi_threads': self.wsgi.threads,
+            'transport': async_transport.stats(),
+        })
+        return 200
+
+
+application = AsyncGenerationApp(app)
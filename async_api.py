@@ -0,0 +1,324 @@
+"""
+Async variant of direct_openai_call for the ASGI server (asgi.py).
+Calls go through one pooled httpx.AsyncClient per process with the same
+payloads, timeouts, retries, rate limit pacing, completion cache and usage
+accounting as the synchronous path, so a single event loop can wait on
+hundreds of completions at once instead of holding a thread for each.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+import httpx
+
+from completion_cache import completion_cache, make_cache_key
+from direct_api import TRANSIENT_STATUSES, OpenAIError, _note_usage, _observe_call, build_payload, parse_stream_line
+from observability import record_first_token
+from rate_limiter import estimate_request_tokens, rate_limiter
+from singleflight import single_flight
+from transport import (BACKOFF_BASE, CONNECT_TIMEOUT, MAX_RETRIES, OPENAI_BASE_URL, READ_TIMEOUT,
+                       RETRY_AFTER_MAX, RETRY_STATUSES, backoff_delay, parse_retry_after)
+
+logger = logging.getLogger(__name__)
+
+# Connections kept to the API per process; each in-flight completion holds one
+ASYNC_MAX_CONNECTIONS = int(os.environ.get('OPENAI_ASYNC_MAX_CONNECTIONS', 500))
+ASYNC_MAX_KEEPALIVE = int(os.environ.get('OPENAI_ASYNC_MAX_KEEPALIVE', 100))
+
+
+class AsyncOpenAITransport:
+    """Async counterpart of transport.OpenAITransport (pooled client, retries, statistics)"""
+
+    def __init__(self, base_url=OPENAI_BASE_URL, max_connections=ASYNC_MAX_CONNECTIONS,
+                 max_keepalive=ASYNC_MAX_KEEPALIVE, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 max_retries=MAX_RETRIES):
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+        self._lock = threading.Lock()
+        self._client = None
+        self._loop = None
+        self._counters = {
+            'requests': 0,
+            'attempts': 0,
+            'retries': 0,
+            'failures': 0,
+            'timeouts': 0,
+            'connection_errors': 0,
+            'backoff_seconds': 0.0,
+            'in_flight': 0,
+            'max_in_flight': 0,
+        }
+
+    def _get_client(self):
+        """Return the client for the running event loop (a client cannot be shared between loops)"""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            connect, read = self.timeout
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(read, connect=connect),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_keepalive),
+            )
+            self._loop = loop
+        return self._client
+
+    async def aclose(self):
+        """Close the pooled connections (on server shutdown)"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+            if name == 'in_flight':
+                self._counters['max_in_flight'] = max(self._counters['max_in_flight'], self._counters['in_flight'])
+
+    async def post(self, path, payload, headers=None, stream=False):
+        """
+        POST a JSON payload to the API, retrying transient failures.
+
+        Args:
+            path (str): Path relative to the base URL (e.g. "/chat/completions")
+            payload (dict): JSON body
+            headers (dict): Extra request headers (e.g. Authorization)
+            stream (bool): Leave the response body unread; the caller must aclose() it
+
+        Returns:
+            httpx.Response: The final response (possibly an error status)
+
+        Raises:
+            httpx.HTTPError: If the request could not be sent
+        """
+        client = self._get_client()
+        self._count('requests')
+
+        # Budgets are tracked per model, so only model calls are paced
+        model = payload.get('model')
+        estimated_tokens = estimate_request_tokens(payload) if model else 0
+
+        attempt = 0
+        while True:
+            if model:
+                await rate_limiter.acquire_async(model, estimated_tokens)
+            self._count('attempts')
+            try:
+                request = client.build_request("POST", path, json=payload, headers=headers)
+                response = await client.send(request, stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                # Nothing reached the server, so it is safe to try again
+                is_timeout = not isinstance(e, httpx.ConnectError)
+                self._count('timeouts' if is_timeout else 'connection_errors')
+                if attempt >= self.max_retries:
+                    self._count('failures')
+                    raise
+                delay = backoff_delay(attempt)
+            except httpx.TimeoutException:
+                # Read timeouts are not retried: the completion may still be billed
+                self._count('timeouts')
+                self._count('failures')
+                raise
+            else:
+                retry_after = parse_retry_after(response.headers)
+                if model:
+                    # The shared budget store is SQLite, which can block on another worker's write
+                    await asyncio.to_thread(rate_limiter.update_from_headers, model, response.headers)
+                    if response.status_code == 429:
+                        # Hold back every worker's calls to this model, not just this one
+                        await asyncio.to_thread(rate_limiter.block, model,
+                                                min(retry_after if retry_after is not None
+                                                    else BACKOFF_BASE, RETRY_AFTER_MAX))
+
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    if response.status_code >= 400:
+                        self._count('failures')
+                    return response
+
+                delay = backoff_delay(attempt, retry_after)
+                # Release the connection back to the pool before sleeping
+                await response.aclose()
+
+            self._count('retries')
+            self._count('backoff_seconds', delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        """Return retry, concurrency and pool settings as a dictionary"""
+        with self._lock:
+            counters = dict(self._counters)
+        counters['backoff_seconds'] = round(counters['backoff_seconds'], 3)
+        return {
+            'base_url': self.base_url,
+            'timeout': {'connect': self.timeout[0], 'read': self.timeout[1]},
+            'max_retries': self.max_retries,
+            'max_connections': self.max_connections,
+            'max_keepalive_connections': self.max_keepalive,
+            **counters,
+        }
+
+
+# Transport shared by every async call in this process
+async_transport = AsyncOpenAITransport()
+
+
+async def _read_error_message(response):
+    """Extract the error message from a failed (possibly streamed) API response"""
+    await response.aread()
+    try:
+        return response.json().get('error', {}).get('message', 'Unknown error')
+    except json.JSONDecodeError:
+        return response.text or "Unknown error (no JSON response)"
+
+
+async def _aiter_stream(response, cache_key, model, started, on_usage):
+    """Async version of direct_api._iter_stream"""
+    total_length = 0
+    parts = []
+    usage = None
+    first_token_latency = None
+    outcome = "error"
+    try:
+        async for line in response.aiter_lines():
+            done, event = parse_stream_line(line)
+            if done:
+                if cache_key:
+                    await completion_cache.aset(cache_key, "".join(parts))
+                _note_usage(model, usage, first_token_latency, True, on_usage)
+                outcome = "ok"
+                break
+            if event is None:
+                continue
+
+            # The last chunk (with no choices) carries the usage of the whole request
+            if event.get("usage"):
+                usage = event["usage"]
+
+            for choice in event.get("choices") or []:
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    if first_token_latency is None:
+                        first_token_latency = time.perf_counter() - started
+                        record_first_token(model, first_token_latency)
+                    total_length += len(content)
+                    if cache_key:
+                        parts.append(content)
+                    yield content
+    except httpx.HTTPError as e:
+        raise Exception(f"Network error while streaming from OpenAI API: {str(e)}")
+    except (GeneratorExit, asyncio.CancelledError):
+        # The client went away before the end of the stream
+        outcome = "cancelled"
+        single_flight.count('cancelled_calls')
+        raise
+    finally:
+        await response.aclose()
+        async_transport._count('in_flight', -1)
+        _observe_call(model, started, True, outcome)
+        logger.debug("Stream finished", extra={'model': model, 'chars': total_length, 'outcome': outcome})
+
+
+async def _cached_stream(content):
+    yield content
+
+
+async def async_openai_call(api_key, messages, model="gpt-4.1", temperature=0.7, max_tokens=1000,
+                            max_completion_tokens=None, reasoning_effort="medium", stream=False,
+                            use_cache=True, on_usage=None):
+    """
+    Async version of direct_api.direct_openai_call (same arguments).
+
+    Returns:
+        str: The model's response text, or when stream=True an async
+             generator yielding the response text in chunks as they arrive
+    """
+    payload = build_payload(messages, model, temperature, max_tokens, max_completion_tokens, reasoning_effort)
+
+    # Identical requests are answered from the completion cache
+    cache_key = make_cache_key(payload) if use_cache else None
+    if cache_key:
+        cached = await completion_cache.aget(cache_key)
+        if cached is not None:
+            logger.debug("Completion cache hit", extra={'model': model})
+            return _cached_stream(cached) if stream else cached
+    else:
+        completion_cache.note_bypass()
+        return await _send_request(api_key, payload, stream, None, on_usage)
+
+    # Identical requests already in progress are shared instead of sent again
+    async def send():
+        return await _send_request(api_key, payload, stream, cache_key, on_usage)
+    if stream:
+        return await single_flight.astream(cache_key, send)
+    return await single_flight.acall(cache_key, send)
+
+
+async def _send_request(api_key, payload, stream, cache_key, on_usage):
+    """Send a chat completions request (see async_openai_call)"""
+    model = payload["model"]
+    headers = {
+        "Authorization": f"Bearer {api_key}"
+    }
+    payload = dict(payload)
+
+    if stream:
+        payload["stream"] = True
+        # Ask for the usage block (incl. cached prompt tokens) at the end of the stream
+        payload["stream_options"] = {"include_usage": True}
+
+    logger.debug("Sending API request", extra={'model': model, 'parameters': ",".join(payload.keys())})
+
+    started = time.perf_counter()
+    async_transport._count('in_flight')
+    handed_off = False
+    try:
+        response = await async_transport.post("/chat/completions", payload, headers=headers, stream=stream)
+
+        if response.status_code != 200:
+            error_message = await _read_error_message(response)
+            await response.aclose()
+            _observe_call(model, started, stream, "error")
+            raise OpenAIError(f"API request failed with status code {response.status_code}: {error_message}",
+                              response.status_code, response.status_code in TRANSIENT_STATUSES)
+
+        # The status is known at this point, so errors above surface before any chunk
+        if stream:
+            handed_off = True
+            return _aiter_stream(response, cache_key, model, started, on_usage)
+
+        result = response.json()
+        content = result["choices"][0]["message"]["content"]
+        _observe_call(model, started, False, "ok")
+        logger.debug("Response received", extra={'model': model, 'chars': len(content)})
+        _note_usage(model, result.get("usage"), time.perf_counter() - started, False, on_usage)
+        if cache_key:
+            await completion_cache.aset(cache_key, content)
+        return content
+
+    except asyncio.CancelledError:
+        # Every caller waiting for this completion went away
+        _observe_call(model, started, stream, "cancelled")
+        single_flight.count('cancelled_calls')
+        raise
+    except httpx.HTTPError as e:
+        _observe_call(model, started, stream, "error")
+        raise OpenAIError(f"Network error when calling OpenAI API: {str(e)}", transient=True)
+    except json.JSONDecodeError:
+        raise OpenAIError(f"Invalid JSON response from OpenAI API: {response.text}", transient=True)
+    except OpenAIError as e:
+        raise OpenAIError(f"Error calling OpenAI API: {str(e)}", e.status_code, e.transient)
+    except Exception as e:
+        raise OpenAIError(f"Error calling OpenAI API: {str(e)}")
+    finally:
+        # A returned stream releases its slot when it finishes
+        if not handed_off:
+            async_transport._count('in_flight', -1)
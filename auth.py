@@ -0,0 +1,128 @@
+"""
+Login credentials and throttling.
+The password hash is read from APP_PASSWORD_HASH (print one with "flask --app
+app hash-password"), so starting a worker never runs the deliberately slow
+key derivation. With only APP_PASSWORD set, the password is hashed on first
+use instead of at import. Failed logins are counted per user name and client
+address: after LOGIN_MAX_FAILURES within LOGIN_FAILURE_WINDOW seconds, logins
+with that name from that client are refused without checking the password
+until the window has passed. Keying on the name as well keeps one client
+from locking out everyone else who shares its address (e.g. behind a proxy
+that is not in TRUSTED_PROXIES). Counts are kept per worker process.
+"""
+
+import hmac
+import os
+import threading
+import time
+from collections import deque
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Failed logins allowed per user name and client address within the window (0 = no throttling)
+LOGIN_MAX_FAILURES = int(os.environ.get('LOGIN_MAX_FAILURES', 5))
+LOGIN_FAILURE_WINDOW = float(os.environ.get('LOGIN_FAILURE_WINDOW', 300))
+
+# Clients tracked before stale entries are swept
+LOGIN_MAX_CLIENTS = 10000
+
+# Default password is 'peptideservice' - you should change this in your .env file
+DEFAULT_PASSWORD = 'peptideservice'
+
+_hash_lock = threading.Lock()
+_password_hash = None
+
+
+def username():
+    """Return the login name (APP_USERNAME, read when called so .env files are loaded first)"""
+    return os.environ.get('APP_USERNAME', 'admin')
+
+
+def password_hash():
+    """Return the password hash: APP_PASSWORD_HASH, or APP_PASSWORD hashed once per process"""
+    global _password_hash
+    if _password_hash is None:
+        with _hash_lock:
+            if _password_hash is None:
+                _password_hash = (os.environ.get('APP_PASSWORD_HASH')
+                                  or generate_password_hash(os.environ.get('APP_PASSWORD', DEFAULT_PASSWORD)))
+    return _password_hash
+
+
+def check_credentials(name, password):
+    """Return True if name and password are the configured login"""
+    # Both checks always run, so the response time does not tell whether the user name exists
+    name_ok = hmac.compare_digest((name or '').encode('utf-8'), username().encode('utf-8'))
+    password_ok = check_password_hash(password_hash(), password or '')
+    return name_ok and password_ok and bool(password)
+
+
+class LoginThrottle:
+    """Failed logins per client (a user name and address pair) in a sliding window"""
+
+    def __init__(self, max_failures=LOGIN_MAX_FAILURES, window=LOGIN_FAILURE_WINDOW):
+        self.max_failures = max_failures
+        self.window = window
+        self._failures = {}
+        self._lock = threading.Lock()
+        self._counters = {'failures': 0, 'refused': 0}
+
+    def _recent(self, client, now):
+        # Called with the lock held; drops failures that left the window
+        failures = self._failures.get(client)
+        if failures is None:
+            return None
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if not failures:
+            del self._failures[client]
+            return None
+        return failures
+
+    def retry_after(self, client):
+        """Return the seconds until client may try again (0 = now), counting a refusal"""
+        if not self.max_failures:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            failures = self._recent(client, now)
+            if failures is None or len(failures) < self.max_failures:
+                return 0
+            self._counters['refused'] += 1
+            return max(failures[0] + self.window - now, 0)
+
+    def failed(self, client):
+        """Record a failed login"""
+        if not self.max_failures:
+            return
+        now = time.monotonic()
+        with self._lock:
+            failures = self._recent(client, now)
+            if failures is None:
+                if len(self._failures) >= LOGIN_MAX_CLIENTS:
+                    for other in list(self._failures):
+                        self._recent(other, now)
+                failures = self._failures[client] = deque(maxlen=self.max_failures)
+            failures.append(now)
+            self._counters['failures'] += 1
+
+    def succeeded(self, client):
+        """Forget the failures of a client that logged in"""
+        with self._lock:
+            self._failures.pop(client, None)
+
+    def stats(self):
+        """Return failure and refusal counts and the clients currently locked out"""
+        now = time.monotonic()
+        with self._lock:
+            locked_out = 0
+            for client in list(self._failures):
+                failures = self._recent(client, now)
+                if failures is not None and len(failures) >= self.max_failures:
+                    locked_out += 1
+            return {**self._counters, 'locked_out': locked_out,
+                    'max_failures': self.max_failures, 'window_seconds': self.window}
+
+
+# Failed logins of this process
+login_throttle = LoginThrottle()
@@ -0,0 +1,148 @@
+"""
+Batch generation of email responses.
+Reads emails from JSONL, runs each one through the same generation path as
+/generate_response with bounded concurrency, and yields a JSONL result line
+for every email as soon as it finishes. Results already present in a partial
+output file are skipped, so an interrupted run can be resumed.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Default and maximum number of emails generated at the same time
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 4))
+BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', 16))
+
+
+def parse_batch_lines(lines):
+    """
+    Parse JSONL input into batch items.
+
+    Each line is a JSON object with the email under "customer_email" (or
+    "email") and optional "id", "template_id", "customer_notes" (or "notes"),
+    "model" and "token_limit". Lines without an id are numbered from 1.
+
+    Args:
+        lines (iterable): Lines of JSONL text
+
+    Yields:
+        tuple: (item_id, data, error) where data is a generation request body,
+               or data is None and error explains why the line cannot be used
+    """
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield str(line_number), None, f"Invalid JSON on line {line_number}: {e}"
+            continue
+        if not isinstance(item, dict):
+            yield str(line_number), None, f"Line {line_number} is not a JSON object"
+            continue
+
+        item_id = str(item.get('id', line_number))
+        data = {
+            'customer_email': item.get('customer_email', item.get('email', '')),
+            'customer_notes': item.get('customer_notes', item.get('notes', '')),
+            'template_id': item.get('template_id'),
+        }
+        for key in ('model', 'token_limit', 'bypass_cache'):
+            if key in item:
+                data[key] = item[key]
+        yield item_id, data, None
+
+
+def completed_ids(lines):
+    """
+    Collect the ids of successful results from a (possibly partial) output file.
+
+    Failed results and lines cut off by an interruption are ignored, so those
+    emails are generated again on resume.
+    """
+    done = set()
+    for line in lines:
+        try:
+            result = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(result, dict) and result.get('status') == 'ok':
+            done.add(str(result.get('id')))
+    return done
+
+
+def _run_item(generate_fn, item_id, data):
+    """Generate one response and wrap the outcome in a result dictionary"""
+    start = time.perf_counter()
+    try:
+        response, reused = generate_fn(data)
+        result = {
+            'id': item_id,
+            'status': 'ok',
+            'response': response,
+            'elapsed_seconds': round(time.perf_counter() - start, 3),
+        }
+        if reused:
+            # An approved reply to a near-duplicate email answered instead of a generation
+            result['reused'] = reused
+        return result
+    except Exception as e:
+        return {
+            'id': item_id,
+            'status': 'error',
+            'error': str(e),
+            'elapsed_seconds': round(time.perf_counter() - start, 3),
+        }
+
+
+def run_batch(items, generate_fn, concurrency=BATCH_CONCURRENCY, skip_ids=()):
+    """
+    Generate responses for a stream of batch items.
+
+    At most `concurrency` generations run at once, and input is only read as
+    slots free up, so memory use does not grow with the size of the batch.
+
+    Args:
+        items (iterable): Tuples from parse_batch_lines
+        generate_fn (callable): Takes a generation request body and returns the response text
+            and the reused reply's details (or None)
+        concurrency (int): Maximum number of simultaneous generations
+        skip_ids (set): Ids that already have a result (resume)
+
+    Yields:
+        dict: One result per item, in the order they finish
+    """
+    concurrency = max(1, min(int(concurrency), BATCH_MAX_CONCURRENCY))
+    skip_ids = set(skip_ids)
+    items = iter(items)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch') as executor:
+        pending = set()
+        exhausted = False
+        while pending or not exhausted:
+            # Top up the in-flight set from the input
+            while not exhausted and len(pending) < concurrency:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+
+                item_id, data, error = item
+                if item_id in skip_ids:
+                    continue
+                if error is not None:
+                    yield {'id': item_id, 'status': 'error', 'error': error}
+                    continue
+                pending.add(executor.submit(_run_item, generate_fn, item_id, data))
+
+            if not pending:
+                continue
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
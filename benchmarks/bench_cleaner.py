@@ -0,0 +1,157 @@
+"""
+Microbenchmark for the response cleaner.
+
+Compares the previous implementation of clean_response (seven re.sub calls
+plus extra passes) with the single-pass cleaner and the streaming cleaner,
+after checking that all of them produce the same output.
+
+Usage:
+    python benchmarks/bench_cleaner.py [--corpus results.jsonl] [--repeat 5]
+
+The corpus is a JSONL file with a "response" field per line (for example the
+output of "flask batch-generate"); without one, a built-in sample of typical
+responses is used.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cleaner import StreamCleaner, clean_response  # noqa: E402
+
+OPENERS = [
+    "",
+    "",
+    "Certainly! Here's a response you can send to the customer:\n\n",
+    "Sure! I can help with that.\n\n",
+    "Here's a revised version of the email:\n\n---\n",
+    "I've updated the response as requested.\n\n",
+    "Here is a draft reply:\n\n",
+    "Below is a customer-friendly version:\n\n",
+]
+
+PARAGRAPHS = [
+    "Thank you for reaching out to us about your recent order. We understand how important it is "
+    "to receive your research materials on time — and we're here to help.",
+    "Your order has been processed and shipped via our standard carrier. You should receive a "
+    "tracking number by email within 24 hours; if it does not arrive, please let us know.",
+    "All of our peptides are supplied as lyophilized powder with a purity of 98% or higher, "
+    "verified by HPLC and mass spectrometry. Certificates of analysis are available on request.",
+    "For storage, we recommend keeping the vials at -20°C, away from light and moisture – "
+    "reconstituted solutions should be refrigerated and used within a few weeks.",
+    "Please note that our products are intended strictly for laboratory research purposes. "
+    "We are unable to provide guidance on dosage or any form of human or animal use.",
+    "If you have any further questions about product specifications or your order status, "
+    "feel free to reply to this email and our team will be happy to assist.",
+]
+
+
+def legacy_clean_response(response):
+    """The clean_response implementation this module replaced"""
+    prefatory_patterns = [
+        r"^Certainly!.*?\n\n",
+        r"^Sure!.*?\n\n",
+        r"^Here's.*?(\n\n|\n---\n)",
+        r"^I've.*?\n\n",
+        r"^Here is.*?\n\n",
+        r"^Below is.*?\n\n",
+        r"^The following.*?\n\n"
+    ]
+    for pattern in prefatory_patterns:
+        response = re.sub(pattern, "", response, flags=re.DOTALL)
+    response = re.sub(r"^---\n", "", response)
+    response = response.replace("—", "-")
+    response = response.replace("–", "-")
+    return response.strip()
+
+
+def sample_corpus(size=2000, seed=42):
+    """Build a corpus of typical responses (openers, 2-6 paragraphs, dashes)"""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        body = "\n\n".join(rng.choice(PARAGRAPHS) for _ in range(rng.randint(2, 6)))
+        corpus.append(rng.choice(OPENERS) + "Dear Customer,\n\n" + body + "\n\nBest regards,\nCustomer Service\n")
+    return corpus
+
+
+def load_corpus(path):
+    corpus = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(item, dict) and item.get('response'):
+                corpus.append(item['response'])
+    return corpus
+
+
+def chunked(text, size=12):
+    """Split a response into stream-like chunks of a few tokens"""
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def clean_stream(chunks):
+    cleaner = StreamCleaner()
+    parts = [cleaner.feed(chunk) for chunk in chunks]
+    parts.append(cleaner.finish())
+    return "".join(parts)
+
+
+def legacy_stream(chunks):
+    """What streaming cost before: buffer everything, clean at the end"""
+    return legacy_clean_response("".join(chunks))
+
+
+def bench(name, fn, inputs, repeat):
+    """Time fn over all inputs, best of `repeat` runs; returns microseconds per response"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in inputs:
+            fn(item)
+        timings.append(time.perf_counter() - start)
+    per_item = min(timings) / len(inputs) * 1e6
+    print(f"{name:<28} {per_item:8.2f} us/response   (median run {statistics.median(timings) * 1000:.1f} ms)")
+    return per_item
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--corpus', help='JSONL file with a "response" field per line')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else sample_corpus()
+    if not corpus:
+        sys.exit("Corpus is empty")
+    streams = [chunked(text) for text in corpus]
+
+    # The new cleaners must produce exactly what the old one did
+    for text, chunks in zip(corpus, streams):
+        expected = legacy_clean_response(text)
+        assert clean_response(text) == expected, text[:80]
+        assert clean_stream(chunks) == expected, text[:80]
+
+    print(f"{len(corpus)} responses, average {sum(map(len, corpus)) // len(corpus)} chars\n")
+    legacy = bench("legacy clean_response", legacy_clean_response, corpus, args.repeat)
+    current = bench("clean_response", clean_response, corpus, args.repeat)
+    print(f"{'':<28} {legacy / current:8.2f}x faster\n")
+    # Streaming: the old cleaner could only run once the whole response had arrived
+    chunks_per_response = sum(map(len, streams)) / len(streams)
+    bench("legacy (stream, buffered)", legacy_stream, streams, args.repeat)
+    incremental = bench("StreamCleaner", clean_stream, streams, args.repeat)
+    print(f"{'':<28} {incremental / chunks_per_response:8.2f} us/chunk ({chunks_per_response:.0f} chunks per response)")
+
+
+if __name__ == '__main__':
+    main()
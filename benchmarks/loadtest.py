@@ -0,0 +1,362 @@
+"""
+Load test for the email assistant.
+
+Starts the mock OpenAI server (benchmarks/mock_openai.py), then runs the app
+under gunicorn with each workers x threads setting in turn and drives login,
+/generate_response (blocking and streamed) and the template APIs with a fixed
+number of concurrent clients. Reports throughput and p50/p95/p99 latency per
+endpoint, and can compare against a saved baseline to catch regressions.
+
+Usage:
+    python benchmarks/loadtest.py --matrix 1x8,2x4,4x4 --concurrency 16 --duration 30
+    python benchmarks/loadtest.py --output baseline.json
+    python benchmarks/loadtest.py --baseline baseline.json --max-regression 0.2
+
+Use --app-url to test an app that is already running (the matrix is ignored);
+it must be configured to use the mock (OPENAI_BASE_URL) or a real key.
+
+Test templates are created with the tag "loadtest" and deleted afterwards.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_WEIGHTS = "generate=5,stream=2,templates=4,template=2,login=1"
+SEARCH_TERMS = ["order", "shipping", "purity", "storage", "refund", "research", "coa", "tracking"]
+SAMPLE_EMAILS = [
+    "Hi, I ordered BPC-157 last week and haven't received a tracking number yet. Can you check order #{n}?",
+    "Hello, what is the purity of your TB-500 and do you provide a certificate of analysis? Ref {n}",
+    "How should I store the lyophilized peptides once they arrive? Thanks ({n})",
+    "My package arrived damaged, one vial was broken. What can you do? Order {n}",
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return True
+        except requests.RequestException:
+            time.sleep(0.2)
+    return False
+
+
+def stop_process(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(math.ceil(p / 100.0 * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+class Client:
+    """One simulated user with its own logged-in session"""
+
+    def __init__(self, base_url, username, password, template_ids):
+        self.base_url = base_url
+        self.username = username
+        self.password = password
+        self.template_ids = template_ids
+        self.session = requests.Session()
+        self.login(self.session)
+
+    def login(self, session):
+        response = session.post(f"{self.base_url}/login", allow_redirects=False,
+                                data={'username': self.username, 'password': self.password}, timeout=30)
+        return response.status_code == 302
+
+    def run(self, scenario):
+        """Run one request of a scenario; returns (ok, extra timings)"""
+        if scenario == 'login':
+            return self.login(requests.Session()), {}
+
+        if scenario == 'generate':
+            response = self.session.post(f"{self.base_url}/generate_response", json=self._generation_body(), timeout=180)
+            return response.status_code == 200, {}
+
+        if scenario == 'stream':
+            start = time.perf_counter()
+            first_delta = None
+            ok = False
+            with self.session.post(f"{self.base_url}/generate_response/stream", json=self._generation_body(),
+                                   stream=True, timeout=180) as response:
+                if response.status_code != 200:
+                    return False, {}
+                for line in response.iter_lines(decode_unicode=True):
+                    if line == 'event: delta' and first_delta is None:
+                        first_delta = time.perf_counter() - start
+                    elif line == 'event: done':
+                        ok = True
+                    elif line == 'event: error':
+                        return False, {}
+            return ok, ({'stream_first_delta': first_delta} if first_delta is not None else {})
+
+        if scenario == 'templates':
+            params = {'search': random.choice(SEARCH_TERMS)} if random.random() < 0.5 else {}
+            response = self.session.get(f"{self.base_url}/api/templates", params=params, timeout=30)
+            return response.status_code == 200, {}
+
+        if scenario == 'template':
+            if not self.template_ids:
+                return True, {}
+            response = self.session.get(f"{self.base_url}/api/templates/{random.choice(self.template_ids)}", timeout=30)
+            return response.status_code == 200, {}
+
+        raise ValueError(f"Unknown scenario: {scenario}")
+
+    def _generation_body(self):
+        # A unique email per request, so the completion cache never answers
+        email = random.choice(SAMPLE_EMAILS).format(n=random.randrange(10 ** 9))
+        return {'customer_email': email, 'model': 'gpt-4.1', 'token_limit': 500}
+
+
+def seed_templates(base_url, username, password, count):
+    """Create test templates; returns their ids"""
+    session = requests.Session()
+    session.post(f"{base_url}/login", data={'username': username, 'password': password}, timeout=30)
+    ids = []
+    for n in range(count):
+        term = SEARCH_TERMS[n % len(SEARCH_TERMS)]
+        response = session.post(f"{base_url}/api/templates", timeout=30, json={
+            'title': f"Load test {term} {n}",
+            'content': f"Thank you for your question about {term}. " * 20,
+            'tags': ['loadtest', term],
+        })
+        if response.status_code == 201:
+            ids.append(response.json()['id'])
+    return ids
+
+
+def delete_templates(base_url, username, password, ids):
+    session = requests.Session()
+    session.post(f"{base_url}/login", data={'username': username, 'password': password}, timeout=30)
+    for template_id in ids:
+        session.delete(f"{base_url}/api/templates/{template_id}", timeout=30)
+
+
+def run_load(base_url, args, template_ids):
+    """Drive the app with args.concurrency clients for args.duration seconds"""
+    scenarios, weights = zip(*args.weights.items())
+    results = {}
+    lock = threading.Lock()
+    stop_at = time.monotonic() + args.warmup + args.duration
+    measure_from = time.monotonic() + args.warmup
+
+    def user():
+        client = Client(base_url, args.username, args.password, template_ids)
+        while time.monotonic() < stop_at:
+            scenario = random.choices(scenarios, weights)[0]
+            start = time.perf_counter()
+            try:
+                ok, extra = client.run(scenario)
+            except requests.RequestException:
+                ok, extra = False, {}
+            elapsed = time.perf_counter() - start
+            if time.monotonic() < measure_from:
+                continue
+            with lock:
+                entry = results.setdefault(scenario, {'latencies': [], 'errors': 0})
+                entry['latencies'].append(elapsed)
+                if not ok:
+                    entry['errors'] += 1
+                for name, value in extra.items():
+                    results.setdefault(name, {'latencies': [], 'errors': 0})['latencies'].append(value)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in [executor.submit(user) for _ in range(args.concurrency)]:
+            future.result()
+
+    report = {}
+    total = 0
+    for scenario, entry in sorted(results.items()):
+        latencies = sorted(entry['latencies'])
+        is_request = scenario in args.weights
+        if is_request:
+            total += len(latencies)
+        report[scenario] = {
+            'requests': len(latencies),
+            'errors': entry['errors'],
+            'rps': round(len(latencies) / args.duration, 2) if is_request else None,
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        }
+    report['total'] = {'requests': total, 'rps': round(total / args.duration, 2)}
+    return report
+
+
+def print_report(name, report):
+    print(f"\n== {name} ==")
+    print(f"{'endpoint':<20}{'requests':>9}{'errors':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for scenario, stats in report.items():
+        if scenario == 'total':
+            continue
+        rps = f"{stats['rps']:.2f}" if stats['rps'] is not None else "-"
+        print(f"{scenario:<20}{stats['requests']:>9}{stats['errors']:>8}{rps:>9}"
+              f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+    print(f"{'total':<20}{report['total']['requests']:>9}{'':>8}{report['total']['rps']:>9.2f}")
+
+
+def compare(results, baseline, max_regression):
+    """Return a list of regressions: lower throughput or higher p95 than the baseline allows"""
+    problems = []
+    for config, report in results.items():
+        base = baseline.get(config)
+        if not base:
+            continue
+        base_rps, rps = base['total']['rps'], report['total']['rps']
+        if base_rps and rps < base_rps * (1 - max_regression):
+            problems.append(f"{config}: throughput {rps} rps vs {base_rps} rps")
+        for scenario, stats in report.items():
+            base_stats = base.get(scenario)
+            if scenario == 'total' or not base_stats:
+                continue
+            if stats['p95_ms'] > base_stats['p95_ms'] * (1 + max_regression):
+                problems.append(f"{config} {scenario}: p95 {stats['p95_ms']} ms vs {base_stats['p95_ms']} ms")
+            if stats['errors'] > base_stats['errors'] and stats['errors'] > stats['requests'] * 0.01:
+                problems.append(f"{config} {scenario}: {stats['errors']} errors vs {base_stats['errors']}")
+    return problems
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the email assistant against a mock OpenAI server")
+    parser.add_argument('--matrix', default='1x8,2x4,4x4',
+                        help='Comma-separated gunicorn WORKERSxTHREADS settings (default: 1x8,2x4,4x4)')
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=20, help='Measured seconds per setting')
+    parser.add_argument('--warmup', type=float, default=3, help='Unmeasured seconds before each run')
+    parser.add_argument('--weights', default=DEFAULT_WEIGHTS,
+                        help=f'Scenario mix as name=weight pairs (default: {DEFAULT_WEIGHTS})')
+    parser.add_argument('--seed-templates', type=int, default=60, help='Test templates to create')
+    parser.add_argument('--mock-args', default='--latency lognormal --latency-ms 800 --latency-spread-ms 400',
+                        help='Arguments for benchmarks/mock_openai.py')
+    parser.add_argument('--gunicorn-args', default='--timeout 120', help='Extra gunicorn arguments')
+    parser.add_argument('--app-url', help='Test an already running app instead of starting gunicorn')
+    parser.add_argument('--username', default=os.environ.get('APP_USERNAME', 'admin'))
+    parser.add_argument('--password', default=os.environ.get('APP_PASSWORD', 'peptideservice'))
+    parser.add_argument('--output', help='Write the results as JSON (e.g. to use as a baseline)')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='Allowed throughput drop / p95 increase vs the baseline (default: 0.2)')
+    args = parser.parse_args(argv)
+
+    weights = {}
+    for pair in args.weights.split(','):
+        name, _, weight = pair.partition('=')
+        weights[name.strip()] = float(weight or 1)
+    args.weights = {name: weight for name, weight in weights.items() if weight > 0}
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {}
+    processes = []
+    log_dir = tempfile.mkdtemp(prefix='loadtest-')
+
+    try:
+        if args.app_url:
+            targets = [(args.app_url.rstrip('/'), 'external')]
+        else:
+            mock_port = free_port()
+            mock = subprocess.Popen(
+                [sys.executable, os.path.join(ROOT, 'benchmarks', 'mock_openai.py'), '--port', str(mock_port)]
+                + shlex.split(args.mock_args),
+                stdout=open(os.path.join(log_dir, 'mock.log'), 'w'), stderr=subprocess.STDOUT
+            )
+            processes.append(mock)
+            if not wait_until_ready(f"http://127.0.0.1:{mock_port}/stats"):
+                sys.exit("Mock OpenAI server did not start")
+            targets = [(None, setting.strip()) for setting in args.matrix.split(',') if setting.strip()]
+
+        for url, setting in targets:
+            app = None
+            if url is None:
+                workers, threads = (int(value) for value in setting.lower().split('x'))
+                port = free_port()
+                env = dict(os.environ,
+                           OPENAI_BASE_URL=f"http://127.0.0.1:{mock_port}/v1",
+                           OPENAI_API_KEY='loadtest',
+                           APP_USERNAME=args.username,
+                           APP_PASSWORD=args.password,
+                           OPENAI_POOL_MAXSIZE=str(max(threads, 10)))
+                app = subprocess.Popen(
+                    [sys.executable, '-m', 'gunicorn', 'app:app', '--worker-class', 'gthread',
+                     '--workers', str(workers), '--threads', str(threads), '--bind', f'127.0.0.1:{port}']
+                    + shlex.split(args.gunicorn_args),
+                    cwd=ROOT, env=env,
+                    stdout=open(os.path.join(log_dir, f'gunicorn-{setting}.log'), 'w'), stderr=subprocess.STDOUT
+                )
+                processes.append(app)
+                url = f"http://127.0.0.1:{port}"
+                if not wait_until_ready(f"{url}/login", timeout=60):
+                    sys.exit(f"App did not start with {setting} (see {log_dir})")
+                name = f"{workers}x{threads}"
+            else:
+                name = setting
+
+            template_ids = seed_templates(url, args.username, args.password, args.seed_templates)
+            try:
+                print(f"Running {name}: {args.concurrency} users for {args.duration:.0f}s ...", flush=True)
+                results[name] = run_load(url, args, template_ids)
+                print_report(f"{name} (workers x threads)" if app else name, results[name])
+            finally:
+                delete_templates(url, args.username, args.password, template_ids)
+                if app is not None:
+                    stop_process(app)
+    finally:
+        for process in processes:
+            stop_process(process)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        problems = compare(results, baseline, args.max_regression)
+        if problems:
+            print("\nRegressions against the baseline:")
+            for problem in problems:
+                print(f"  {problem}")
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+Mock OpenAI chat completions server for load tests.
+
+Answers POST /v1/chat/completions (blocking and streamed) after a random
+delay drawn from a configurable latency distribution, injects 500 errors and
+429 responses at configurable rates, and sends x-ratelimit-* headers from a
+simulated per-minute request/token budget. Uses only the standard library.
+
+Usage:
+    python benchmarks/mock_openai.py --port 8765 --latency lognormal --latency-ms 800 \\
+        --error-rate 0.01 --rate-429 0.02
+
+Point the app at it with:
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=test gunicorn app:app
+
+GET /stats returns request counts; POST /stats/reset clears them.
+"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FILLER = (
+    "Thank you for reaching out to us. Your order has been processed and will ship within one "
+    "business day. Our peptides are supplied for laboratory research use only, with a purity of "
+    "98% or higher verified by HPLC. Please let us know if you have any other questions."
+).split()
+
+
+class LatencyModel:
+    """Draws response latencies (seconds) from the configured distribution"""
+
+    def __init__(self, kind, mean_ms, spread_ms, max_ms):
+        self.kind = kind
+        self.mean = mean_ms / 1000.0
+        self.spread = spread_ms / 1000.0
+        self.max = max_ms / 1000.0 if max_ms else None
+
+    def sample(self):
+        if self.kind == 'fixed':
+            value = self.mean
+        elif self.kind == 'uniform':
+            value = random.uniform(max(self.mean - self.spread, 0.0), self.mean + self.spread)
+        elif self.kind == 'normal':
+            value = random.gauss(self.mean, self.spread)
+        else:
+            # Log-normal with the requested mean and standard deviation: a long right tail,
+            # like real completion latencies
+            variance = math.log(1 + (self.spread / self.mean) ** 2) if self.mean else 0.0
+            value = random.lognormvariate(math.log(self.mean or 1e-6) - variance / 2, math.sqrt(variance))
+        value = max(value, 0.0)
+        return min(value, self.max) if self.max else value
+
+
+class Budget:
+    """Per-minute request and token budget, refilled continuously (like OpenAI's limits)"""
+
+    def __init__(self, rpm, tpm):
+        self.limits = {'requests': rpm, 'tokens': tpm}
+        self.remaining = {'requests': float(rpm), 'tokens': float(tpm)}
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, tokens):
+        """Consume budget; returns (allowed, headers)"""
+        with self.lock:
+            now = time.monotonic()
+            for kind, limit in self.limits.items():
+                self.remaining[kind] = min(limit, self.remaining[kind] + limit / 60.0 * (now - self.updated))
+            self.updated = now
+
+            allowed = self.remaining['requests'] >= 1 and self.remaining['tokens'] >= tokens
+            if allowed:
+                self.remaining['requests'] -= 1
+                self.remaining['tokens'] -= tokens
+
+            headers = {}
+            for kind, limit in self.limits.items():
+                remaining = max(self.remaining[kind], 0.0)
+                reset = (limit - remaining) / (limit / 60.0)
+                headers[f'x-ratelimit-limit-{kind}'] = str(limit)
+                headers[f'x-ratelimit-remaining-{kind}'] = str(int(remaining))
+                headers[f'x-ratelimit-reset-{kind}'] = f"{reset:.3f}s"
+            return allowed, headers
+
+
+class MockState:
+    def __init__(self, args):
+        self.args = args
+        self.latency = LatencyModel(args.latency, args.latency_ms, args.latency_spread_ms, args.latency_max_ms)
+        self.budget = Budget(args.rpm, args.tpm) if args.rpm else None
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+
+def estimate_tokens(payload):
+    chars = sum(len(message.get('content') or '') for message in payload.get('messages', []))
+    return chars // 4
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        if self.state.args.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with self.state.lock:
+                counters = dict(self.state.counters)
+            return self._send_json(200, counters)
+        self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+
+        if self.path == '/stats/reset':
+            with self.state.lock:
+                self.state.counters.clear()
+            return self._send_json(200, {})
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            return self._send_json(404, {'error': {'message': 'Not found'}})
+
+        try:
+            payload = json.loads(body)
+        except json.JSONDecodeError:
+            return self._send_json(400, {'error': {'message': 'Invalid JSON'}})
+
+        args = self.state.args
+        self.state.count('requests')
+        prompt_tokens = estimate_tokens(payload)
+        max_tokens = payload.get('max_completion_tokens') or payload.get('max_tokens') or 1000
+
+        headers = {}
+        if self.state.budget:
+            allowed, headers = self.state.budget.take(prompt_tokens + max_tokens)
+            if not allowed:
+                self.state.count('429_budget')
+                headers['retry-after-ms'] = str(int(args.retry_after * 1000))
+                return self._send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}}, headers)
+
+        roll = random.random()
+        if roll < args.rate_429:
+            self.state.count('429_injected')
+            headers['retry-after'] = str(args.retry_after)
+            return self._send_json(429, {'error': {'message': 'Rate limit reached (injected)'}}, headers)
+        if roll < args.rate_429 + args.error_rate:
+            self.state.count('500_injected')
+            time.sleep(self.state.latency.sample() / 4)
+            return self._send_json(500, {'error': {'message': 'Internal error (injected)'}}, headers)
+
+        words = min(args.response_words, max_tokens)
+        text = " ".join(FILLER[i % len(FILLER)] for i in range(words))
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': words,
+            'total_tokens': prompt_tokens + words,
+            'prompt_tokens_details': {'cached_tokens': 0},
+        }
+
+        if payload.get('stream'):
+            return self._stream(payload, text, usage, headers)
+
+        time.sleep(self.state.latency.sample())
+        self.state.count('completions')
+        self._send_json(200, {
+            'id': 'chatcmpl-mock',
+            'object': 'chat.completion',
+            'model': payload.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+            'usage': usage,
+        }, headers)
+
+    def _stream(self, payload, text, usage, headers):
+        """Send the completion as server-sent events: the latency is spread over the chunks"""
+        total = self.state.latency.sample()
+        words = text.split(" ")
+        first_token = total * self.state.args.first_token_share
+        per_chunk = (total - first_token) / max(len(words), 1)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        def write(data):
+            encoded = data.encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(encoded), encoded))
+            self.wfile.flush()
+
+        time.sleep(first_token)
+        for index, word in enumerate(words):
+            content = word if index == 0 else " " + word
+            write("data: " + json.dumps({'choices': [{'index': 0, 'delta': {'content': content}}]}) + "\n\n")
+            time.sleep(per_chunk)
+        if (payload.get('stream_options') or {}).get('include_usage'):
+            write("data: " + json.dumps({'choices': [], 'usage': usage}) + "\n\n")
+        write("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.state.count('completions')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mock OpenAI chat completions server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', choices=['fixed', 'uniform', 'normal', 'lognormal'], default='lognormal',
+                        help='Latency distribution (default: lognormal)')
+    parser.add_argument('--latency-ms', type=float, default=800, help='Mean latency in ms')
+    parser.add_argument('--latency-spread-ms', type=float, default=400,
+                        help='Standard deviation (normal, lognormal) or half-width (uniform) in ms')
+    parser.add_argument('--latency-max-ms', type=float, default=0, help='Cap on latency in ms (0 = no cap)')
+    parser.add_argument('--first-token-share', type=float, default=0.3,
+                        help='Fraction of a streamed response\'s latency before the first chunk')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 500')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Fraction of requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After sent with 429s (seconds)')
+    parser.add_argument('--rpm', type=int, default=0,
+                        help='Simulated requests per minute limit (0 = no budget, no x-ratelimit headers)')
+    parser.add_argument('--tpm', type=int, default=2000000, help='Simulated tokens per minute limit')
+    parser.add_argument('--response-words', type=int, default=120, help='Words per completion')
+    parser.add_argument('--seed', type=int, help='Random seed')
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    Handler.state = MockState(args)
+    # The default listen backlog of 5 drops connections when many calls start at once
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"Mock OpenAI server on http://{args.host}:{args.port}/v1 "
+          f"({args.latency} latency, mean {args.latency_ms:.0f} ms)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
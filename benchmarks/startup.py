@@ -0,0 +1,210 @@
+"""
+Startup-time benchmark for the email assistant.
+
+Measures how long a fresh process takes to import the app, serve its first
+request and complete the first login, for each startup configuration:
+
+    password   APP_PASSWORD only, schema checked and migrated at boot
+    hash       APP_PASSWORD_HASH and DB_AUTO_MIGRATE=0 (migrations run once up front)
+
+Then it starts gunicorn (with gunicorn.conf.py) with preload_app on and off,
+and measures the time until the first response, and how long a replacement
+worker takes to serve requests after the only worker is killed (the cost of
+every crash, max_requests restart and scale-up).
+
+Usage:
+    python benchmarks/startup.py [--runs 5] [--skip-gunicorn]
+
+Each run uses a fresh copy of a temporary database; nothing in the instance
+folder is touched.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PASSWORD = 'startup-benchmark'
+
+# Run in a child process so each measurement starts from an empty interpreter
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+client.get('/login')
+ready = time.perf_counter()
+client.post('/login', data={{'username': 'admin', 'password': {password!r}}})
+logged_in = time.perf_counter()
+print(json.dumps({{'import_ms': (imported - started) * 1000, 'ready_ms': (ready - started) * 1000,
+                  'login_ms': (logged_in - ready) * 1000, 'numpy_loaded': 'numpy' in sys.modules}}))
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def password_hash():
+    from werkzeug.security import generate_password_hash
+    return generate_password_hash(PASSWORD)
+
+
+def prepare_database(work_dir):
+    """Create a migrated database to copy for each run"""
+    template = os.path.join(work_dir, 'template.db')
+    env = base_env(work_dir, template)
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'db-upgrade'], cwd=ROOT, env=env,
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return template
+
+
+def base_env(work_dir, database):
+    return dict(os.environ,
+                DATABASE_URL=f"sqlite:///{database}",
+                RECOMMEND_INDEX_PATH=os.path.join(work_dir, 'template_index.npz'),
+                RATE_LIMIT_DB=os.path.join(work_dir, 'ratelimits.db'),
+                JOBS_DB_PATH=os.path.join(work_dir, 'jobs.db'),
+                APP_USERNAME='admin',
+                OPENAI_API_KEY='startup-benchmark',
+                LOG_LEVEL='WARNING')
+
+
+def configuration_env(name, work_dir, database, hashed):
+    env = base_env(work_dir, database)
+    env.pop('APP_PASSWORD_HASH', None)
+    if name == 'password':
+        env.update(APP_PASSWORD=PASSWORD, DB_AUTO_MIGRATE='1')
+    else:
+        env.update(APP_PASSWORD_HASH=hashed, DB_AUTO_MIGRATE='0')
+    return env
+
+
+def fresh_database(work_dir, template, run):
+    database = os.path.join(work_dir, f'run-{run}.db')
+    shutil.copyfile(template, database)
+    return database
+
+
+def measure_process(env):
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', CHILD.format(root=ROOT, password=PASSWORD)],
+                            cwd=ROOT, env=env, check=True, capture_output=True, text=True).stdout
+    total_ms = (time.perf_counter() - started) * 1000
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process_ms'] = total_ms
+    return result
+
+
+def wait_for_response(url, timeout=60):
+    """Poll url until it answers; returns the time it took in seconds, or None"""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return time.perf_counter() - started
+        except (urllib.error.URLError, ConnectionError, OSError):
+            time.sleep(0.01)
+    return None
+
+
+def worker_pids(master_pid):
+    output = subprocess.run(['pgrep', '-P', str(master_pid)], capture_output=True, text=True).stdout
+    return [int(pid) for pid in output.split()]
+
+
+def measure_gunicorn(env, preload):
+    """Return (seconds to first response, seconds for a replacement worker to answer)"""
+    port = free_port()
+    env = dict(env, PORT=str(port), WEB_CONCURRENCY='1', GUNICORN_PRELOAD='1' if preload else '0')
+    url = f"http://127.0.0.1:{port}/login"
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:app'], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        first = wait_for_response(url)
+        if first is None:
+            return None, None
+        pids = worker_pids(server.pid)
+        if not pids:
+            return first, None
+        killed = time.perf_counter()
+        os.kill(pids[0], signal.SIGKILL)
+        # Wait for the old worker to be gone so the next answer comes from its replacement
+        while pids[0] in worker_pids(server.pid):
+            time.sleep(0.005)
+        respawn = wait_for_response(url)
+        return first, (time.perf_counter() - killed) if respawn is not None else None
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def summarize(values):
+    values = [value for value in values if value is not None]
+    return statistics.median(values) if values else None
+
+
+def ms(value):
+    return f"{value:.0f}" if value is not None else "-"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure how long the app takes to become ready")
+    parser.add_argument('--runs', type=int, default=5, help='Runs per configuration (medians are reported)')
+    parser.add_argument('--skip-gunicorn', action='store_true', help='Only measure plain process startup')
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='startup-')
+    try:
+        template = prepare_database(work_dir)
+        hashed = password_hash()
+
+        print(f"Process startup, median of {args.runs} runs (ms)")
+        print(f"{'configuration':<16}{'import':>9}{'ready':>9}{'process':>9}{'1st login':>11}  numpy at start")
+        for name in ('password', 'hash'):
+            results = []
+            for run in range(args.runs):
+                env = configuration_env(name, work_dir, fresh_database(work_dir, template, run), hashed)
+                results.append(measure_process(env))
+            print(f"{name:<16}{ms(summarize(r['import_ms'] for r in results)):>9}"
+                  f"{ms(summarize(r['ready_ms'] for r in results)):>9}"
+                  f"{ms(summarize(r['process_ms'] for r in results)):>9}"
+                  f"{ms(summarize(r['login_ms'] for r in results)):>11}"
+                  f"  {'yes' if any(r['numpy_loaded'] for r in results) else 'no'}")
+
+        if args.skip_gunicorn:
+            return
+        print(f"\ngunicorn with gunicorn.conf.py, 1 worker, 'hash' configuration, median of {args.runs} runs (ms)")
+        print(f"{'preload_app':<16}{'first response':>16}{'replacement worker':>20}")
+        for preload in (True, False):
+            firsts, respawns = [], []
+            for run in range(args.runs):
+                env = configuration_env('hash', work_dir, fresh_database(work_dir, template, run), hashed)
+                first, respawn = measure_gunicorn(env, preload)
+                firsts.append(first * 1000 if first is not None else None)
+                respawns.append(respawn * 1000 if respawn is not None else None)
+            print(f"{'on' if preload else 'off':<16}{ms(summarize(firsts)):>16}{ms(summarize(respawns)):>20}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Cleanup of AI responses.
+Removes prefatory text ("Certainly! ...", "Here's ...") from the start of a
+response and replaces em/en dashes, either on a complete response in one
+regex pass or incrementally on a stream of chunks.
+"""
+
+import re
+
+# Prefatory openers, tried in this order, each at most once, at the start of
+# the (remaining) response. Each removes the opener up to the end of its
+# paragraph (the first terminator after it).
+PREFATORY_OPENERS = [
+    ("Certainly!", ("\n\n",)),
+    ("Sure!", ("\n\n",)),
+    ("Here's", ("\n\n", "\n---\n")),
+    ("I've", ("\n\n",)),
+    ("Here is", ("\n\n",)),
+    ("Below is", ("\n\n",)),
+    ("The following", ("\n\n",)),
+]
+
+# A "---" divider left at the start after the openers are removed
+LEADING_DIVIDER = "---\n"
+
+
+def _opener_pattern(opener, terminators):
+    alternatives = "|".join(re.escape(terminator) for terminator in terminators)
+    return f"(?:{re.escape(opener)}.*?(?:{alternatives}))?"
+
+
+# One anchored pass equivalent to applying the openers one after another:
+# every group is optional, so each takes its shortest match (or none) and
+# the next group continues where it stopped
+_PREFATORY_RE = re.compile(
+    "".join(_opener_pattern(opener, terminators) for opener, terminators in PREFATORY_OPENERS)
+    + f"(?:{re.escape(LEADING_DIVIDER)})?",
+    re.DOTALL
+)
+
+# Em dash and en dash become hyphens
+DASHES = (("—", "-"), ("–", "-"))
+
+# Longest stretch held back while waiting for the end of a possible opener;
+# longer prefatory paragraphs are left in the stream (the final response is
+# still cleaned with clean_response)
+MAX_OPENER_HOLD = 500
+
+
+def replace_dashes(text):
+    """Replace em and en dashes with hyphens"""
+    # str.replace is a fast C scan; str.translate is far slower for a two-character table
+    for dash, replacement in DASHES:
+        text = text.replace(dash, replacement)
+    return text
+
+
+def clean_response(response):
+    """Clean up the response by removing common prefatory text and em dashes"""
+    match = _PREFATORY_RE.match(response)
+    return replace_dashes(response[match.end():]).strip()
+
+
+class StreamCleaner:
+    """
+    Incremental version of clean_response for streamed responses.
+
+    Text is held back only while the start of the response could still be a
+    prefatory opener, and trailing whitespace is held until more text follows,
+    so the concatenated output equals clean_response() of the whole response.
+
+    Usage:
+        cleaner = StreamCleaner()
+        for chunk in chunks:
+            emit(cleaner.feed(chunk))
+        emit(cleaner.finish())
+    """
+
+    def __init__(self, max_hold=MAX_OPENER_HOLD):
+        self.max_hold = max_hold
+        self._buffer = ""      # Text not yet past the opener check
+        self._opener = 0       # Index of the next opener to try
+        self._position = 0     # Start of the remaining text in the buffer
+        self._in_prefix = True
+        self._started = False  # Whether any non-whitespace text was emitted
+        self._pending = ""     # Whitespace held back until more text follows
+
+    def feed(self, chunk):
+        """Add a chunk of the response and return the text that is safe to show"""
+        if not chunk:
+            return ""
+        if not self._in_prefix:
+            return self._emit(chunk)
+
+        self._buffer += chunk
+        if not self._scan_prefix(final=False):
+            return ""
+        return self._finish_prefix()
+
+    def finish(self):
+        """Return whatever is still held back once the response is complete"""
+        if self._in_prefix:
+            self._scan_prefix(final=True)
+            text = self._finish_prefix()
+        else:
+            text = ""
+        # Trailing whitespace is dropped, as strip() would
+        self._pending = ""
+        return text
+
+    def _scan_prefix(self, final):
+        """
+        Advance through the openers as far as the buffered text allows.
+
+        Returns:
+            bool: True once the prefix is settled, False if more text is needed
+        """
+        buffer = self._buffer
+        while self._opener < len(PREFATORY_OPENERS):
+            opener, terminators = PREFATORY_OPENERS[self._opener]
+            rest = buffer[self._position:]
+
+            if len(rest) < len(opener) and opener.startswith(rest) and not final:
+                return False  # Could still become this opener
+            if not rest.startswith(opener):
+                self._opener += 1
+                continue
+
+            end = self._find_terminator(buffer, self._position + len(opener), terminators)
+            if end is None:
+                if not final and len(buffer) - self._position <= self.max_hold:
+                    return False  # Wait for the end of the opener's paragraph
+                self._opener += 1
+                continue
+
+            self._position = end
+            self._opener += 1
+
+        rest = buffer[self._position:]
+        if len(rest) < len(LEADING_DIVIDER) and LEADING_DIVIDER.startswith(rest) and not final:
+            return False
+        if rest.startswith(LEADING_DIVIDER):
+            self._position += len(LEADING_DIVIDER)
+        return True
+
+    @staticmethod
+    def _find_terminator(text, start, terminators):
+        """Return the end of the earliest terminator at or after start, or None"""
+        best = None
+        for terminator in terminators:
+            index = text.find(terminator, start)
+            if index != -1 and (best is None or index < best[0]):
+                best = (index, index + len(terminator))
+        return best[1] if best else None
+
+    def _finish_prefix(self):
+        self._in_prefix = False
+        text = self._buffer[self._position:]
+        self._buffer = ""
+        return self._emit(text)
+
+    def _emit(self, text):
+        """Rewrite dashes and handle leading/trailing whitespace"""
+        text = replace_dashes(text)
+        if not self._started:
+            text = text.lstrip()
+            if not text:
+                return ""
+            self._started = True
+
+        text = self._pending + text
+        stripped = text.rstrip()
+        self._pending = text[len(stripped):]
+        return stripped
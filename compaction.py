@@ -0,0 +1,218 @@
+"""
+Compaction of customer emails before they are put into a prompt.
+Drops quoted reply history, signatures and legal boilerplate, collapses
+whitespace and can cap the email to a token budget, reporting how many
+prompt tokens were saved.
+"""
+
+import os
+import re
+
+# Compact emails unless the request asks to keep the original
+COMPACTION_ENABLED = os.environ.get('COMPACTION_ENABLED', '1') == '1'
+
+# Maximum estimated tokens of the compacted email (0 = no cap)
+COMPACTION_TOKEN_BUDGET = int(os.environ.get('COMPACTION_TOKEN_BUDGET', 0))
+
+TRUNCATION_MARKER = "[...]"
+
+# Lines that start the quoted previous message in a reply; everything after them is history
+_REPLY_HEADERS = re.compile(
+    r"^(?:"
+    r"On\s.{0,200}?wrote:"                                 # Gmail / Apple Mail
+    r"|-{2,}\s*Original Message\s*-{2,}"                  # Outlook (plain text)
+    r"|_{10,}"                                            # Outlook (HTML converted)
+    r"|Am\s.{0,200}?schrieb.{0,100}:"                     # Common non-English variants
+    r"|Le\s.{0,200}?a écrit\s?:"
+    r"|El\s.{0,200}?escribió:"
+    r")\s*$",
+    re.IGNORECASE | re.MULTILINE
+)
+
+# Outlook header block: From: followed by Sent:/Date: and To:/Subject: lines
+_HEADER_BLOCK = re.compile(
+    r"^From:\s.+\n(?:.*\n){0,2}?(?:Sent|Date):\s.+\n(?:.*\n){0,3}?(?:To|Subject):\s",
+    re.IGNORECASE | re.MULTILINE
+)
+
+# Standard signature delimiter ("-- ") and mobile client footers
+_SIGNATURE_DELIMITER = re.compile(r"^--\s?$", re.MULTILINE)
+_CLIENT_FOOTERS = re.compile(
+    r"^(?:Sent from my \w+.*|Sent from (?:Mail|Outlook|Yahoo Mail).*|Get Outlook for \w+.*)$",
+    re.IGNORECASE | re.MULTILINE
+)
+
+# Sign-off lines; the name after them is kept, contact details below it are dropped
+_SIGN_OFF = re.compile(
+    r"^(?:best(?: regards| wishes)?|kind regards|warm regards|regards|sincerely|cheers|"
+    r"thanks(?: again| so much| in advance)?|thank you(?: so much| in advance)?|many thanks|"
+    r"all the best|respectfully)[,.!]?\s*$",
+    re.IGNORECASE
+)
+SIGN_OFF_KEEP_LINES = 1
+SIGNATURE_MAX_LINES = 12
+SIGNATURE_MAX_LINE_LENGTH = 80
+
+# Paragraphs of legal or marketing boilerplate
+_BOILERPLATE = re.compile(
+    r"(?:confidential|privileged).{0,200}(?:intended (?:solely )?(?:for|recipient)|addressee)"
+    r"|intended (?:solely )?for the (?:use of the )?(?:individual|addressee|named recipient)"
+    r"|(?:received|got) this (?:e-?mail|message|communication) in error"
+    r"|\bunsubscribe\b|\bdisclaimer\b|virus[- ]free|scanned for viruses",
+    re.IGNORECASE | re.DOTALL
+)
+
+_TOKEN_PIECES = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text):
+    """
+    Estimate the number of tokens in a text without a tokenizer.
+
+    Counts words and punctuation marks; long words count as several tokens
+    (about four characters each), which tracks BPE tokenizers closely for
+    English prose.
+    """
+    return sum(max(1, (len(piece) + 3) // 4) for piece in _TOKEN_PIECES.findall(text))
+
+
+def _cut_quoted_history(text):
+    """Cut the email at the first reply header, unless nothing would be left"""
+    cut_points = [match.start() for match in (_REPLY_HEADERS.search(text), _HEADER_BLOCK.search(text)) if match]
+    for cut in sorted(cut_points):
+        if text[:cut].strip():
+            return text[:cut], True
+    return text, False
+
+
+def _drop_quoted_lines(text):
+    """Drop lines quoted with ">" (inline or bottom-posted replies)"""
+    lines = text.split("\n")
+    kept = [line for line in lines if not line.lstrip().startswith(">")]
+    return "\n".join(kept), len(kept) != len(lines)
+
+
+def _cut_signature(text):
+    """Drop the signature block after a "-- " delimiter or a sign-off line"""
+    text, footers = _CLIENT_FOOTERS.subn("", text)
+
+    delimiter = _SIGNATURE_DELIMITER.search(text)
+    if delimiter and text[:delimiter.start()].strip():
+        return text[:delimiter.start()], True
+
+    # Look for the last sign-off near the end and keep only the name after it
+    lines = text.rstrip().split("\n")
+    start = max(len(lines) - SIGNATURE_MAX_LINES - 1, 1)
+    for index in range(len(lines) - 1, start - 1, -1):
+        if _SIGN_OFF.match(lines[index].strip()):
+            keep = index + 1
+            kept_after = 0
+            while keep < len(lines) and kept_after < SIGN_OFF_KEEP_LINES and lines[keep].strip():
+                keep += 1
+                kept_after += 1
+            # Only drop what looks like contact details, never more of the message
+            dropped = [line.strip() for line in lines[keep:] if line.strip()]
+            if dropped and all(len(line) <= SIGNATURE_MAX_LINE_LENGTH and not line.endswith("?")
+                               for line in dropped):
+                return "\n".join(lines[:keep]), True
+            break
+    return text, footers > 0
+
+
+def _drop_boilerplate(text):
+    """Drop paragraphs that are legal disclaimers or mailing list footers"""
+    paragraphs = re.split(r"\n\s*\n", text)
+    kept = [paragraph for paragraph in paragraphs if not _BOILERPLATE.search(paragraph)]
+    if not kept:
+        return text, False
+    return "\n\n".join(kept), len(kept) != len(paragraphs)
+
+
+def collapse_whitespace(text):
+    """Normalize spaces and line breaks without changing the visible text"""
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = text.replace("\u00a0", " ").replace("\u200b", "")
+    text = re.sub(r"[ \t\f\v]+", " ", text)
+    text = re.sub(r" ?\n ?", "\n", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+
+def truncate_to_budget(text, token_budget):
+    """
+    Shorten a text to roughly token_budget tokens, keeping its beginning.
+
+    Whole paragraphs are kept while they fit, then whole sentences of the
+    next paragraph. A marker shows that the rest was left out.
+    """
+    if estimate_tokens(text) <= token_budget:
+        return text, False
+
+    budget = token_budget - estimate_tokens(TRUNCATION_MARKER)
+    kept = []
+    used = 0
+    for paragraph in text.split("\n\n"):
+        cost = estimate_tokens(paragraph)
+        if used + cost <= budget:
+            kept.append(paragraph)
+            used += cost
+            continue
+        sentences = []
+        for sentence in _SENTENCE_END.split(paragraph):
+            cost = estimate_tokens(sentence)
+            if used + cost > budget:
+                break
+            sentences.append(sentence)
+            used += cost
+        if sentences:
+            kept.append(" ".join(sentences))
+        break
+
+    kept.append(TRUNCATION_MARKER)
+    return "\n\n".join(kept), True
+
+
+def compact_email(text, token_budget=COMPACTION_TOKEN_BUDGET):
+    """
+    Remove everything from an email that does not help answer it.
+
+    Args:
+        text (str): The email as pasted by the user
+        token_budget (int): Maximum estimated tokens to keep (0 or None = no cap)
+
+    Returns:
+        tuple: (compacted text, report dict with token counts and the removed parts)
+    """
+    original_tokens = estimate_tokens(text)
+    compacted = text.replace("\r\n", "\n").replace("\r", "\n")
+    removed = []
+
+    for name, step in (
+        ('quoted_history', _cut_quoted_history),
+        ('quoted_lines', _drop_quoted_lines),
+        ('boilerplate', _drop_boilerplate),
+        ('signature', _cut_signature),
+    ):
+        compacted, changed = step(compacted)
+        if changed:
+            removed.append(name)
+
+    compacted = collapse_whitespace(compacted)
+    if not compacted:
+        # Never send an empty email; fall back to whitespace cleanup only
+        compacted = collapse_whitespace(text)
+        removed = []
+
+    if token_budget:
+        compacted, truncated = truncate_to_budget(compacted, token_budget)
+        if truncated:
+            removed.append('over_budget')
+
+    compacted_tokens = estimate_tokens(compacted)
+    return compacted, {
+        'original_tokens': original_tokens,
+        'compacted_tokens': compacted_tokens,
+        'tokens_saved': max(original_tokens - compacted_tokens, 0),
+        'removed': removed,
+    }
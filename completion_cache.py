@@ -0,0 +1,223 @@
+"""
+Cache for OpenAI chat completions.
+Completions are keyed on a canonical hash of the request payload (messages,
+model, temperature, token limit, ...). Entries live in an in-memory LRU with
+a TTL, backed by an optional SQLite file that all worker processes share.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Set COMPLETION_CACHE_ENABLED=0 to turn the cache off entirely
+CACHE_ENABLED = os.environ.get('COMPLETION_CACHE_ENABLED', '1') != '0'
+
+# In-memory tier settings
+CACHE_MAX_ENTRIES = int(os.environ.get('COMPLETION_CACHE_SIZE', 512))
+CACHE_TTL = int(os.environ.get('COMPLETION_CACHE_TTL', 3600))
+
+# Optional on-disk tier shared by all workers (disabled when not set)
+CACHE_DB_PATH = os.environ.get('COMPLETION_CACHE_DB')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS completions (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_completions_expires_at ON completions (expires_at);
+"""
+
+
+def _normalize_content(content):
+    """Normalize message text so insignificant whitespace does not change the key"""
+    if not isinstance(content, str):
+        return content
+    lines = content.replace("\r\n", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+def make_cache_key(payload):
+    """
+    Build a canonical hash for a chat completions payload.
+
+    Args:
+        payload (dict): The request payload (model, messages, temperature, ...)
+
+    Returns:
+        str: Hex digest identifying the request
+    """
+    canonical = {key: value for key, value in payload.items() if key not in ('stream', 'stream_options')}
+    canonical['messages'] = [
+        {'role': message.get('role'), 'content': _normalize_content(message.get('content'))}
+        for message in payload.get('messages', [])
+    ]
+    encoded = json.dumps(canonical, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+    """Two-tier (memory LRU + optional SQLite) cache with TTL expiry"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, db_path=CACHE_DB_PATH, enabled=CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._local = threading.local()
+        self._counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'bypassed': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _connect(self):
+        """Return this thread's connection to the disk tier, or None if disabled"""
+        if not self.db_path:
+            return None
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def note_bypass(self):
+        """Record a request that skipped the cache on purpose"""
+        self._count('bypassed')
+
+    def get(self, key):
+        """
+        Look up a cached completion.
+
+        Returns:
+            str or None: The cached completion text, or None on a miss
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._counters['memory_hits'] += 1
+                    return value
+                del self._entries[key]
+                self._counters['expirations'] += 1
+
+        value = self._disk_get(key, now)
+        if value is not None:
+            self._count('disk_hits')
+            self._memory_set(key, value, now + self.ttl)
+            return value
+
+        self._count('misses')
+        return None
+
+    def set(self, key, value):
+        """Store a completion in both tiers"""
+        if not self.enabled or not value:
+            return
+        expires_at = time.time() + self.ttl
+        self._memory_set(key, value, expires_at)
+        self._disk_set(key, value, expires_at)
+        self._count('stores')
+
+    async def aget(self, key):
+        """get() for the event loop: with a disk tier the lookup runs in a thread, as SQLite may wait for a lock"""
+        if self.enabled and self.db_path:
+            return await asyncio.to_thread(self.get, key)
+        return self.get(key)
+
+    async def aset(self, key, value):
+        """set() for the event loop (see aget)"""
+        if self.enabled and self.db_path:
+            await asyncio.to_thread(self.set, key, value)
+        else:
+            self.set(key, value)
+
+    def _memory_set(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            # Evict least recently used entries beyond the limit
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def _disk_get(self, key, now):
+        try:
+            conn = self._connect()
+            if conn is None:
+                return None
+            row = conn.execute(
+                "SELECT value FROM completions WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            # The disk tier is best effort; fall back to calling the API
+            logger.warning("Completion cache read failed", extra={'error': str(e)})
+            return None
+
+    def _disk_set(self, key, value, expires_at):
+        try:
+            conn = self._connect()
+            if conn is None:
+                return
+            conn.execute(
+                "INSERT OR REPLACE INTO completions (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at)
+            )
+            # Occasionally purge expired rows so the file does not grow forever
+            if random.random() < 0.01:
+                conn.execute("DELETE FROM completions WHERE expires_at <= ?", (time.time(),))
+        except sqlite3.Error as e:
+            logger.warning("Completion cache write failed", extra={'error': str(e)})
+
+    def stats(self):
+        """Return hit/miss counters and sizes as a dictionary"""
+        with self._lock:
+            counters = dict(self._counters)
+            size = len(self._entries)
+        hits = counters['memory_hits'] + counters['disk_hits']
+        lookups = hits + counters['misses']
+        return {
+            'enabled': self.enabled,
+            'memory_entries': size,
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl,
+            'disk_tier': bool(self.db_path),
+            **counters,
+            'hits': hits,
+            'hit_ratio': round(hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+# Cache shared by every call in this process
+completion_cache = CompletionCache()
@@ -1,31 +1,149 @@
 """
 This module provides a function to call the OpenAI API directly without the client library.
 It handles various model-specific parameter naming and constraints.
+Requests go through the shared pooled transport in transport.py.
 """
 import requests
 import json
+import logging
+import time
 
-def direct_openai_call(api_key, messages, model="gpt-4.1", temperature=0.7, max_tokens=1000, max_completion_tokens=None, reasoning_effort="medium"):
+from completion_cache import completion_cache, make_cache_key
+from observability import COMPLETION_WINDOW, OPENAI_SECONDS, record_first_token, record_span, record_usage
+from singleflight import CallCancelled, CallGuard, single_flight
+from transport import transport
+from usage_stats import usage_stats
+
+logger = logging.getLogger(__name__)
+
+# Statuses that may succeed on another model or a later attempt
+TRANSIENT_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+class OpenAIError(Exception):
+    """A failed API call; transient is True for timeouts, network errors and overload (429/5xx)"""
+
+    def __init__(self, message, status_code=None, transient=False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.transient = transient
+
+def _read_error_message(response):
+    """Extract the error message from a failed API response"""
+    try:
+        error_data = response.json()
+        return error_data.get('error', {}).get('message', 'Unknown error')
+    except json.JSONDecodeError:
+        return response.text or "Unknown error (no JSON response)"
+
+def _note_usage(model, usage, latency, streamed, on_usage):
+    """Record the usage block of a completion and pass it to the caller's callback"""
+    if not usage:
+        return
+    cost = record_usage(model, usage)
+    usage_stats.record(model, usage, latency, streamed=streamed, cost=cost)
+    cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+    logger.info("OpenAI usage", extra={
+        'model': model,
+        'prompt_tokens': usage.get('prompt_tokens'),
+        'cached_tokens': cached_tokens,
+        'completion_tokens': usage.get('completion_tokens'),
+        'cost_usd': round(cost, 6) if cost is not None else None,
+    })
+    if on_usage:
+        on_usage(usage)
+
+def _observe_call(model, started, stream, outcome):
+    """Record the duration of an API call as a histogram sample and an openai_call span"""
+    elapsed = time.perf_counter() - started
+    OPENAI_SECONDS.observe(elapsed, model=model, stream=str(stream).lower(), outcome=outcome)
+    record_span('openai_call', elapsed)
+    if not stream and outcome == "ok":
+        COMPLETION_WINDOW.add(model, elapsed)
+
+def parse_stream_line(line):
     """
-    Make a direct API call to OpenAI without using the client library.
-    
-    Args:
-        api_key (str): Your OpenAI API key
-        messages (list): The messages to send to the API
-        model (str): The model to use (default: gpt-4.1)
-        temperature (float): Controls randomness in responses (default: 0.7)
-        max_tokens (int): Maximum tokens in the response (default: 1000)
-        max_completion_tokens (int): Alternative parameter for reasoning models
-        reasoning_effort (str): Only for reasoning models - "low", "medium", or "high"
-    
+    Parse one line of a streamed (server-sent events) API response.
+
     Returns:
-        str: The model's response text
+        tuple: (done, event) - done is True for the final "[DONE]" line;
+               event is the decoded chunk, or None for lines without data
     """
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
-    
+    # Events are "data: {...}" lines separated by blank lines
+    if not line or not line.startswith("data:"):
+        return False, None
+    data = line[len("data:"):].strip()
+    if data == "[DONE]":
+        return True, None
+
+    try:
+        event = json.loads(data)
+    except json.JSONDecodeError:
+        raise Exception(f"Invalid JSON in OpenAI stream: {data}")
+    if event.get("error"):
+        raise Exception(f"Error in OpenAI stream: {event['error'].get('message', 'Unknown error')}")
+    return False, event
+
+def _iter_stream(response, cache_key=None, model=None, started=None, on_usage=None, guard=None):
+    """
+    Yield the content deltas of a streamed (server-sent events) API response.
+    The underlying connection is released when the generator finishes or is closed.
+    If a cache key is given, the full text is cached once the stream completes.
+    The usage block sent at the end of the stream is recorded with the time to first token.
+    The stream stops with CallCancelled once its guard has interrupted the call.
+    """
+    total_length = 0
+    parts = []
+    usage = None
+    first_token_latency = None
+    outcome = "error"
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            # Lines already buffered are still readable after the connection is shut down
+            if guard is not None:
+                guard.check()
+            done, event = parse_stream_line(line)
+            if done:
+                if cache_key:
+                    completion_cache.set(cache_key, "".join(parts))
+                _note_usage(model, usage, first_token_latency, True, on_usage)
+                outcome = "ok"
+                break
+            if event is None:
+                continue
+
+            # The last chunk (with no choices) carries the usage of the whole request
+            if event.get("usage"):
+                usage = event["usage"]
+
+            for choice in event.get("choices") or []:
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    if first_token_latency is None and started is not None:
+                        first_token_latency = time.perf_counter() - started
+                        record_first_token(model, first_token_latency)
+                    total_length += len(content)
+                    if cache_key:
+                        parts.append(content)
+                    yield content
+    except requests.exceptions.RequestException as e:
+        if guard is not None and guard.aborted:
+            outcome = "cancelled"
+            single_flight.count('cancelled_calls')
+            raise CallCancelled("Stream cancelled")
+        raise Exception(f"Network error while streaming from OpenAI API: {str(e)}")
+    except (GeneratorExit, CallCancelled):
+        # The client went away or every request reading the stream was cancelled
+        outcome = "cancelled"
+        single_flight.count('cancelled_calls')
+        raise
+    finally:
+        response.close()
+        if started is not None:
+            _observe_call(model, started, True, outcome)
+        logger.debug("Stream finished", extra={'model': model, 'chars': total_length, 'outcome': outcome})
+
+def build_payload(messages, model, temperature=0.7, max_tokens=1000, max_completion_tokens=None, reasoning_effort="medium"):
+    """Build the chat completions payload with the parameters the model accepts (see direct_openai_call)"""
     # Start building the payload with common parameters
     payload = {
         "model": model,
@@ -63,36 +181,122 @@ def direct_openai_call(api_key, messages, model="gpt-4.1", temperature=0.7, max_
     if supports_temperature:
         payload["temperature"] = temperature
     
-    # Print the API request (for debugging)
-    print(f"Sending API request to model: {model}")
-    print(f"Payload parameters: {', '.join(payload.keys())}")
+    return payload
+
+def direct_openai_call(api_key, messages, model="gpt-4.1", temperature=0.7, max_tokens=1000, max_completion_tokens=None, reasoning_effort="medium", stream=False, use_cache=True, on_usage=None, cancel=None):
+    """
+    Make a direct API call to OpenAI without using the client library.
     
-    # Make the API request
+    Args:
+        api_key (str): Your OpenAI API key
+        messages (list): The messages to send to the API
+        model (str): The model to use (default: gpt-4.1)
+        temperature (float): Controls randomness in responses (default: 0.7)
+        max_tokens (int): Maximum tokens in the response (default: 1000)
+        max_completion_tokens (int): Alternative parameter for reasoning models
+        reasoning_effort (str): Only for reasoning models - "low", "medium", or "high"
+        stream (bool): Stream the response instead of waiting for the full completion
+        use_cache (bool): Serve identical requests from the completion cache (default: True)
+        on_usage (callable): Called with the "usage" object of the response (not for cache hits
+                             or requests that shared an identical call already in progress)
+        cancel (CancelToken): The request's cancel token; the connection is shut down when it is
+                              cancelled (a call shared with other requests, once all are cancelled)
+    
+    Returns:
+        str: The model's response text, or when stream=True a generator
+             yielding the response text in chunks as they arrive
+    
+    Raises:
+        OpenAIError: If the call failed
+        CallCancelled: If the call was interrupted through cancel
+    """
+    payload = build_payload(messages, model, temperature, max_tokens, max_completion_tokens, reasoning_effort)
+    
+    # Identical requests are answered from the completion cache
+    cache_key = make_cache_key(payload) if use_cache else None
+    if cache_key:
+        cached = completion_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("Completion cache hit", extra={'model': model})
+            return iter([cached]) if stream else cached
+    else:
+        completion_cache.note_bypass()
+        guard = CallGuard()
+        guard.watch(cancel)
+        return _send_request(api_key, payload, stream, None, on_usage, guard)
+    
+    # Identical requests already in progress are shared instead of sent again
+    def send(guard):
+        return _send_request(api_key, payload, stream, cache_key, on_usage, guard)
+    if stream:
+        return single_flight.stream(cache_key, send, cancel)
+    return single_flight.call(cache_key, send, cancel)
+
+def _send_request(api_key, payload, stream, cache_key, on_usage, guard=None):
+    """Send a chat completions request (see direct_openai_call)"""
+    model = payload["model"]
+    headers = {
+        "Authorization": f"Bearer {api_key}"
+    }
+    payload = dict(payload)
+    
+    if stream:
+        payload["stream"] = True
+        # Ask for the usage block (incl. cached prompt tokens) at the end of the stream
+        payload["stream_options"] = {"include_usage": True}
+    
+    # Log the API request (for debugging)
+    logger.debug("Sending API request", extra={'model': model, 'parameters': ",".join(payload.keys())})
+    
+    # Make the API request (pooled connection, timeouts and retries on 429/5xx)
     try:
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
+        started = time.perf_counter()
+        response = transport.post(
+            "/chat/completions",
+            payload,
             headers=headers,
-            data=json.dumps(payload)
+            stream=stream,
+            guard=guard
         )
         
         # Handle error responses
         if response.status_code != 200:
-            try:
-                error_data = response.json()
-                error_message = error_data.get('error', {}).get('message', 'Unknown error')
-            except json.JSONDecodeError:
-                error_message = response.text or "Unknown error (no JSON response)"
-            
-            raise Exception(f"API request failed with status code {response.status_code}: {error_message}")
+            error_message = _read_error_message(response)
+            response.close()
+            _observe_call(model, started, stream, "error")
+            raise OpenAIError(f"API request failed with status code {response.status_code}: {error_message}",
+                              response.status_code, response.status_code in TRANSIENT_STATUSES)
+        
+        # The status is known at this point, so errors above surface before any chunk
+        if stream:
+            return _iter_stream(response, cache_key, model, started, on_usage, guard)
         
         # Parse and return the response
         result = response.json()
-        print(f"Response received. Content length: {len(result['choices'][0]['message']['content'])}")
-        return result["choices"][0]["message"]["content"]
+        content = result["choices"][0]["message"]["content"]
+        _observe_call(model, started, False, "ok")
+        logger.debug("Response received", extra={'model': model, 'chars': len(content)})
+        _note_usage(model, result.get("usage"), time.perf_counter() - started, False, on_usage)
+        if cache_key:
+            completion_cache.set(cache_key, content)
+        return content
     
+    except CallCancelled:
+        # Every request waiting for this completion was cancelled
+        _observe_call(model, started, stream, "cancelled")
+        single_flight.count('cancelled_calls')
+        raise
     except requests.exceptions.RequestException as e:
-        raise Exception(f"Network error when calling OpenAI API: {str(e)}")
+        if guard is not None and guard.aborted:
+            # The body was being read when the connection was shut down
+            _observe_call(model, started, stream, "cancelled")
+            single_flight.count('cancelled_calls')
+            raise CallCancelled("Call cancelled while reading the response")
+        _observe_call(model, started, stream, "error")
+        raise OpenAIError(f"Network error when calling OpenAI API: {str(e)}", transient=True)
     except json.JSONDecodeError:
-        raise Exception(f"Invalid JSON response from OpenAI API: {response.text}")
+        raise OpenAIError(f"Invalid JSON response from OpenAI API: {response.text}", transient=True)
+    except OpenAIError as e:
+        raise OpenAIError(f"Error calling OpenAI API: {str(e)}", e.status_code, e.transient)
     except Exception as e:
-        raise Exception(f"Error calling OpenAI API: {str(e)}")
\ No newline at end of file
+        raise OpenAIError(f"Error calling OpenAI API: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,87 @@
+"""
+Server-side draft sessions.
+A draft keeps the exact messages that produced a response, so a revision only
+needs the modification request from the client. Each revision appends to the
+stored conversation, which keeps the system prompt, template and customer
+email a byte-identical prefix that OpenAI's prompt cache can reuse.
+"""
+
+import json
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from models import db, Draft
+
+# Drafts not revised for this many days are deleted
+DRAFT_TTL_DAYS = int(os.environ.get('DRAFT_TTL_DAYS', 7))
+
+
+def load_draft(draft_id):
+    """Return the draft with this id, or None if it does not exist or has expired"""
+    draft = db.session.get(Draft, str(draft_id))
+    if draft is None:
+        return None
+    if draft.updated_at < datetime.utcnow() - timedelta(days=DRAFT_TTL_DAYS):
+        return None
+    return draft
+
+
+def revision_messages(draft, modification_message, edited_response=None):
+    """
+    Build the messages for the next revision of a draft.
+
+    Args:
+        draft (Draft): The draft to revise
+        modification_message (dict): The user message asking for the change
+        edited_response (str): The response as currently shown to the user, if
+            they edited it by hand; it replaces the stored one
+
+    Returns:
+        list: Stored conversation plus the modification request
+    """
+    messages = json.loads(draft.messages)
+    if edited_response and messages and messages[-1]['role'] == 'assistant':
+        if edited_response.strip() != messages[-1]['content'].strip():
+            messages[-1] = {'role': 'assistant', 'content': edited_response}
+    messages.append(modification_message)
+    return messages
+
+
+def save_draft(draft, mode, model, messages, response, usage=None):
+    """
+    Store the conversation that produced a response.
+
+    Args:
+        draft (Draft): The draft that was revised, or None to start a new one
+        mode (str): Model or hybrid mode selected by the user
+        model (str): Model that wrote the response
+        messages (list): Messages sent for the response
+        response (str): The response shown to the user
+        usage (dict): Prompt and cached token counts of the call, if known
+
+    Returns:
+        str: The draft id
+    """
+    conversation = json.dumps(messages + [{'role': 'assistant', 'content': response}])
+    if draft is None:
+        purge_expired_drafts()
+        draft = Draft(id=uuid.uuid4().hex, mode=mode, model=model, messages=conversation,
+                      revisions=0, prompt_tokens=0, cached_tokens=0)
+        db.session.add(draft)
+    else:
+        draft.revisions += 1
+        draft.model = model
+        draft.messages = conversation
+        draft.updated_at = datetime.utcnow()
+    if usage:
+        draft.prompt_tokens += usage.get('prompt_tokens') or 0
+        draft.cached_tokens += usage.get('cached_tokens') or 0
+    db.session.commit()
+    return draft.id
+
+
+def purge_expired_drafts():
+    """Delete drafts that have not been revised within DRAFT_TTL_DAYS (in the current session)"""
+    cutoff = datetime.utcnow() - timedelta(days=DRAFT_TTL_DAYS)
+    Draft.query.filter(Draft.updated_at < cutoff).delete(synchronize_session=False)
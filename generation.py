@@ -0,0 +1,626 @@
+"""
+Email response generation for the AI Email Response Assistant.
+This module compacts the customer email, builds the prompt messages, runs the
+generation pipeline for the selected mode (a single call, or a multi-stage
+hybrid mode such as technical) and cleans up the result. It is shared by the blocking
+and the streaming generation endpoints.
+"""
+
+import asyncio
+import logging
+
+from cleaner import StreamCleaner, clean_response
+from compaction import COMPACTION_ENABLED, COMPACTION_TOKEN_BUDGET, compact_email
+from drafts import load_draft, revision_messages, save_draft
+from models import db, Template
+from observability import span
+from pipeline import PIPELINES_FILE, Pipeline, Stage, load_pipelines
+from replies import find_reusable_reply, record_reply_use, save_reply
+from singleflight import CallCancelled
+
+logger = logging.getLogger(__name__)
+
+# System prompt for the AI (instructions on how to respond)
+SYSTEM_PROMPT = """
+You are a helpful customer service assistant for a peptide distribution company.
+Our company sells lab-grade peptides strictly for research purposes. We are NOT medical professionals.
+You MUST NOT provide any dosage information, medical advice, or suggestions for human/animal consumption or use. If asked directly about these topics, politely state that you cannot provide that type of information, and pivot to offering allowed information like product specifications (purity, sequence if available), storage guidelines, or order/shipping status if relevant to the query.
+Your tone should be professional, helpful, and polite.
+Do not explicitly state *why* you cannot provide medical advice (e.g., don't say 'Due to regulations...' or 'We cannot legally...'). Simply decline to provide the restricted information politely as described above.
+Focus on answering the customer's query accurately within the allowed boundaries (e.g., product information, availability, purity, storage, order status, general research context where appropriate).
+
+IMPORTANT FORMATTING INSTRUCTION: Do not use em dash characters (—) in your response. Use hyphens (-) sparingly or other appropriate punctuation instead.
+"""
+
+REFINING_PROMPT = """
+You are a customer service language expert for a peptide distribution company.
+Your task is to reword technical responses to make them more customer-friendly while preserving the technical accuracy.
+Keep the same information but make the tone warmer, more approachable, and easier to understand.
+Maintain all the technical information and policies mentioned in the original response.
+Remember that we sell lab-grade peptides strictly for research purposes and are NOT medical professionals.
+We cannot provide dosage information, medical advice, or suggestions for human/animal consumption or use.
+
+IMPORTANT: Provide ONLY the final reworded response with no introductory text like "Here's a reworded version" or "Certainly!"
+Do not include any meta-commentary or prefatory remarks. Start directly with the customer service response.
+
+IMPORTANT FORMATTING INSTRUCTION: Do not use em dash characters (—) in your response. Use hyphens (-) sparingly or other appropriate punctuation instead.
+"""
+
+# Models used by the technical hybrid mode
+TECHNICAL_FIRST_MODEL = 'o4-mini'  # Use correct model name without gpt- prefix
+TECHNICAL_SECOND_MODEL = 'gpt-4.1'
+
+
+class GenerationError(Exception):
+    """Error raised for invalid generation requests, carrying an HTTP status code"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def parse_generation_request(data):
+    """
+    Extract and validate the generation parameters from a request body.
+
+    Args:
+        data (dict): JSON body posted by the client
+
+    Returns:
+        dict: Normalized generation parameters
+
+    Raises:
+        GenerationError: If the request is invalid
+    """
+    if not data:
+        raise GenerationError("Request body must be JSON")
+
+    params = {
+        'customer_email': data.get('customer_email', ''),
+        'previous_response': data.get('previous_response', ''),  # Will be empty for initial request
+        'modification_request': data.get('modification_request', ''),  # Will be empty for initial request
+        'template_id': data.get('template_id'),  # Optional template ID
+        'customer_notes': data.get('customer_notes', ''),  # Get the customer notes
+        'model': data.get('model', 'gpt-4.1'),  # Default to gpt-4.1 if not specified
+        'bypass_cache': bool(data.get('bypass_cache', False)),  # Force a fresh completion
+        'keep_original': bool(data.get('keep_original', False)),  # Skip email compaction
+        'draft_id': data.get('draft_id'),  # Draft session to revise
+        'regenerate': bool(data.get('regenerate', False)),  # Generate even if an approved reply matches
+    }
+
+    try:
+        params['token_limit'] = int(data.get('token_limit', 1000))  # Default to 1000 if not specified
+    except (TypeError, ValueError):
+        raise GenerationError("token_limit must be an integer")
+
+    try:
+        params['input_token_budget'] = int(data.get('input_token_budget') or COMPACTION_TOKEN_BUDGET)
+    except (TypeError, ValueError):
+        raise GenerationError("input_token_budget must be an integer")
+
+    # Optional time to wait for a first token before a faster model is also asked (see hedging.py)
+    try:
+        budget_ms = data.get('latency_budget_ms')
+        params['latency_budget'] = float(budget_ms) / 1000.0 if budget_ms is not None else None
+    except (TypeError, ValueError):
+        raise GenerationError("latency_budget_ms must be a number")
+    if params['latency_budget'] is not None and params['latency_budget'] <= 0:
+        raise GenerationError("latency_budget_ms must be positive")
+
+    # Log the received parameters
+    logger.debug("Generation request", extra={'model': params['model'], 'token_limit': params['token_limit']})
+
+    params['requested_token_limit'] = params['token_limit']
+    select_pipeline(params)
+
+    if params['draft_id']:
+        # A revision only needs the change; the email and response are stored in the draft
+        if not params['modification_request']:
+            raise GenerationError("modification_request is required to revise a draft")
+    elif not params['customer_email']:
+        # Validate customer email is provided
+        raise GenerationError("Customer email is required")
+
+    return params
+
+
+def select_pipeline(params):
+    """
+    Set params['pipeline'] and the token limit for params['model'].
+
+    Called again when a draft revision switches to the draft's model, so the
+    limit always follows the model that actually runs.
+
+    Returns:
+        Pipeline: The pipeline for the model
+    """
+    # Hybrid modes (e.g. technical) are pipelines selected through the model field
+    pipeline = get_pipeline(params['model'])
+    params['pipeline'] = pipeline.name
+    params['token_limit'] = params['requested_token_limit']
+    if pipeline.min_token_limit:
+        # Ensure a higher token limit for multi-stage modes
+        params['token_limit'] = max(params['token_limit'], pipeline.min_token_limit)
+        models = " -> ".join(stage.model or params['model'] for stage in pipeline.stages)
+        logger.debug("Hybrid mode enabled", extra={'pipeline': pipeline.name, 'models': models})
+    return pipeline
+
+
+def compact_input(params):
+    """
+    Compact the customer email before the messages are built.
+
+    Replaces params['customer_email'] with the compacted text and stores the
+    report (tokens saved, parts removed) in params['compaction'].
+
+    Returns:
+        dict or None: The compaction report, or None if the original is kept
+    """
+    params['compaction'] = None
+    if params['keep_original'] or not COMPACTION_ENABLED:
+        return None
+
+    with span('compaction'):
+        compacted, report = compact_email(params['customer_email'], params['input_token_budget'])
+    params['customer_email'] = compacted
+    params['compaction'] = report
+    logger.debug("Email compacted", extra={'original_tokens': report['original_tokens'],
+                                           'compacted_tokens': report['compacted_tokens'],
+                                           'removed': ",".join(report['removed']) or "nothing"})
+    return report
+
+
+def get_template_content(template_id):
+    """Return the content of a template, or an empty string if it cannot be loaded"""
+    if not template_id:
+        return ""
+    try:
+        with span('template_lookup'):
+            template = Template.query.get(template_id)
+        if template:
+            return template.content
+    except Exception as e:
+        logger.warning("Error retrieving template", extra={'template_id': template_id, 'error': str(e)})
+        # Continue without the template
+    return ""
+
+
+def build_messages(params, template_content=""):
+    """
+    Construct the messages for the API call.
+
+    The system prompt, template and customer email come first and are laid out
+    the same way for an initial request and a modification, so they form an
+    identical prefix that OpenAI's prompt cache can reuse.
+
+    Args:
+        params (dict): Parameters from parse_generation_request
+        template_content (str): Optional template to use as a starting point
+
+    Returns:
+        list: Chat messages
+    """
+    # Initialize messages list with the system prompt
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT}
+    ]
+
+    # Template first: it is shared by every email answered with it
+    user_content = ""
+    if template_content:
+        user_content += f"Please use the following template as a starting point for your response:\n\n---TEMPLATE START---\n{template_content}\n---TEMPLATE END---\n\n"
+
+    user_content += f"Customer Email:\n{params['customer_email']}\n\n"
+
+    if params['customer_notes']:
+        user_content += f"IMPORTANT NOTES: {params['customer_notes']}\n\n"
+
+    user_content += "Draft a suitable response:"
+
+    messages.append({
+        "role": "user",
+        "content": user_content
+    })
+
+    if params['previous_response']:
+        # Modification request: the previous response and the change follow the same prefix
+        messages.extend([
+            {"role": "assistant", "content": params['previous_response']},
+            modification_message(params['modification_request'])
+        ])
+
+    return messages
+
+
+def modification_message(modification_request):
+    """Build the user message asking for a change to the previous response"""
+    return {"role": "user", "content": f"Please modify the above response based on this request: {modification_request}"}
+
+
+def build_refining_messages(first_response):
+    """Build the messages for the second (refining) step of technical mode"""
+    return [
+        {"role": "system", "content": REFINING_PROMPT},
+        {"role": "user", "content": f"Here is a technical response to a customer email:\n\n{first_response}\n\nReword this to be more customer-friendly while maintaining all the technical information. Start directly with the reworded response without any introduction or prefatory text."}
+    ]
+
+
+# Prompt builders for pipeline stages: (params, template_content, upstream) -> messages
+
+def respond_messages(params, template_content, upstream):
+    """Answer the customer email (the standard prompt)"""
+    return build_messages(params, template_content)
+
+
+def refine_messages(params, template_content, upstream):
+    """Reword the previous stage's output; a modification is applied to the refined text"""
+    messages = build_refining_messages(upstream)
+    if params['previous_response']:
+        messages.extend([
+            {"role": "assistant", "content": params['previous_response']},
+            modification_message(params['modification_request'])
+        ])
+    return messages
+
+
+PROMPT_BUILDERS = {
+    'respond': respond_messages,
+    'refine': refine_messages,
+}
+
+# Single call with the model selected in the request
+STANDARD_PIPELINE = Pipeline('standard', [Stage('respond', respond_messages)])
+
+# Hybrid modes, selected by sending their name as the model
+PIPELINES = {
+    'technical': Pipeline('technical', [
+        Stage('draft', respond_messages, model=TECHNICAL_FIRST_MODEL, token_share=0.5,
+              label='Drafting technical response'),
+        Stage('refine', refine_messages, model=TECHNICAL_SECOND_MODEL, token_share=0.5,
+              label='Refining response'),
+    ], min_token_limit=2000),
+}
+
+if PIPELINES_FILE:
+    PIPELINES.update(load_pipelines(PIPELINES_FILE, PROMPT_BUILDERS))
+
+
+def get_pipeline(model):
+    """Return the pipeline for a mode name, or the standard pipeline for a plain model"""
+    return PIPELINES.get(model, STANDARD_PIPELINE)
+
+
+def resolve_draft(params):
+    """
+    Load the draft a request revises (once) and store it in params['draft'].
+
+    Returns:
+        Draft or None: The draft, or None for a request without draft_id
+
+    Raises:
+        GenerationError: If the draft does not exist or has expired
+    """
+    params.setdefault('draft', None)
+    if params['draft'] is None and params['draft_id']:
+        params['draft'] = load_draft(params['draft_id'])
+        if params['draft'] is None:
+            raise GenerationError("Draft not found or expired", 404)
+    return params['draft']
+
+
+def _prepare_pipeline(params):
+    """
+    Compact the input and load the template, or load the draft being revised.
+
+    Returns:
+        tuple: (pipeline, template_content, messages), where messages are the
+               prebuilt messages of a draft revision (None otherwise)
+    """
+    params['stages'] = None
+    params['prompt'] = None
+    draft = resolve_draft(params)
+    messages = None
+    if draft is not None:
+        params['compaction'] = None
+        params['model'] = draft.mode
+        select_pipeline(params)
+        with span('prompt_build'):
+            messages = revision_messages(draft, modification_message(params['modification_request']),
+                                         params['previous_response'])
+        template_content = ""
+    else:
+        compact_input(params)
+        template_content = get_template_content(params['template_id'])
+    return get_pipeline(params['model']), template_content, messages
+
+
+def _capture(params, event, data):
+    """Keep the final prompt and stage timings of a run; returns True for events not passed on"""
+    if event == "timings":
+        params['stages'] = data['stages']
+    elif event == "prompt":
+        params['prompt'] = data
+    else:
+        return False
+    return True
+
+
+def check_cancelled(params):
+    """
+    Stop a request whose cancel token (params['cancel'], optional) was cancelled.
+
+    Raises:
+        GenerationError: With status 409 if the request was cancelled
+    """
+    token = params.get('cancel')
+    if token is not None and token.cancelled:
+        raise GenerationError(f"Request cancelled: {token.reason}", 409)
+
+
+def _run_pipeline(api_key, params, stream):
+    """
+    Compact the input, then run the request's pipeline (yields pipeline events).
+
+    A request with a draft_id revises the stored conversation instead; only
+    the final stage runs. The final prompt and its usage are stored in
+    params['prompt'] and params['stages'] for save_draft. A cancelled request
+    stops at the next event, and an API call it is waiting for is interrupted
+    (see singleflight.CallGuard); closing the pipeline closes its API stream.
+    """
+    pipeline, template_content, messages = _prepare_pipeline(params)
+    events = pipeline.run(api_key, params, template_content, stream=stream, messages=messages)
+    try:
+        for event, data in events:
+            check_cancelled(params)
+            if not _capture(params, event, data):
+                yield event, data
+    except CallCancelled:
+        # Only raised once this request's own token was cancelled
+        check_cancelled(params)
+        raise
+    finally:
+        events.close()
+
+
+def reuse_reply(params):
+    """
+    Look up an approved reply to a near-duplicate email before generating (see replies.py).
+
+    Sets params['reused'] to the reply id, similarity and approval time of a
+    match (None otherwise) and params['reply_id'] to the reply's id.
+
+    Returns:
+        str or None: The approved reply, or None if a response has to be generated
+    """
+    params['reused'] = None
+    params['reply_id'] = None
+    try:
+        with span('reply_lookup'):
+            match = find_reusable_reply(params)
+        if match is not None:
+            record_reply_use(match['reply_id'])
+    except Exception as e:
+        # A response can always be generated instead
+        db.session.rollback()
+        logger.error("Error looking up stored replies", extra={'error': str(e)})
+        return None
+    if match is None:
+        return None
+    params.update(compaction=None, stages=None, prompt=None, draft_id=None, reply_id=match['reply_id'])
+    params['reused'] = {key: match[key] for key in ('reply_id', 'similarity', 'distance', 'approved_at')}
+    return match['response']
+
+
+def generation_result(params, ai_response):
+    """Return the JSON body of a finished generation (also the data of the stream's "done" event)"""
+    # The model that wrote the response: a hedged stage may have been answered by its fallback model
+    final_stage = params['stages'][-1] if params['stages'] else {}
+    return {"response": ai_response, "compaction": params['compaction'], "stages": params['stages'],
+            "answered_by": final_stage.get('answered_by'),
+            "draft_id": params['draft_id'], "reply_id": params['reply_id'], "reused": params['reused']}
+
+
+def _save_draft(params, ai_response):
+    """Store the conversation of a response as a draft; returns the draft id or None"""
+    if not params['prompt']:
+        return None
+    final_stage = params['stages'][-1] if params['stages'] else {}
+    try:
+        with span('draft_save'):
+            return save_draft(params['draft'], params['model'], params['prompt']['model'],
+                              params['prompt']['messages'], ai_response, final_stage)
+    except Exception as e:
+        # The response is still returned; it just cannot be revised by draft id
+        db.session.rollback()
+        logger.error("Error saving draft", extra={'error': str(e)})
+        return None
+
+
+def _save_reply(params, ai_response):
+    """Store a response as a draft reply an agent can approve; returns the reply id or None"""
+    try:
+        with span('reply_save'):
+            return save_reply(params, ai_response)
+    except Exception as e:
+        db.session.rollback()
+        logger.error("Error saving reply", extra={'error': str(e)})
+        return None
+
+
+def generate(api_key, params, keep_draft=True):
+    """
+    Generate a complete response and clean it up.
+
+    An approved reply to a near-duplicate email is returned instead if there
+    is one (see reuse_reply). The compaction report, per-stage timings, the
+    draft id and the reply id are stored in params['compaction'],
+    params['stages'], params['draft_id'] and params['reply_id'].
+
+    Args:
+        api_key (str): OpenAI API key
+        params (dict): Parameters from parse_generation_request
+        keep_draft (bool): Store a draft session so the response can be revised by id,
+            and a draft reply so it can be approved
+
+    Returns:
+        str: The cleaned AI response
+
+    Raises:
+        GenerationError: If the request was cancelled (see check_cancelled)
+    """
+    ai_response = reuse_reply(params)
+    if ai_response is not None:
+        return ai_response
+
+    parts = [data['content'] for event, data in _run_pipeline(api_key, params, stream=False) if event == "delta"]
+    ai_response = "".join(parts)
+
+    # Clean up the response to remove any prefatory text
+    original_length = len(ai_response)
+    with span('cleanup'):
+        ai_response = clean_response(ai_response)
+    logger.debug("Response cleaned", extra={'original_chars': original_length, 'chars': len(ai_response)})
+
+    check_cancelled(params)
+    params['draft_id'] = _save_draft(params, ai_response) if keep_draft else None
+    params['reply_id'] = _save_reply(params, ai_response) if keep_draft else None
+    return ai_response
+
+
+def generate_stream(api_key, params):
+    """
+    Generate a response incrementally.
+
+    Yields (event, data) tuples:
+        ("stage", {...})    when a stage of a multi-stage mode starts
+        ("delta", {...})    for every chunk of cleaned text received from the API
+        ("done", {...})     with the final cleaned response, the compaction
+                            report, the per-stage timings, the draft id and the
+                            reply id (see generation_result)
+
+    A reused reply (see reuse_reply) is sent as a single "done" event.
+
+    Args:
+        api_key (str): OpenAI API key
+        params (dict): Parameters from parse_generation_request
+    """
+    ai_response = reuse_reply(params)
+    if ai_response is not None:
+        yield "done", generation_result(params, ai_response)
+        return
+
+    parts = []
+    cleaner = StreamCleaner()
+    for event, data in _run_pipeline(api_key, params, stream=True):
+        if event == "delta":
+            # Prefatory text and em dashes are removed before the chunk is shown
+            parts.append(data['content'])
+            content = cleaner.feed(data['content'])
+            if content:
+                yield "delta", {"content": content}
+            continue
+        yield event, data
+
+    content = cleaner.finish()
+    if content:
+        yield "delta", {"content": content}
+
+    # The complete response is cleaned once more, in case an opener was too long to hold back
+    with span('cleanup'):
+        ai_response = clean_response("".join(parts))
+    check_cancelled(params)
+    params['draft_id'] = _save_draft(params, ai_response)
+    params['reply_id'] = _save_reply(params, ai_response)
+    yield "done", generation_result(params, ai_response)
+
+
+# Async variants for the ASGI server (asgi.py). Database work runs in a thread
+# with its own app context, so the event loop only waits on the API.
+
+async def _in_app_context(app, function, *args):
+    """Run blocking database work in a worker thread inside an app context"""
+    def call():
+        with app.app_context():
+            return function(*args)
+    return await asyncio.to_thread(call)
+
+
+async def _arun_pipeline(app, api_key, params, stream):
+    """Async version of _run_pipeline"""
+    pipeline, template_content, messages = await _in_app_context(app, _prepare_pipeline, params)
+    events = pipeline.arun(api_key, params, template_content, stream=stream, messages=messages)
+    try:
+        async for event, data in events:
+            check_cancelled(params)
+            if not _capture(params, event, data):
+                yield event, data
+    finally:
+        await events.aclose()
+
+
+async def _asave_draft(app, params, ai_response):
+    """Async version of _save_draft followed by _save_reply; returns the draft id"""
+    def save():
+        # The draft was loaded in another app context; load it again in this one
+        params['draft'] = load_draft(params['draft_id']) if params['draft_id'] else None
+        params['draft_id'] = _save_draft(params, ai_response)
+        params['reply_id'] = _save_reply(params, ai_response)
+        return params['draft_id']
+    return await _in_app_context(app, save)
+
+
+async def agenerate(app, api_key, params, keep_draft=True):
+    """
+    Async version of generate.
+
+    Args:
+        app (Flask): Application whose database the draft and template live in
+        api_key (str): OpenAI API key
+        params (dict): Parameters from parse_generation_request
+        keep_draft (bool): Store a draft session and a draft reply (as for generate)
+
+    Returns:
+        str: The cleaned AI response
+    """
+    ai_response = await _in_app_context(app, reuse_reply, params)
+    if ai_response is not None:
+        return ai_response
+
+    parts = [data['content'] async for event, data in _arun_pipeline(app, api_key, params, stream=False)
+             if event == "delta"]
+    with span('cleanup'):
+        ai_response = clean_response("".join(parts))
+
+    check_cancelled(params)
+    params['draft_id'] = await _asave_draft(app, params, ai_response) if keep_draft else None
+    return ai_response
+
+
+async def agenerate_stream(app, api_key, params):
+    """Async version of generate_stream (same events); app is as for agenerate"""
+    ai_response = await _in_app_context(app, reuse_reply, params)
+    if ai_response is not None:
+        yield "done", generation_result(params, ai_response)
+        return
+
+    parts = []
+    cleaner = StreamCleaner()
+    async for event, data in _arun_pipeline(app, api_key, params, stream=True):
+        if event == "delta":
+            parts.append(data['content'])
+            content = cleaner.feed(data['content'])
+            if content:
+                yield "delta", {"content": content}
+            continue
+        yield event, data
+
+    content = cleaner.finish()
+    if content:
+        yield "delta", {"content": content}
+
+    with span('cleanup'):
+        ai_response = clean_response("".join(parts))
+    check_cancelled(params)
+    await _asave_draft(app, params, ai_response)
+    yield "done", generation_result(params, ai_response)
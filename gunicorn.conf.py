@@ -0,0 +1,32 @@
+"""
+Gunicorn settings, read automatically by "gunicorn app:app".
+The app is imported once in the master (preload_app), which also migrates the
+schema, hashes the password and loads the template suggestion index before
+forking; workers start with all of it already in memory (shared copy-on-write)
+and are ready as soon as they are forked. Set GUNICORN_PRELOAD=0 to import the
+app in every worker instead, e.g. to pick up code changes with a HUP reload.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = 120
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+
+def when_ready(server):
+    # Runs in the master before the first workers are forked
+    if preload_app:
+        import app
+        app.preload()
+
+
+def post_fork(server, worker):
+    # Sockets opened by the master must not be shared between processes
+    if preload_app:
+        import app
+        app.after_fork()
@@ -0,0 +1,412 @@
+"""
+Hedged OpenAI calls with a faster fallback model.
+Hedging is opt-in per model: only models listed in HEDGE_MODELS have a
+fallback. If a call to one of them has not produced its first token (or,
+for a blocking call, its response) after the model's recent
+HEDGE_PERCENTILE latency (or the request's latency budget, if that is
+shorter), the same messages go to the fallback model as well; whichever
+call answers first is used and the other one is closed. A call that fails
+with a timeout, a network error or an overload status (429/5xx, after the
+transport's retries) goes to the fallback model straight away; any other
+error is raised. The model that answered is returned with the result.
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+from direct_api import OpenAIError, direct_openai_call
+from observability import COMPLETION_WINDOW, FIRST_TOKEN_WINDOW
+from singleflight import CancelToken
+
+logger = logging.getLogger(__name__)
+
+HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', '1') != '0'
+
+# Fallback model per model, e.g. '{"gpt-4.1": "gpt-4.1-mini"}'. Empty by default: a fallback
+# answers with a different (usually weaker) model, so each model has to opt in
+HEDGE_MODELS = json.loads(os.environ.get('HEDGE_MODELS') or '{}')
+
+# A hedge goes out once the first token (or blocking response) is later than this percentile of recent calls
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 95))
+
+# Calls to a model needed before its percentile is used; HEDGE_DEFAULT_DELAY applies until then
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', 20))
+HEDGE_DEFAULT_DELAY = float(os.environ.get('HEDGE_DEFAULT_DELAY', 15))
+
+# Never hedge sooner than this (unless the request's budget is shorter), so fast models are not doubled
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 1))
+
+_stats_lock = threading.Lock()
+_stats = {
+    'calls': 0,
+    'hedged': 0,
+    'hedge_won': 0,
+    'primary_won': 0,
+    'fallbacks': 0,
+    'saved_seconds': 0.0,
+}
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def fallback_model(model):
+    """Return the model that hedges calls to model, or None"""
+    if not HEDGE_ENABLED:
+        return None
+    fallback = HEDGE_MODELS.get(model)
+    return fallback if fallback and fallback != model else None
+
+
+def _window(stream):
+    # A blocking call's latency is that of its whole response, so it is compared with those
+    return FIRST_TOKEN_WINDOW if stream else COMPLETION_WINDOW
+
+
+def hedge_delay(model, latency_budget=None, stream=True):
+    """
+    Seconds to wait for the first token (stream) or response (blocking call) of model before sending a hedge.
+
+    Args:
+        model (str): Model of the primary call
+        latency_budget (float): The request's own limit in seconds, if any
+        stream (bool): Whether the call is streamed
+    """
+    percentile = _window(stream).percentile(model, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+    delay = max(percentile, HEDGE_MIN_DELAY) if percentile is not None else HEDGE_DEFAULT_DELAY
+    if latency_budget is not None:
+        delay = min(delay, latency_budget)
+    return delay
+
+
+def estimate_saved(model, waited, stream=True):
+    """
+    Estimate how much longer the primary call would have taken to answer.
+
+    Uses the mean of the model's recent latencies (first token or whole
+    response, as for hedge_delay) longer than the time already waited; None
+    when there are none to go by.
+    """
+    longer = [value for value in _window(stream).values(model) if value > waited]
+    if not longer:
+        return None
+    return sum(longer) / len(longer) - waited
+
+
+def _close(stream):
+    # Cached completions come back as plain iterators
+    if hasattr(stream, 'close'):
+        stream.close()
+
+
+def _is_transient(error):
+    return isinstance(error, OpenAIError) and error.transient
+
+
+def _answer(model, primary, winner, reason, waited, stream):
+    """Describe who answered a hedged call and count the outcome"""
+    answer = {'model': winner.model}
+    if reason is None:
+        return answer
+    answer['hedge'] = reason
+    if reason == 'error':
+        _count('fallbacks')
+        return answer
+    if winner is primary:
+        _count('primary_won')
+        return answer
+    _count('hedge_won')
+    saved = estimate_saved(model, waited, stream)
+    if saved is not None:
+        _count('saved_seconds', saved)
+        answer['hedge_saved_ms'] = round(saved * 1000, 1)
+    return answer
+
+
+def _log_hedge(model, fallback, reason, delay):
+    logger.info("Hedging OpenAI call", extra={'model': model, 'fallback_model': fallback,
+                                              'reason': reason, 'delay_ms': round(delay * 1000, 1)})
+
+
+class _Attempt:
+    """
+    One call of a hedged request, run in its own thread until it answers.
+
+    A stream answers with its first chunk, a blocking call with its whole
+    response. Each attempt has its own cancel token, which the request's
+    token cancels too, so a losing call can be stopped on its own.
+    """
+
+    def __init__(self, model, call, stream, cancel):
+        self.model = model
+        self.streamed = stream
+        self.stream = None
+        self.started = time.perf_counter()
+        self.future = Future()
+        self.token = CancelToken()
+        self._abandoned = False
+        self._lock = threading.Lock()
+        if cancel is not None:
+            cancel.add_callback(lambda: self.token.cancel(cancel.reason))
+        # Copy the context so the call's spans are part of the request's trace
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._run, call, stream),
+                         name=f"hedge-{model}", daemon=True).start()
+
+    def _run(self, call, stream):
+        try:
+            result = call(self.model, self.token)
+        except BaseException as e:
+            self.future.set_exception(e)
+            return
+        if not stream:
+            self.future.set_result(result)
+            return
+        try:
+            first = next(result, None)
+        except BaseException as e:
+            _close(result)
+            self.future.set_exception(e)
+            return
+        with self._lock:
+            abandoned = self._abandoned
+            if not abandoned:
+                self.stream = result
+        if abandoned:
+            _close(result)
+            return
+        self.future.set_result(first)
+
+    def abandon(self):
+        """Stop this call, whether it is still waiting for the API or already streaming"""
+        if not self.future.done():
+            # The abandoned call never answered; count the time it waited, as ahedged_call does,
+            # so the window does not only hold the calls that won
+            _window(self.streamed).add(self.model, time.perf_counter() - self.started)
+        with self._lock:
+            self._abandoned = True
+            stream, self.stream = self.stream, None
+        if stream is not None:
+            _close(stream)
+        # Shuts down the connection of a call still waiting (see singleflight.CallGuard)
+        self.token.cancel("the other call of a hedged request answered first")
+
+
+def _race(primary, hedge):
+    """
+    Wait for the first attempt to answer and return it.
+
+    A transient error of one attempt leaves the other one to answer; any
+    other error of the primary call (authentication, bad request, content
+    filter) is raised even if the hedge could still answer.
+    """
+    pending = [attempt for attempt in (primary, hedge) if attempt is not None]
+    errors = {}
+    while pending:
+        wait([attempt.future for attempt in pending], return_when=FIRST_COMPLETED)
+        for attempt in list(pending):
+            if not attempt.future.done():
+                continue
+            pending.remove(attempt)
+            error = attempt.future.exception()
+            if error is None or (attempt is primary and not _is_transient(error)):
+                for other in pending:
+                    other.abandon()
+                if error is not None:
+                    raise error
+                return attempt
+            errors[attempt] = error
+    raise errors.get(primary) or errors[hedge]
+
+
+def _rest(first, stream):
+    """Yield the first chunk, then the rest of the stream"""
+    try:
+        if first:
+            yield first
+        yield from stream
+    finally:
+        _close(stream)
+
+
+def hedged_call(api_key, messages, model, max_tokens, stream=False, use_cache=True, on_usage=None,
+                latency_budget=None, cancel=None):
+    """
+    Call the API, hedged with the model's fallback model (see the module docstring).
+
+    Args:
+        api_key, messages, model, max_tokens, stream, use_cache, on_usage, cancel: As for direct_openai_call
+        latency_budget (float): Seconds the request is willing to wait for a first token
+            (or a blocking response) before hedging (None = the model's percentile only)
+
+    Returns:
+        tuple: (result, answer) - result as from direct_openai_call; answer is
+               {"model": model that answered} plus, if a hedge or fallback was
+               sent, "hedge" ("slow" or "error") and "hedge_saved_ms" (estimated)
+    """
+    fallback = fallback_model(model)
+    if fallback is None:
+        return direct_openai_call(api_key=api_key, messages=messages, model=model, max_tokens=max_tokens,
+                                  stream=stream, use_cache=use_cache, on_usage=on_usage,
+                                  cancel=cancel), {'model': model}
+
+    def call(attempt_model, token):
+        # The caller's call type is kept: a blocking caller gets blocking calls
+        return direct_openai_call(api_key=api_key, messages=messages, model=attempt_model, max_tokens=max_tokens,
+                                  stream=stream, use_cache=use_cache, on_usage=on_usage, cancel=token)
+
+    _count('calls')
+    delay = hedge_delay(model, latency_budget, stream)
+    primary = _Attempt(model, call, stream, cancel)
+    hedge = None
+    reason = None
+    wait([primary.future], timeout=delay)
+    if not primary.future.done():
+        reason = 'slow'
+    elif primary.future.exception() is not None:
+        if not _is_transient(primary.future.exception()):
+            raise primary.future.exception()
+        reason = 'error'
+    if reason is not None:
+        _log_hedge(model, fallback, reason, delay)
+        _count('hedged')
+        hedge = _Attempt(fallback, call, stream, cancel)
+
+    winner = _race(primary, hedge)
+    waited = time.perf_counter() - primary.started
+    answer = _answer(model, primary, winner, reason, waited, stream)
+    if not stream:
+        return winner.future.result(), answer
+    return _rest(winner.future.result(), winner.stream), answer
+
+
+async def ahedged_call(api_key, messages, model, max_tokens, stream=False, use_cache=True, on_usage=None,
+                       latency_budget=None):
+    """Async version of hedged_call; the losing call is cancelled outright"""
+    # Imported here so the WSGI app does not load the async HTTP client
+    from async_api import async_openai_call
+
+    fallback = fallback_model(model)
+    if fallback is None:
+        result = await async_openai_call(api_key=api_key, messages=messages, model=model, max_tokens=max_tokens,
+                                         stream=stream, use_cache=use_cache, on_usage=on_usage)
+        return result, {'model': model}
+
+    async def attempt(attempt_model):
+        # The caller's call type is kept: a blocking caller gets blocking calls
+        result = await async_openai_call(api_key=api_key, messages=messages, model=attempt_model,
+                                         max_tokens=max_tokens, stream=stream, use_cache=use_cache,
+                                         on_usage=on_usage)
+        if not stream:
+            return result, None
+        chunks = result
+        try:
+            first = await chunks.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except BaseException:
+            await chunks.aclose()
+            raise
+        return first, chunks
+
+    def start(attempt_model):
+        task = asyncio.ensure_future(attempt(attempt_model))
+        task.model = attempt_model
+        task.started = time.perf_counter()
+        return task
+
+    async def cancel(task):
+        if task.done():
+            if not task.cancelled() and task.exception() is None and task.result()[1] is not None:
+                await task.result()[1].aclose()
+            return
+        task.cancel()
+        # The cancelled call never answered; count the time it waited
+        _window(stream).add(task.model, time.perf_counter() - task.started)
+
+    _count('calls')
+    delay = hedge_delay(model, latency_budget, stream)
+    primary = start(model)
+    hedge = None
+    reason = None
+    try:
+        await asyncio.wait([primary], timeout=delay)
+        if not primary.done():
+            reason = 'slow'
+        elif primary.exception() is not None:
+            if not _is_transient(primary.exception()):
+                raise primary.exception()
+            reason = 'error'
+        if reason is not None:
+            _log_hedge(model, fallback, reason, delay)
+            _count('hedged')
+            hedge = start(fallback)
+
+        pending = {task for task in (primary, hedge) if task is not None}
+        winner = None
+        errors = {}
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=lambda task: task is not primary):
+                if task is primary and task.exception() is not None and not _is_transient(task.exception()):
+                    # Not something the fallback model can fix: raise it (both calls are stopped below)
+                    raise task.exception()
+                if task.exception() is None and winner is None:
+                    winner = task
+                elif task.exception() is not None:
+                    errors[task] = task.exception()
+                else:
+                    await cancel(task)
+        if winner is None:
+            raise errors.get(primary) or errors[hedge]
+    except BaseException:
+        # The request itself was cancelled or failed: stop both calls
+        for task in (primary, hedge):
+            if task is not None:
+                await cancel(task)
+        raise
+    for task in pending:
+        await cancel(task)
+
+    waited = time.perf_counter() - primary.started
+    answer = _answer(model, primary, winner, reason, waited, stream)
+    first, chunks = winner.result()
+    if not stream:
+        return first, answer
+
+    async def rest():
+        try:
+            if first:
+                yield first
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    return rest(), answer
+
+
+def hedge_stats():
+    """Return hedge counts, estimated time saved and the current hedge delays per model"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['saved_seconds'] = round(stats['saved_seconds'], 3)
+    stats['enabled'] = HEDGE_ENABLED
+    stats['percentile'] = HEDGE_PERCENTILE
+    stats['models'] = {
+        model: {'fallback': fallback,
+                'stream_delay_seconds': round(hedge_delay(model, stream=True), 3),
+                'blocking_delay_seconds': round(hedge_delay(model, stream=False), 3),
+                'stream_samples': len(FIRST_TOKEN_WINDOW.values(model)),
+                'blocking_samples': len(COMPLETION_WINDOW.values(model))}
+        for model, fallback in HEDGE_MODELS.items()
+    }
+    return stats
@@ -0,0 +1,330 @@
+"""
+Persistent background job queue for the AI Email Response Assistant.
+Jobs are stored in a SQLite database so they survive restarts and can be
+picked up by any worker process. Each process runs a small, bounded pool of
+threads that claim queued jobs and run the registered handler for them.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Location of the queue database (shared by all worker processes);
+# defaults to jobs.db in the Flask instance folder
+JOBS_DB_PATH = os.environ.get('JOBS_DB_PATH')
+
+# Number of job threads per worker process
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+
+# Maximum number of queued jobs before new submissions are rejected
+JOB_MAX_QUEUED = int(os.environ.get('JOB_MAX_QUEUED', 500))
+
+# A running job whose lease expires (e.g. the process died) is queued again
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 600))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 2))
+
+# Finished jobs are deleted after this many seconds
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', 24 * 3600))
+
+# How often idle threads check the database for jobs submitted by other processes
+POLL_INTERVAL = 0.5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    lease_expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_status_created ON jobs (status, created_at);
+"""
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at capacity"""
+
+
+class JobQueue:
+    """SQLite-backed job queue with a bounded pool of worker threads"""
+
+    def __init__(self, db_path, workers=JOB_WORKERS, max_queued=JOB_MAX_QUEUED):
+        self.db_path = db_path
+        self.workers = workers
+        self.max_queued = max_queued
+        self.handlers = {}
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._pid = None
+        self._schema_ready = False
+
+    def register(self, kind, handler):
+        """
+        Register the function that runs jobs of a given kind.
+
+        Args:
+            kind (str): Job kind (e.g. "generate")
+            handler (callable): Called with the job payload; returns a JSON-serializable result
+        """
+        self.handlers[kind] = handler
+
+    def _connect(self):
+        """Open a connection to the queue database"""
+        # Autocommit mode; transactions are started explicitly where needed
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if not self._schema_ready:
+            conn.executescript(SCHEMA)
+            self._schema_ready = True
+        return conn
+
+    def start(self):
+        """Start the worker threads for this process (safe to call repeatedly)"""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            # Threads do not survive a fork, so each process starts its own
+            if self._pid == pid:
+                return
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = pid
+            logger.info("Started job worker threads", extra={'threads': self.workers, 'pid': pid})
+
+    def submit(self, kind, payload):
+        """
+        Add a job to the queue.
+
+        Args:
+            kind (str): Job kind; a handler must be registered for it
+            payload (dict): JSON-serializable job input
+
+        Returns:
+            str: The new job id
+
+        Raises:
+            QueueFullError: If too many jobs are already waiting
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"No handler registered for job kind: {kind}")
+
+        job_id = uuid.uuid4().hex
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                conn.execute("ROLLBACK")
+                raise QueueFullError(f"Job queue is full ({queued} jobs waiting)")
+            conn.execute(
+                "INSERT INTO jobs (id, kind, status, payload, created_at) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, kind, json.dumps(payload), time.time())
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        # Make sure this process can run it and wake an idle thread
+        self.start()
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        """
+        Look up a job.
+
+        Returns:
+            dict or None: Job status and result, or None if the job does not exist
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = self._row_to_dict(row)
+            if row['status'] == 'queued':
+                job['position'] = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at <= ?",
+                    (row['created_at'],)
+                ).fetchone()[0]
+            return job
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _row_to_dict(row):
+        """Convert a job row to a dictionary for JSON serialization"""
+        job = {
+            'job_id': row['id'],
+            'kind': row['kind'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'created_at': row['created_at'],
+            'started_at': row['started_at'],
+            'finished_at': row['finished_at'],
+        }
+        if row['started_at']:
+            job['wait_seconds'] = round(row['started_at'] - row['created_at'], 3)
+        if row['finished_at'] and row['started_at']:
+            job['run_seconds'] = round(row['finished_at'] - row['started_at'], 3)
+        if row['result'] is not None:
+            job['result'] = json.loads(row['result'])
+        if row['error'] is not None:
+            job['error'] = row['error']
+        return job
+
+    def _claim(self, conn):
+        """Atomically claim the oldest queued job, returning its row or None"""
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Requeue jobs whose worker disappeared, or give up after too many attempts
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Job worker stopped responding', finished_at = ? "
+                "WHERE status = 'running' AND lease_expires_at < ? AND attempts >= ?",
+                (now, now, JOB_MAX_ATTEMPTS)
+            )
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', lease_expires_at = NULL "
+                "WHERE status = 'running' AND lease_expires_at < ?",
+                (now,)
+            )
+
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, lease_expires_at = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (now, now + JOB_LEASE_SECONDS, row['id'])
+            )
+            conn.execute("COMMIT")
+            return row
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _finish(self, conn, job_id, result=None, error=None):
+        """Store the outcome of a job"""
+        conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, lease_expires_at = NULL "
+            "WHERE id = ?",
+            ('failed' if error is not None else 'completed',
+             json.dumps(result) if error is None else None,
+             error, time.time(), job_id)
+        )
+
+    def _cleanup(self, conn):
+        """Delete finished jobs older than the result TTL"""
+        conn.execute(
+            "DELETE FROM jobs WHERE status IN ('completed', 'failed') AND finished_at < ?",
+            (time.time() - JOB_RESULT_TTL,)
+        )
+
+    def _worker_loop(self):
+        """Claim and run jobs until the process exits"""
+        conn = self._connect()
+        last_cleanup = 0
+        while True:
+            try:
+                row = self._claim(conn)
+            except sqlite3.Error as e:
+                logger.warning("Error claiming job", extra={'error': str(e)})
+                row = None
+
+            if row is None:
+                # Nothing to do; wait for a local submit or poll again shortly
+                if time.time() - last_cleanup > 60:
+                    try:
+                        self._cleanup(conn)
+                    except sqlite3.Error as e:
+                        logger.warning("Error cleaning up finished jobs", extra={'error': str(e)})
+                    last_cleanup = time.time()
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+
+            handler = self.handlers.get(row['kind'])
+            try:
+                if handler is None:
+                    raise ValueError(f"No handler registered for job kind: {row['kind']}")
+                result = handler(json.loads(row['payload']))
+                self._finish(conn, row['id'], result=result)
+            except Exception as e:
+                logger.error("Job failed", extra={'job_id': row['id'], 'error': str(e)})
+                try:
+                    self._finish(conn, row['id'], error=str(e))
+                except Exception as finish_error:
+                    # Keep the worker running; the job is claimed again once its lease expires
+                    logger.error("Error recording failed job", extra={'job_id': row['id'],
+                                                                     'error': str(finish_error)})
+
+    def stats(self, window=200):
+        """
+        Return queue depth and wait-time statistics.
+
+        Args:
+            window (int): Number of most recently started jobs used for wait times
+        """
+        conn = self._connect()
+        try:
+            now = time.time()
+            counts = {status: count for status, count in conn.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            )}
+            oldest = conn.execute(
+                "SELECT MIN(created_at) FROM jobs WHERE status = 'queued'"
+            ).fetchone()[0]
+            waits = sorted(row[0] for row in conn.execute(
+                "SELECT started_at - created_at FROM jobs WHERE started_at IS NOT NULL "
+                "ORDER BY started_at DESC LIMIT ?", (window,)
+            ))
+        finally:
+            conn.close()
+
+        def percentile(p):
+            if not waits:
+                return None
+            index = min(len(waits) - 1, int(round(p / 100.0 * (len(waits) - 1))))
+            return round(waits[index], 3)
+
+        return {
+            'queue_depth': counts.get('queued', 0),
+            'running': counts.get('running', 0),
+            'completed': counts.get('completed', 0),
+            'failed': counts.get('failed', 0),
+            'oldest_queued_seconds': round(now - oldest, 3) if oldest else 0,
+            'wait_seconds': {
+                'samples': len(waits),
+                'mean': round(sum(waits) / len(waits), 3) if waits else None,
+                'p50': percentile(50),
+                'p95': percentile(95),
+                'max': round(waits[-1], 3) if waits else None,
+            },
+            'workers_per_process': self.workers,
+            'max_queued': self.max_queued,
+        }
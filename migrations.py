@@ -0,0 +1,224 @@
+"""
+Versioned database schema.
+The schema_version table records which migrations have run. Worker boot only
+reads it (one query) and applies what is missing; with DB_AUTO_MIGRATE=0 it
+does not touch the schema at all and "flask --app app db-upgrade" is run once
+per deploy instead (e.g. as the release phase). Migrations are serialized
+across workers with a file lock (SQLite) or an advisory lock (PostgreSQL).
+"""
+
+import logging
+import os
+import time
+
+from sqlalchemy import (BigInteger, Column, DateTime, ForeignKey, Index, Integer, LargeBinary, MetaData, String,
+                        Table, Text, inspect, text)
+
+from models import db
+
+try:
+    import fcntl
+except ImportError:  # No cross-process locking on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Set DB_AUTO_MIGRATE=0 when migrations run in a release step instead of at boot
+DB_AUTO_MIGRATE = os.environ.get('DB_AUTO_MIGRATE', '1') != '0'
+
+VERSION_TABLE = 'schema_version'
+
+# Arbitrary key of the PostgreSQL advisory lock held while migrating
+ADVISORY_LOCK_KEY = 74_201_718
+
+
+# The schema each migration creates is written out here rather than taken from
+# models.py, so a migration does the same thing however the models change later
+
+_baseline = MetaData()
+
+Table(
+    'template', _baseline,
+    Column('id', Integer, primary_key=True),
+    Column('title', String(100), nullable=False),
+    Column('content', Text, nullable=False),
+    Column('created_at', DateTime),
+    Column('updated_at', DateTime),
+)
+
+Table(
+    'tag', _baseline,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(50), nullable=False, unique=True),
+)
+
+Table(
+    'template_tags', _baseline,
+    Column('template_id', Integer, ForeignKey('template.id'), primary_key=True),
+    Column('tag_id', Integer, ForeignKey('tag.id'), primary_key=True),
+)
+
+Table(
+    'draft', _baseline,
+    Column('id', String(32), primary_key=True),
+    Column('mode', String(50), nullable=False),
+    Column('model', String(50), nullable=False),
+    Column('messages', Text, nullable=False),
+    Column('revisions', Integer, nullable=False),
+    Column('prompt_tokens', Integer, nullable=False),
+    Column('cached_tokens', Integer, nullable=False),
+    Column('created_at', DateTime),
+    Column('updated_at', DateTime),
+    Index('ix_draft_updated_at', 'updated_at'),
+)
+
+_reply_store = MetaData()
+
+Table(
+    'reply', _reply_store,
+    Column('id', Integer, primary_key=True),
+    Column('status', String(20), nullable=False),
+    Column('mode', String(50), nullable=False),
+    Column('template_id', Integer),
+    Column('draft_id', String(32)),
+    Column('email_body', LargeBinary, nullable=False),
+    Column('reply_body', LargeBinary, nullable=False),
+    Column('simhash', BigInteger, nullable=False),
+    Column('band0', Integer, nullable=False),
+    Column('band1', Integer, nullable=False),
+    Column('band2', Integer, nullable=False),
+    Column('band3', Integer, nullable=False),
+    Column('uses', Integer, nullable=False),
+    Column('created_at', DateTime),
+    Column('approved_at', DateTime),
+    Column('updated_at', DateTime),
+    Index('ix_reply_draft_id', 'draft_id'),
+    Index('ix_reply_band0', 'band0'),
+    Index('ix_reply_band1', 'band1'),
+    Index('ix_reply_band2', 'band2'),
+    Index('ix_reply_band3', 'band3'),
+)
+
+
+def _create_tables(conn):
+    """Baseline: templates, tags and draft sessions (existing tables are left as they are)"""
+    _baseline.create_all(bind=conn)
+
+
+def _add_indexes(conn):
+    """Indexes for tag filters, template listings and imports on databases created before them"""
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS ix_template_tags_tag_id ON template_tags (tag_id)",
+        "CREATE INDEX IF NOT EXISTS ix_template_updated_at_id ON template (updated_at, id)",
+        "CREATE INDEX IF NOT EXISTS ix_template_title ON template (title)",
+    ):
+        conn.execute(text(statement))
+
+
+def _create_reply_table(conn):
+    """Stored replies for near-duplicate emails (see replies.py) on databases created before them"""
+    _reply_store.create_all(bind=conn)
+
+
+def _add_reply_identifiers(conn):
+    """Digest of each reply email's identifiers (see replies.email_identifiers); existing replies get none"""
+    # Databases set up while migration 3 still used models.py got the column there
+    if 'identifiers' not in {column['name'] for column in inspect(conn).get_columns('reply')}:
+        conn.execute(text("ALTER TABLE reply ADD COLUMN identifiers VARCHAR(32)"))
+
+
+# (version, description, function taking a connection), in order; never change a released entry
+MIGRATIONS = [
+    (1, "Create tables", _create_tables),
+    (2, "Indexes for tag filters, template listings and imports", _add_indexes),
+    (3, "Reply store for near-duplicate emails", _create_reply_table),
+    (4, "Identifiers of reply emails", _add_reply_identifiers),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _ensure_version_table(conn):
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} ("
+        f"version INTEGER PRIMARY KEY, description VARCHAR(200) NOT NULL, applied_at FLOAT NOT NULL)"
+    ))
+
+
+def current_version(conn):
+    """Return the highest applied migration (0 for a new or unversioned database)"""
+    if not inspect(conn).has_table(VERSION_TABLE):
+        return 0
+    return conn.execute(text(f"SELECT MAX(version) FROM {VERSION_TABLE}")).scalar() or 0
+
+
+class _MigrationLock:
+    """Hold off other workers while migrating"""
+
+    def __init__(self, conn, lock_path):
+        self.conn = conn
+        self.lock_path = lock_path if fcntl else None
+        self._file = None
+
+    def __enter__(self):
+        if self.conn.dialect.name == 'postgresql':
+            self.conn.execute(text("SELECT pg_advisory_lock(:key)"), {'key': ADVISORY_LOCK_KEY})
+        elif self.lock_path:
+            self._file = open(self.lock_path, 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.conn.dialect.name == 'postgresql':
+            self.conn.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': ADVISORY_LOCK_KEY})
+        elif self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+
+
+def schema_is_current(app):
+    """Return True if every migration has been applied"""
+    with app.app_context(), db.engine.connect() as conn:
+        return current_version(conn) >= LATEST_VERSION
+
+
+def upgrade_schema(app, lock_path=None):
+    """
+    Apply the migrations this database has not had yet.
+
+    Args:
+        app (Flask): The application (the database must already be initialized)
+        lock_path (str): Lock file for SQLite (default: in the instance folder)
+
+    Returns:
+        list: Versions applied (empty if the schema was already current)
+    """
+    if lock_path is None:
+        os.makedirs(app.instance_path, exist_ok=True)
+        lock_path = os.path.join(app.instance_path, 'migrate.lock')
+
+    with app.app_context():
+        # The usual case: one read and nothing to do
+        if schema_is_current(app):
+            return []
+
+        applied = []
+        with db.engine.connect() as conn, _MigrationLock(conn, lock_path):
+            conn.commit()
+            _ensure_version_table(conn)
+            conn.commit()
+            # Another worker may have migrated while this one waited for the lock
+            version = current_version(conn)
+            for number, description, migrate in MIGRATIONS:
+                if number <= version:
+                    continue
+                logger.info("Applying database migration", extra={'version': number, 'description': description})
+                migrate(conn)
+                conn.execute(
+                    text(f"INSERT INTO {VERSION_TABLE} (version, description, applied_at) "
+                         f"VALUES (:version, :description, :applied_at)"),
+                    {'version': number, 'description': description, 'applied_at': time.time()}
+                )
+                conn.commit()
+                applied.append(number)
+        return applied
@@ -0,0 +1,382 @@
+"""
+Metrics, timing spans and structured logging.
+Counters and latency histograms are kept in memory per worker process and
+rendered in the Prometheus text format for the /metrics endpoint. Spans time
+the sections of a request (template lookup, prompt build, API calls, cleanup,
+serialization); each span feeds a histogram and is listed in the request's
+log line. Token usage and its cost are counted per model.
+"""
+
+import collections
+import contextvars
+import hmac
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Logging: LOG_FORMAT is "text" (key=value pairs) or "json"
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+
+# Bearer token for scrapers reading /metrics (without it, only logged-in users can)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Latency histogram buckets in seconds (API calls take up to a minute or more)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+# USD per million tokens: (prompt, cached prompt, completion). Override or add
+# models with MODEL_PRICES, e.g. '{"gpt-4.1": [2.0, 0.5, 8.0]}'
+MODEL_PRICES = {
+    'gpt-4.1': (2.00, 0.50, 8.00),
+    'gpt-4.1-mini': (0.40, 0.10, 1.60),
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'o4-mini': (1.10, 0.275, 4.40),
+    'o3': (2.00, 0.50, 8.00),
+    'o3-mini': (1.10, 0.55, 4.40),
+}
+if os.environ.get('MODEL_PRICES'):
+    MODEL_PRICES.update({model: tuple(prices) for model, prices in json.loads(os.environ['MODEL_PRICES']).items()})
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing value per label combination"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(values.items())]
+
+
+class Histogram:
+    """Observations counted into cumulative buckets per label combination"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * len(self.buckets)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(round(total, 6))}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class LatencyWindow:
+    """The most recent observations per key, for percentiles (histogram buckets are too coarse)"""
+
+    def __init__(self, size=200):
+        self.size = size
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def add(self, key, value):
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = collections.deque(maxlen=self.size)
+            values.append(value)
+
+    def values(self, key):
+        """Return the observations for key, sorted"""
+        with self._lock:
+            return sorted(self._values.get(key, ()))
+
+    def percentile(self, key, percent, min_count=1):
+        """Return the percent-th percentile for key, or None with fewer than min_count observations"""
+        values = self.values(key)
+        if len(values) < max(min_count, 1):
+            return None
+        index = min(int(math.ceil(percent / 100.0 * len(values))) - 1, len(values) - 1)
+        return values[max(index, 0)]
+
+    def counts(self):
+        with self._lock:
+            return {key: len(values) for key, values in self._values.items()}
+
+
+class Registry:
+    """Metrics of this process plus collectors that report other modules' statistics"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collect):
+        """
+        Add a function that returns current values when metrics are rendered.
+
+        The function returns a list of (name, kind, help, samples) tuples,
+        where kind is "gauge" or "counter" and samples is a list of
+        (labels dict, value) pairs.
+        """
+        self._collectors.append(collect)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                logger.warning("Metrics collector failed", extra={'error': str(e)})
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    names = sorted(labels)
+                    lines.append(f"{name}{_format_labels(names, [labels[n] for n in names])} "
+                                 f"{_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of this process
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    'email_assistant_http_request_duration_seconds',
+    'Time to handle an HTTP request, including streaming the body',
+    ('method', 'endpoint', 'status'))
+SPAN_SECONDS = registry.histogram(
+    'email_assistant_span_duration_seconds',
+    'Time spent in a section of request handling',
+    ('span',))
+OPENAI_SECONDS = registry.histogram(
+    'email_assistant_openai_request_duration_seconds',
+    'Time of an OpenAI API call until the full response was received',
+    ('model', 'stream', 'outcome'))
+OPENAI_FIRST_TOKEN_SECONDS = registry.histogram(
+    'email_assistant_openai_first_token_seconds',
+    'Time until the first streamed token of an OpenAI API call',
+    ('model',))
+# Recent first-token latencies of streams and full-response latencies of
+# blocking calls per model (for hedged calls, see hedging.py)
+FIRST_TOKEN_WINDOW = LatencyWindow()
+COMPLETION_WINDOW = LatencyWindow()
+TOKENS = registry.counter(
+    'email_assistant_openai_tokens_total',
+    'Tokens reported in the usage of OpenAI API calls (cached is part of prompt)',
+    ('model', 'kind'))
+COST = registry.counter(
+    'email_assistant_openai_cost_usd_total',
+    'Estimated cost of OpenAI API calls in USD (from MODEL_PRICES)',
+    ('model',))
+
+# Spans of the request being handled in this context: list of (name, seconds)
+_current_spans = contextvars.ContextVar('spans', default=None)
+
+
+def start_trace():
+    """Start collecting spans for a new request in the current context"""
+    _current_spans.set([])
+
+
+def trace_spans():
+    """Return the spans of the current request as {name: milliseconds} (summed per name)"""
+    spans = _current_spans.get() or []
+    totals = {}
+    for name, seconds in spans:
+        totals[name] = totals.get(name, 0.0) + seconds
+    return {name: round(seconds * 1000, 1) for name, seconds in totals.items()}
+
+
+def record_first_token(model, seconds):
+    """Record the time until the first streamed token of an API call"""
+    OPENAI_FIRST_TOKEN_SECONDS.observe(seconds, model=model)
+    FIRST_TOKEN_WINDOW.add(model, seconds)
+
+
+def record_span(name, seconds):
+    """Record a section that was timed elsewhere"""
+    SPAN_SECONDS.observe(seconds, span=name)
+    spans = _current_spans.get()
+    if spans is not None:
+        spans.append((name, seconds))
+
+
+@contextmanager
+def span(name):
+    """Time a section of code as a span"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def record_request(method, path, endpoint, status, elapsed):
+    """Observe a finished request and log it with the span timings of its trace"""
+    REQUEST_SECONDS.observe(elapsed, method=method, endpoint=endpoint, status=status)
+    # Polling and static files would drown out the interesting requests
+    level = logging.DEBUG if endpoint in ('/metrics', '/static/<path:filename>') else logging.INFO
+    fields = {'method': method, 'path': path, 'status': status, 'duration_ms': round(elapsed * 1000, 1)}
+    fields.update((f"{name}_ms", ms) for name, ms in trace_spans().items())
+    logger.log(level, "Request", extra=fields)
+
+
+def estimate_cost(model, usage):
+    """Return the estimated USD cost of a usage block, or None for a model without prices"""
+    prices = MODEL_PRICES.get(model)
+    if not prices or not usage:
+        return None
+    prompt_tokens = usage.get('prompt_tokens') or 0
+    cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+    completion_tokens = usage.get('completion_tokens') or 0
+    prompt_price, cached_price, completion_price = prices
+    return ((prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_price
+            + completion_tokens * completion_price) / 1_000_000
+
+
+def record_usage(model, usage):
+    """Count the tokens and cost of one completion; returns the cost (None if unknown)"""
+    prompt_tokens = usage.get('prompt_tokens') or 0
+    cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+    TOKENS.inc(prompt_tokens, model=model, kind='prompt')
+    TOKENS.inc(cached_tokens, model=model, kind='cached')
+    TOKENS.inc(usage.get('completion_tokens') or 0, model=model, kind='completion')
+    cost = estimate_cost(model, usage)
+    if cost is not None:
+        COST.inc(cost, model=model)
+    return cost
+
+
+def metrics_authorized(headers):
+    """Check the METRICS_TOKEN bearer token; False if no token is configured"""
+    if not METRICS_TOKEN:
+        return False
+    authorization = headers.get('Authorization', '')
+    return hmac.compare_digest(authorization.encode('utf-8'), f"Bearer {METRICS_TOKEN}".encode('utf-8'))
+
+
+# Attributes every LogRecord has; anything else was passed through "extra"
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def _format_field(value):
+    text = str(value)
+    if not text or any(c in text for c in ' "=\n'):
+        return json.dumps(text)
+    return text
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    One line per record with the fields passed through "extra":
+
+        ts=2024-05-01T12:00:00 level=INFO logger=generation msg="..." model=gpt-4.1
+
+    or a JSON object per line when LOG_FORMAT=json.
+    """
+
+    def __init__(self, json_lines=False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        fields.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            fields['exc'] = self.formatException(record.exc_info)
+        if self.json_lines:
+            return json.dumps(fields, default=str)
+        return " ".join(f"{key}={_format_field(value)}" for key, value in fields.items())
+
+
+def configure_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    """Send log records of all modules to stderr as structured lines (once per process)"""
+    root = logging.getLogger()
+    if any(getattr(handler, '_structured', False) for handler in root.handlers):
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(StructuredFormatter(json_lines=log_format == 'json'))
+    handler._structured = True
+    root.addHandler(handler)
+    root.setLevel(level)
@@ -0,0 +1,348 @@
+"""
+Multi-stage generation pipelines.
+A pipeline is a list of named stages, each with its own model, share of the
+token limit and prompt builder; the output of one stage is the input of the
+next. Results of upstream stages are cached, so a modification request only
+reruns the final stage. Every stage run is timed.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from completion_cache import CACHE_DB_PATH, CompletionCache, make_cache_key
+from hedging import ahedged_call, hedged_call
+from observability import record_span, span
+
+logger = logging.getLogger(__name__)
+
+# Upstream stage results are kept for a whole editing session
+STAGE_CACHE_TTL = int(os.environ.get('PIPELINE_STAGE_CACHE_TTL', 86400))
+STAGE_CACHE_SIZE = int(os.environ.get('PIPELINE_STAGE_CACHE_SIZE', 256))
+
+# Optional JSON file with additional pipelines (see load_pipelines)
+PIPELINES_FILE = os.environ.get('PIPELINES_FILE')
+
+# Results of upstream stages, independent of COMPLETION_CACHE_ENABLED
+stage_cache = CompletionCache(max_entries=STAGE_CACHE_SIZE, ttl=STAGE_CACHE_TTL,
+                              db_path=CACHE_DB_PATH, enabled=True)
+
+_stats_lock = threading.Lock()
+_stage_stats = {}
+
+
+class Stage:
+    """One step of a pipeline"""
+
+    def __init__(self, name, build_messages, model=None, token_share=1.0, label=None):
+        """
+        Args:
+            name (str): Stage name, unique within the pipeline
+            build_messages (callable): (params, template_content, upstream) -> chat messages,
+                where upstream is the output of the previous stage (None for the first)
+            model (str): Model to use (None = the model selected in the request)
+            token_share (float): Fraction of the request's token limit for this stage
+            label (str): Text shown in the interface while the stage runs
+        """
+        self.name = name
+        self.build_messages = build_messages
+        self.model = model
+        self.token_share = token_share
+        self.label = label or name.capitalize()
+
+
+class Pipeline:
+    """An ordered list of stages; the output of the last stage is the response"""
+
+    def __init__(self, name, stages, min_token_limit=0):
+        if not stages:
+            raise ValueError(f"Pipeline {name} has no stages")
+        self.name = name
+        self.stages = stages
+        self.min_token_limit = min_token_limit
+
+    def run(self, api_key, params, template_content="", stream=False, messages=None):
+        """
+        Run the pipeline.
+
+        Upstream stages always see the original request (no previous response
+        or modification), so their results can be reused from the stage cache
+        when the user asks for a modification. Only the final stage sees the
+        modification request.
+
+        Args:
+            api_key (str): OpenAI API key
+            params (dict): Parameters from parse_generation_request
+            template_content (str): Optional template to use as a starting point
+            stream (bool): Stream the final stage as it is generated
+            messages (list): Prebuilt messages for the final stage (a draft
+                revision); upstream stages are skipped
+
+        Yields:
+            tuple: (event, data) with events "stage" (a stage starts; only for
+                   multi-stage pipelines), "prompt" (model and messages of the
+                   final stage), "delta" (text of the final stage) and
+                   "timings" (per-stage timings with token usage, last)
+        """
+        use_cache = not params['bypass_cache']
+        upstream = None
+        timings = []
+        stages = self.stages if messages is None else self.stages[-1:]
+
+        for index, stage in enumerate(stages):
+            model, max_tokens = self._stage_limits(stage, params)
+            start = time.perf_counter()
+
+            if index < len(stages) - 1:
+                stage_messages, key, lookup = self._prepare_upstream(stage, params, template_content, upstream)
+                cached = stage_cache.get(key) if lookup else None
+                yield "stage", {"stage": stage.name, "model": model, "label": stage.label,
+                                "cached": cached is not None}
+                if cached is not None:
+                    upstream = cached
+                else:
+                    self._log_stage(stage, model, max_tokens)
+                    upstream, answer = hedged_call(
+                        api_key=api_key,
+                        messages=stage_messages,
+                        model=model,
+                        max_tokens=max_tokens,
+                        use_cache=use_cache,
+                        latency_budget=params.get('latency_budget'),
+                        cancel=params.get('cancel')
+                    )
+                    stage_cache.set(key, upstream)
+                timings.append(self._record(stage, model, start, cached is not None,
+                                            answer if cached is None else None))
+                continue
+
+            if messages is None:
+                with span('prompt_build'):
+                    messages = stage.build_messages(params, template_content, upstream)
+            if len(self.stages) > 1:
+                yield "stage", {"stage": stage.name, "model": model, "label": stage.label, "cached": False}
+            yield "prompt", {"model": model, "messages": messages}
+            self._log_stage(stage, model, max_tokens)
+            usage = {}
+            result, answer = hedged_call(
+                api_key=api_key,
+                messages=messages,
+                model=model,
+                max_tokens=max_tokens,
+                stream=stream,
+                use_cache=use_cache,
+                on_usage=usage.update,
+                latency_budget=params.get('latency_budget'),
+                cancel=params.get('cancel')
+            )
+            first_token = None
+            if stream:
+                try:
+                    for chunk in result:
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                        yield "delta", {"content": chunk}
+                finally:
+                    # Stops the API call if the caller gave up on the stream
+                    if hasattr(result, 'close'):
+                        result.close()
+            else:
+                yield "delta", {"content": result}
+            timings.append(self._final_timing(stage, model, start, first_token, usage, answer))
+
+        yield "timings", {"stages": timings}
+
+    async def arun(self, api_key, params, template_content="", stream=False, messages=None):
+        """Async version of run() for the ASGI server; yields the same events"""
+        use_cache = not params['bypass_cache']
+        upstream = None
+        timings = []
+        stages = self.stages if messages is None else self.stages[-1:]
+
+        for index, stage in enumerate(stages):
+            model, max_tokens = self._stage_limits(stage, params)
+            start = time.perf_counter()
+
+            if index < len(stages) - 1:
+                stage_messages, key, lookup = self._prepare_upstream(stage, params, template_content, upstream)
+                cached = await stage_cache.aget(key) if lookup else None
+                yield "stage", {"stage": stage.name, "model": model, "label": stage.label,
+                                "cached": cached is not None}
+                if cached is not None:
+                    upstream = cached
+                else:
+                    self._log_stage(stage, model, max_tokens)
+                    upstream, answer = await ahedged_call(
+                        api_key=api_key,
+                        messages=stage_messages,
+                        model=model,
+                        max_tokens=max_tokens,
+                        use_cache=use_cache,
+                        latency_budget=params.get('latency_budget')
+                    )
+                    await stage_cache.aset(key, upstream)
+                timings.append(self._record(stage, model, start, cached is not None,
+                                            answer if cached is None else None))
+                continue
+
+            if messages is None:
+                with span('prompt_build'):
+                    messages = stage.build_messages(params, template_content, upstream)
+            if len(self.stages) > 1:
+                yield "stage", {"stage": stage.name, "model": model, "label": stage.label, "cached": False}
+            yield "prompt", {"model": model, "messages": messages}
+            self._log_stage(stage, model, max_tokens)
+            usage = {}
+            result, answer = await ahedged_call(
+                api_key=api_key,
+                messages=messages,
+                model=model,
+                max_tokens=max_tokens,
+                stream=stream,
+                use_cache=use_cache,
+                on_usage=usage.update,
+                latency_budget=params.get('latency_budget')
+            )
+            first_token = None
+            if stream:
+                try:
+                    async for chunk in result:
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                        yield "delta", {"content": chunk}
+                finally:
+                    # Async generators are not closed when dropped, so stop the API call here
+                    await result.aclose()
+            else:
+                yield "delta", {"content": result}
+            timings.append(self._final_timing(stage, model, start, first_token, usage, answer))
+
+        yield "timings", {"stages": timings}
+
+    @staticmethod
+    def _stage_limits(stage, params):
+        """Model and token limit of a stage for this request"""
+        model = stage.model or params['model']
+        return model, max(int(params['token_limit'] * stage.token_share), 1)
+
+    def _prepare_upstream(self, stage, params, template_content, upstream):
+        """
+        Build an upstream stage's messages and its stage cache key.
+
+        Returns:
+            tuple: (messages, stage cache key, whether to look up a cached result)
+        """
+        model, max_tokens = self._stage_limits(stage, params)
+        # Upstream stages see the original request, so a modification can reuse their results
+        initial_params = dict(params, previous_response='', modification_request='')
+        with span('prompt_build'):
+            stage_messages = stage.build_messages(initial_params, template_content, upstream)
+        key = make_cache_key({
+            'pipeline': self.name, 'stage': stage.name,
+            'model': model, 'max_tokens': max_tokens, 'messages': stage_messages,
+        })
+        # A modification must build on the same draft, even when bypassing the cache
+        use_cache = not params['bypass_cache'] or bool(params['previous_response'])
+        return stage_messages, key, use_cache
+
+    def _final_timing(self, stage, model, start, first_token, usage, answer):
+        """Record the final stage and return its timing with time to first token and token usage"""
+        timing = self._record(stage, model, start, False, answer)
+        if first_token is not None:
+            timing['first_token_ms'] = round((first_token - start) * 1000, 1)
+        if usage:
+            timing['prompt_tokens'] = usage.get('prompt_tokens') or 0
+            timing['cached_tokens'] = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+        return timing
+
+    def _log_stage(self, stage, model, max_tokens):
+        logger.debug("Pipeline stage", extra={'pipeline': self.name, 'stage': stage.name,
+                                              'model': model, 'max_tokens': max_tokens})
+
+    def _record(self, stage, model, start, cached, answer=None):
+        """
+        Add a stage run to the statistics and return its timing.
+
+        answer (from hedged_call) adds the model that answered and, for a
+        hedged call, why it was hedged and the estimated time saved.
+        """
+        elapsed = time.perf_counter() - start
+        key = f"{self.name}/{stage.name}"
+        if len(self.stages) > 1:
+            # A single-stage pipeline is just its API call (the openai_call span)
+            record_span(f"stage.{self.name}.{stage.name}", elapsed)
+        with _stats_lock:
+            stats = _stage_stats.setdefault(key, {'runs': 0, 'cached': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            stats['runs'] += 1
+            if cached:
+                stats['cached'] += 1
+            else:
+                # Only real calls count towards the latency figures
+                stats['total_seconds'] += elapsed
+                stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+        timing = {'stage': stage.name, 'model': model, 'cached': cached, 'elapsed_ms': round(elapsed * 1000, 1)}
+        if answer:
+            timing['answered_by'] = answer['model']
+            timing.update((key, answer[key]) for key in ('hedge', 'hedge_saved_ms') if key in answer)
+        return timing
+
+
+def load_pipelines(path, prompt_builders):
+    """
+    Load pipeline definitions from a JSON file.
+
+    The file maps pipeline names (the "model" value sent by the client) to
+    definitions such as:
+
+        {"technical-mini": {"min_token_limit": 1500, "stages": [
+            {"name": "draft", "model": "o4-mini", "token_share": 0.5, "prompt": "respond"},
+            {"name": "refine", "model": "gpt-4.1-mini", "token_share": 0.5, "prompt": "refine"}
+        ]}}
+
+    Args:
+        path (str): Path of the JSON file
+        prompt_builders (dict): Prompt builder functions by name
+
+    Returns:
+        dict: Pipelines by name
+
+    Raises:
+        ValueError: If a definition is invalid
+    """
+    with open(path, encoding='utf-8') as f:
+        definitions = json.load(f)
+
+    pipelines = {}
+    for name, definition in definitions.items():
+        stages = []
+        for stage in definition.get('stages', []):
+            prompt = stage.get('prompt')
+            if prompt not in prompt_builders:
+                raise ValueError(f"Pipeline {name}: unknown prompt {prompt!r} "
+                                 f"(available: {', '.join(sorted(prompt_builders))})")
+            if not stage.get('name') or not stage.get('model'):
+                # The request's "model" is the pipeline name, so every stage needs its own model
+                raise ValueError(f"Pipeline {name}: every stage needs a name and a model")
+            stages.append(Stage(
+                name=stage['name'],
+                build_messages=prompt_builders[prompt],
+                model=stage['model'],
+                token_share=float(stage.get('token_share', 1.0)),
+                label=stage.get('label'),
+            ))
+        pipelines[name] = Pipeline(name, stages, min_token_limit=int(definition.get('min_token_limit', 0)))
+    return pipelines
+
+
+def pipeline_stats():
+    """Return per-stage run counts and latencies, and stage cache statistics"""
+    with _stats_lock:
+        stages = {key: dict(value) for key, value in _stage_stats.items()}
+    for stats in stages.values():
+        calls = stats['runs'] - stats['cached']
+        stats['mean_seconds'] = round(stats['total_seconds'] / calls, 3) if calls else None
+        stats['total_seconds'] = round(stats['total_seconds'], 3)
+        stats['max_seconds'] = round(stats['max_seconds'], 3)
+    return {'stages': stages, 'cache': stage_cache.stats()}
@@ -0,0 +1,355 @@
+"""
+Rate-limit-aware scheduling for OpenAI API calls.
+Tracks per-model request and token budgets from the x-ratelimit-* response
+headers as token buckets, shared by all worker processes through a SQLite
+file. Calls wait until the budget has room instead of running into 429s.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Location of the shared budget store; set by the app (see configure())
+RATE_LIMIT_DB_PATH = os.environ.get('RATE_LIMIT_DB')
+
+# Longest a call waits for budget before it is sent anyway
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', 60))
+
+# Longest single sleep, so waiting calls notice budget updates from other workers
+MAX_SLEEP = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS budgets (
+    model TEXT PRIMARY KEY,
+    limit_requests REAL,
+    remaining_requests REAL,
+    request_rate REAL,
+    limit_tokens REAL,
+    remaining_tokens REAL,
+    token_rate REAL,
+    blocked_until REAL NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+"""
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+
+
+def parse_reset_duration(value):
+    """
+    Parse an OpenAI reset duration such as "20ms", "1s" or "6m0s".
+
+    Returns:
+        float or None: Seconds, or None if the value cannot be parsed
+    """
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def estimate_request_tokens(payload):
+    """
+    Estimate how many tokens a request counts against the token budget.
+
+    OpenAI counts the prompt plus the requested completion limit. The prompt
+    is estimated at about four characters per token.
+    """
+    prompt_chars = sum(len(message.get('content') or '') for message in payload.get('messages', []))
+    completion = payload.get('max_completion_tokens') or payload.get('max_tokens') or 0
+    return prompt_chars // 4 + completion
+
+
+def _read_budget(headers, kind):
+    """Read (limit, remaining, refill rate per second) for "requests" or "tokens" from headers"""
+    try:
+        limit = float(headers.get(f'x-ratelimit-limit-{kind}'))
+        remaining = float(headers.get(f'x-ratelimit-remaining-{kind}'))
+    except (TypeError, ValueError):
+        return None
+    reset = parse_reset_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+
+    # The budget refills to the limit over the reset time; limits are per minute
+    if reset and limit > remaining:
+        rate = (limit - remaining) / reset
+    else:
+        rate = limit / 60.0
+    return limit, remaining, max(rate, limit / 60.0)
+
+
+class RateLimiter:
+    """Token-bucket scheduler fed by rate limit headers, shared through SQLite"""
+
+    def __init__(self, db_path=RATE_LIMIT_DB_PATH, max_wait=RATE_LIMIT_MAX_WAIT):
+        self.db_path = db_path
+        self.max_wait = max_wait
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counters = {
+            'acquired': 0,
+            'paced': 0,
+            'wait_seconds': 0.0,
+            'gave_up_waiting': 0,
+            'throttled': 0,
+        }
+
+    def configure(self, db_path):
+        """Set the location of the shared store (keeps an explicit RATE_LIMIT_DB)"""
+        if not self.db_path:
+            self.db_path = db_path
+
+    def _connect(self):
+        """Return this thread's connection to the store, or None if not configured"""
+        if not self.db_path:
+            return None
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    @staticmethod
+    def _available(row, now):
+        """Current (requests, tokens) in the buckets after refilling since the last update"""
+        elapsed = max(now - row['updated_at'], 0.0)
+        requests = tokens = None
+        if row['limit_requests'] is not None:
+            requests = min(row['limit_requests'], row['remaining_requests'] + row['request_rate'] * elapsed)
+        if row['limit_tokens'] is not None:
+            tokens = min(row['limit_tokens'], row['remaining_tokens'] + row['token_rate'] * elapsed)
+        return requests, tokens
+
+    def acquire(self, model, tokens):
+        """
+        Wait until the model's budget has room for a call, then reserve it.
+
+        Never raises for lack of budget: after max_wait seconds the call is
+        let through and the transport's 429 handling takes over.
+
+        Args:
+            model (str): Model the call is for
+            tokens (int): Estimated tokens the call counts against the budget
+
+        Returns:
+            float: Seconds spent waiting
+        """
+        conn = self._acquire_connection()
+        if conn is None:
+            return 0.0
+
+        start = time.monotonic()
+        slept = False
+        while True:
+            waited, delay = self._attempt(conn, model, tokens, start, slept)
+            if delay is None:
+                return waited
+            time.sleep(delay)
+            slept = True
+
+    async def acquire_async(self, model, tokens):
+        """
+        Like acquire(), for the event loop.
+
+        Each reservation attempt runs in a thread, since BEGIN IMMEDIATE can
+        wait up to the busy timeout for another worker's write; only the
+        pacing sleeps happen on the loop.
+        """
+        if not self.db_path:
+            return 0.0
+
+        start = time.monotonic()
+        slept = False
+        while True:
+            waited, delay = await asyncio.to_thread(self._attempt_in_thread, model, tokens, start, slept)
+            if delay is None:
+                return waited
+            await asyncio.sleep(delay)
+            slept = True
+
+    def _attempt_in_thread(self, model, tokens, start, slept):
+        # SQLite connections belong to the thread that opened them, so connect here
+        conn = self._acquire_connection()
+        if conn is None:
+            return 0.0, None
+        return self._attempt(conn, model, tokens, start, slept)
+
+    def _acquire_connection(self):
+        try:
+            return self._connect()
+        except sqlite3.Error as e:
+            logger.warning("Rate limiter unavailable", extra={'error': str(e)})
+            return None
+
+    def _attempt(self, conn, model, tokens, start, slept):
+        """
+        One reservation attempt of acquire().
+
+        Returns:
+            tuple: (seconds waited so far, seconds to sleep before the next
+                   attempt or None once the call may go ahead)
+        """
+        now = time.time()
+        try:
+            wait = self._try_reserve(conn, model, tokens, now)
+        except sqlite3.Error as e:
+            logger.warning("Rate limiter error", extra={'error': str(e)})
+            wait = None
+
+        waited = time.monotonic() - start
+        if wait is None:
+            self._count('acquired')
+            if slept:
+                self._count('paced')
+                self._count('wait_seconds', waited)
+            return waited, None
+
+        if waited + wait > self.max_wait:
+            # Budget will not free up in time; let the call go and rely on retries
+            self._count('gave_up_waiting')
+            self._count('wait_seconds', waited)
+            return waited, None
+
+        return waited, min(wait, MAX_SLEEP)
+
+    def _try_reserve(self, conn, model, tokens, now):
+        """Reserve budget if available; return None on success or the seconds to wait"""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT * FROM budgets WHERE model = ?", (model,)).fetchone()
+            if row is None:
+                # No headers seen yet for this model, nothing to pace against
+                conn.execute("COMMIT")
+                return None
+
+            if row['blocked_until'] > now:
+                conn.execute("COMMIT")
+                return row['blocked_until'] - now
+
+            requests, available_tokens = self._available(row, now)
+            waits = []
+            if requests is not None and requests < 1:
+                waits.append((1 - requests) / row['request_rate'])
+            if available_tokens is not None:
+                # A request bigger than the whole budget only needs a full bucket
+                needed = min(tokens, row['limit_tokens'])
+                if available_tokens < needed:
+                    waits.append((needed - available_tokens) / row['token_rate'])
+            if waits:
+                conn.execute("COMMIT")
+                return max(waits)
+
+            conn.execute(
+                "UPDATE budgets SET remaining_requests = ?, remaining_tokens = ?, updated_at = ? WHERE model = ?",
+                (requests - 1 if requests is not None else None,
+                 available_tokens - tokens if available_tokens is not None else None,
+                 now, model)
+            )
+            conn.execute("COMMIT")
+            return None
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def update_from_headers(self, model, headers):
+        """Record the budget reported by the API in a response's rate limit headers"""
+        request_budget = _read_budget(headers, 'requests')
+        token_budget = _read_budget(headers, 'tokens')
+        if request_budget is None and token_budget is None:
+            return
+        try:
+            conn = self._connect()
+            if conn is None:
+                return
+            limit_requests, remaining_requests, request_rate = request_budget or (None, None, None)
+            limit_tokens, remaining_tokens, token_rate = token_budget or (None, None, None)
+            conn.execute(
+                "INSERT INTO budgets (model, limit_requests, remaining_requests, request_rate, "
+                "limit_tokens, remaining_tokens, token_rate, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(model) DO UPDATE SET limit_requests = excluded.limit_requests, "
+                "remaining_requests = excluded.remaining_requests, request_rate = excluded.request_rate, "
+                "limit_tokens = excluded.limit_tokens, remaining_tokens = excluded.remaining_tokens, "
+                "token_rate = excluded.token_rate, updated_at = excluded.updated_at",
+                (model, limit_requests, remaining_requests, request_rate,
+                 limit_tokens, remaining_tokens, token_rate, time.time())
+            )
+        except sqlite3.Error as e:
+            logger.warning("Rate limiter update failed", extra={'error': str(e)})
+
+    def block(self, model, seconds):
+        """Pause all calls for a model (in every worker) after a 429 response"""
+        self._count('throttled')
+        try:
+            conn = self._connect()
+            if conn is None:
+                return
+            until = time.time() + seconds
+            conn.execute(
+                "INSERT INTO budgets (model, blocked_until, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(model) DO UPDATE SET blocked_until = MAX(blocked_until, excluded.blocked_until)",
+                (model, until, time.time())
+            )
+        except sqlite3.Error as e:
+            logger.warning("Rate limiter update failed", extra={'error': str(e)})
+
+    def headroom(self):
+        """Return the current budget of every known model"""
+        models = {}
+        try:
+            conn = self._connect()
+            rows = conn.execute("SELECT * FROM budgets ORDER BY model").fetchall() if conn else []
+        except sqlite3.Error as e:
+            logger.warning("Rate limiter read failed", extra={'error': str(e)})
+            rows = []
+
+        now = time.time()
+        for row in rows:
+            requests, tokens = self._available(row, now)
+            models[row['model']] = {
+                'requests': {
+                    'limit': row['limit_requests'],
+                    'available': round(requests, 1) if requests is not None else None,
+                },
+                'tokens': {
+                    'limit': row['limit_tokens'],
+                    'available': round(tokens) if tokens is not None else None,
+                },
+                'blocked_seconds': round(max(row['blocked_until'] - now, 0.0), 3),
+            }
+        return models
+
+    def stats(self):
+        """Return per-model headroom and this worker's pacing counters"""
+        with self._lock:
+            counters = dict(self._counters)
+        counters['wait_seconds'] = round(counters['wait_seconds'], 3)
+        return {
+            'enabled': bool(self.db_path),
+            'max_wait_seconds': self.max_wait,
+            **counters,
+            'models': self.headroom(),
+        }
+
+
+# Scheduler shared by every call in this process
+rate_limiter = RateLimiter()
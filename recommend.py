@@ -0,0 +1,529 @@
+"""
+Template suggestions for an incoming email.
+Keeps a BM25 index over template titles, content and tags as compact NumPy
+arrays (a CSR matrix of weighted term frequencies) and scores every template
+against the pasted email in one vectorized pass. Template changes update the
+index in place: the old row of a changed or deleted template is tombstoned
+and new rows are appended, with the arrays compacted once enough rows are
+dead. The index is saved to a file that all worker processes share, so
+workers load it instead of rebuilding it and pick up each other's changes.
+Workers load it (and NumPy) on first use; with gunicorn's preload_app the
+master loads it once before forking.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import func
+
+from models import db, Template
+
+# NumPy is imported on first use (see _import_numpy); it takes longer to import than the rest of the app
+np = None
+
+try:
+    import fcntl
+except ImportError:  # No cross-process locking on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Location of the saved index; set by the app (see configure())
+RECOMMEND_INDEX_PATH = os.environ.get('RECOMMEND_INDEX_PATH')
+
+# Number of suggestions returned by default and at most
+SUGGEST_LIMIT = 5
+SUGGEST_MAX_LIMIT = 20
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# A word in the title or tags counts as several occurrences in the body
+TITLE_WEIGHT = 3.0
+TAGS_WEIGHT = 2.0
+CONTENT_WEIGHT = 1.0
+
+# Rewrite the arrays without dead rows once this share of rows is tombstoned
+COMPACT_RATIO = 0.25
+
+# Bumped when the saved layout changes; older files are rebuilt
+FORMAT_VERSION = 1
+
+def _import_numpy():
+    """Import NumPy into this module; returns False if it is not installed"""
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:  # Suggestions are turned off without NumPy
+            return False
+        np = numpy
+    return True
+
+
+_WORD = re.compile(r"[^\W\d_]{2,}|\d{2,}", re.UNICODE)
+
+# Words that appear in nearly every email and say nothing about its topic
+STOP_WORDS = frozenset("""
+    a about after again all also am an and any are as at be because been before being but by can could
+    did do does doing don dear for from get got had has have having he her here hi hello him his how i if
+    in into is it its just let me more most my no not now of off on once only or other our out over own
+    please re regards same she should so some such than thank thanks that the their them then there
+    these they this those through to too under until up us very was we were what when where which while
+    who why will with would you your yours
+""".split())
+
+
+def tokenize(text):
+    """
+    Split text into index terms: lowercase words without stop words.
+    A plural "s" is dropped so that "orders" matches "order".
+    """
+    terms = []
+    for word in _WORD.findall(text.lower()):
+        if word in STOP_WORDS:
+            continue
+        if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'is', 'us')):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+def template_terms(title, content, tags):
+    """Return the field-weighted term frequencies of a template"""
+    counts = Counter()
+    for text, weight in ((title, TITLE_WEIGHT), (content, CONTENT_WEIGHT), (" ".join(tags), TAGS_WEIGHT)):
+        for term in tokenize(text or ''):
+            counts[term] += weight
+    return counts
+
+
+class TemplateIndex:
+    """
+    BM25 index over templates.
+
+    Rows are stored as a CSR matrix: indptr (rows + 1), indices (term ids)
+    and data (weighted term frequencies). Rows added since the last merge
+    are kept in a small pending list and folded into the arrays before the
+    next search or save. Not thread-safe; TemplateRecommender locks it.
+    """
+
+    def __init__(self):
+        self.terms = []
+        self.vocabulary = {}
+        self.doc_ids = np.zeros(0, dtype=np.int64)
+        self.doc_len = np.zeros(0, dtype=np.float32)
+        self.alive = np.zeros(0, dtype=bool)
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.data = np.zeros(0, dtype=np.float32)
+        self.df = np.zeros(0, dtype=np.int32)
+        self._rows = np.zeros(0, dtype=np.int32)  # Row of each stored entry
+        self._pending = []  # (template id, term ids, frequencies) not yet in the arrays
+        self._row_of = {}  # Template id -> row of its live version
+        self._live_length = 0.0
+
+    @property
+    def size(self):
+        """Number of templates in the index"""
+        return len(self._row_of)
+
+    @property
+    def total_rows(self):
+        return len(self.doc_ids) + len(self._pending)
+
+    def _term_ids(self, counts):
+        ids = np.empty(len(counts), dtype=np.int32)
+        for position, term in enumerate(counts):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                term_id = self.vocabulary[term] = len(self.terms)
+                self.terms.append(term)
+            ids[position] = term_id
+        if len(self.terms) > len(self.df):
+            self.df = np.concatenate([self.df, np.zeros(len(self.terms) - len(self.df), dtype=np.int32)])
+        return ids
+
+    def upsert(self, template_id, title, content, tags):
+        """Add a template, replacing its previous version"""
+        self.remove(template_id)
+        counts = template_terms(title, content, tags)
+        term_ids = self._term_ids(counts)
+        frequencies = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        self.df[term_ids] += 1
+        self._row_of[template_id] = self.total_rows
+        self._pending.append((template_id, term_ids, frequencies))
+        self._live_length += float(frequencies.sum())
+
+    def remove(self, template_id):
+        """Tombstone the live row of a template (no-op if it is not indexed)"""
+        row = self._row_of.pop(template_id, None)
+        if row is None:
+            return
+        if row < len(self.doc_ids):
+            start, end = self.indptr[row], self.indptr[row + 1]
+            term_ids = self.indices[start:end]
+            self.alive[row] = False
+            self._live_length -= float(self.doc_len[row])
+        else:
+            _, term_ids, frequencies = self._pending[row - len(self.doc_ids)]
+            self._pending[row - len(self.doc_ids)] = (None, term_ids, frequencies)
+            self._live_length -= float(frequencies.sum())
+        self.df[term_ids] -= 1
+
+    def _merge(self):
+        """Append the pending rows to the arrays, compacting them if many rows are dead"""
+        if self._pending:
+            self._append_pending()
+        if len(self.doc_ids) and (~self.alive).sum() > COMPACT_RATIO * len(self.doc_ids):
+            self.compact()
+
+    def _append_pending(self):
+        lengths = np.array([len(term_ids) for _, term_ids, _ in self._pending], dtype=np.int64)
+        self.doc_ids = np.concatenate([self.doc_ids, np.array(
+            [template_id if template_id is not None else -1 for template_id, _, _ in self._pending], dtype=np.int64)])
+        self.doc_len = np.concatenate([self.doc_len, np.array(
+            [frequencies.sum() for _, _, frequencies in self._pending], dtype=np.float32)])
+        self.alive = np.concatenate([self.alive, np.array(
+            [template_id is not None for template_id, _, _ in self._pending], dtype=bool)])
+        self.indptr = np.concatenate([self.indptr, self.indptr[-1] + np.cumsum(lengths)])
+        self.indices = np.concatenate([self.indices] + [term_ids for _, term_ids, _ in self._pending])
+        self.data = np.concatenate([self.data] + [frequencies for _, _, frequencies in self._pending])
+        self._pending = []
+        self._rows = np.repeat(np.arange(len(self.doc_ids), dtype=np.int32), np.diff(self.indptr))
+
+    def compact(self):
+        """Drop tombstoned rows and unused terms from the arrays"""
+        keep = np.flatnonzero(self.alive)
+        lengths = np.diff(self.indptr)[keep]
+        entries = np.repeat(self.alive, np.diff(self.indptr))
+
+        # Renumber the terms that are still in use
+        used = np.flatnonzero(self.df > 0)
+        remap = np.full(len(self.terms), -1, dtype=np.int32)
+        remap[used] = np.arange(len(used), dtype=np.int32)
+        self.terms = [self.terms[term_id] for term_id in used]
+        self.vocabulary = {term: term_id for term_id, term in enumerate(self.terms)}
+        self.df = self.df[used]
+
+        self.indices = remap[self.indices[entries]]
+        self.data = self.data[entries]
+        self.doc_ids = self.doc_ids[keep]
+        self.doc_len = self.doc_len[keep]
+        self.alive = np.ones(len(keep), dtype=bool)
+        self.indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        self._rows = np.repeat(np.arange(len(keep), dtype=np.int32), lengths)
+        self._row_of = {int(template_id): row for row, template_id in enumerate(self.doc_ids)}
+
+    def search(self, text, limit=SUGGEST_LIMIT):
+        """
+        Rank templates against a text.
+
+        Returns:
+            list: (template_id, score, matched terms) tuples, best match first
+        """
+        self._merge()
+        counts = Counter(term_id for term_id in map(self.vocabulary.get, tokenize(text)) if term_id is not None)
+        if not counts or not self.size:
+            return []
+
+        # Inverse document frequency of the query terms (over live templates only)
+        query = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+        df = self.df[query].astype(np.float32)
+        idf = np.log1p((self.size - df + 0.5) / (df + 0.5))
+        # A word repeated in the email counts a little more, not proportionally more
+        query_weights = np.zeros(len(self.terms), dtype=np.float32)
+        query_weights[query] = idf * (1.0 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts))))
+
+        # Score only the stored entries of the query terms
+        weights = query_weights[self.indices]
+        hits = np.flatnonzero(weights)
+        if not len(hits):
+            return []
+        rows = self._rows[hits]
+        frequencies = self.data[hits]
+        average_length = self._live_length / self.size or 1.0
+        norm = BM25_K1 * (1.0 - BM25_B + BM25_B * self.doc_len[rows] / average_length)
+        contributions = weights[hits] * frequencies * (BM25_K1 + 1.0) / (frequencies + norm)
+        scores = np.bincount(rows, weights=contributions, minlength=len(self.doc_ids))
+        scores[~self.alive] = 0.0
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+
+        results = []
+        for row in candidates:
+            matched = hits[rows == row]
+            # The terms that contributed most, for display
+            best = matched[np.argsort(-contributions[rows == row])][:5]
+            results.append((int(self.doc_ids[row]), round(float(scores[row]), 4),
+                            [self.terms[term_id] for term_id in self.indices[best]]))
+        return results
+
+    def save(self, path, signature):
+        """Write the index to a file (atomically replacing the previous one)"""
+        self._merge()
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as f:
+            np.savez(
+                f,
+                doc_ids=self.doc_ids, doc_len=self.doc_len, alive=self.alive,
+                indptr=self.indptr, indices=self.indices, data=self.data, df=self.df,
+                terms=np.array(self.terms, dtype=np.str_),
+                meta=np.array(json.dumps({'version': FORMAT_VERSION, 'signature': signature})),
+            )
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read an index written by save().
+
+        Returns:
+            tuple: (index, signature), or (None, None) if the file is missing
+                   or was written by an incompatible version
+        """
+        try:
+            with np.load(path, allow_pickle=False) as arrays:
+                meta = json.loads(str(arrays['meta']))
+                if meta.get('version') != FORMAT_VERSION:
+                    return None, None
+                index = cls()
+                for name in ('doc_ids', 'doc_len', 'alive', 'indptr', 'indices', 'data', 'df'):
+                    setattr(index, name, arrays[name])
+                index.terms = arrays['terms'].tolist()
+        except FileNotFoundError:
+            return None, None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Template suggestions: cannot read the saved index", extra={'error': str(e)})
+            return None, None
+        index.vocabulary = {term: term_id for term_id, term in enumerate(index.terms)}
+        index._rows = np.repeat(np.arange(len(index.doc_ids), dtype=np.int32), np.diff(index.indptr))
+        index._row_of = {int(template_id): int(row) for row, template_id in
+                         zip(np.flatnonzero(index.alive), index.doc_ids[index.alive])}
+        index._live_length = float(index.doc_len[index.alive].sum())
+        return index, meta.get('signature')
+
+
+def _database_signature():
+    """Template count and last update time, to tell whether a saved index is current"""
+    count, last_update = db.session.query(func.count(Template.id), func.max(Template.updated_at)).one()
+    return [count, last_update.isoformat() if last_update else None]
+
+
+def _template_fields(template):
+    return template.id, template.title, template.content, [tag.name for tag in template.tags]
+
+
+class TemplateRecommender:
+    """The index of this process, kept in sync with the shared file"""
+
+    def __init__(self, path=RECOMMEND_INDEX_PATH):
+        self.path = path
+        self.index = None
+        self._loaded_mtime = None
+        self._app = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._counters = {
+            'suggestions': 0,
+            'search_seconds': 0.0,
+            'max_search_seconds': 0.0,
+            'updates': 0,
+            'reloads': 0,
+            'rebuilds': 0,
+        }
+
+    @property
+    def enabled(self):
+        return self.index is not None
+
+    def configure(self, path):
+        """Set the location of the saved index (keeps an explicit RECOMMEND_INDEX_PATH)"""
+        if not self.path:
+            self.path = path
+
+    def init_app(self, app, lazy=False):
+        """
+        Load the saved index, or build it from the database if it is missing
+        or out of date (e.g. templates were changed while it was not saved).
+
+        With lazy=True this only remembers the app; the index is loaded by
+        the first call that needs it (see ensure_loaded).
+        """
+        if lazy:
+            self._app = app
+            return
+        self._app = None
+        if not _import_numpy():
+            logger.info("Template suggestions: NumPy is not installed, suggestions are turned off")
+            return
+        with app.app_context(), self._file_lock():
+            signature = _database_signature()
+            index, saved_signature = TemplateIndex.load(self.path) if self.path else (None, None)
+            if index is not None and saved_signature == signature:
+                self.index = index
+                self._loaded_mtime = self._mtime()
+                return
+            logger.info("Template suggestions: building index", extra={'templates': signature[0]})
+            self._rebuild(signature)
+
+    def ensure_loaded(self):
+        """Load the index if init_app was called with lazy=True; returns self.enabled"""
+        if self._app is not None:
+            with self._load_lock:
+                if self._app is not None:
+                    self.init_app(self._app)
+        return self.enabled
+
+    def _rebuild(self, signature):
+        index = TemplateIndex()
+        for template in Template.query.all():
+            index.upsert(*_template_fields(template))
+        self.index = index
+        self._counters['rebuilds'] += 1
+        self._save(signature)
+
+    def rebuild(self):
+        """Rebuild the index from every template (needs an app context)"""
+        self._app = None
+        if not _import_numpy():
+            return
+        with self._file_lock(), self._lock:
+            self._rebuild(_database_signature())
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns if self.path else None
+        except OSError:
+            return None
+
+    def _save(self, signature):
+        if not self.path:
+            return
+        try:
+            self.index.save(self.path, signature)
+            self._loaded_mtime = self._mtime()
+        except OSError as e:
+            logger.warning("Template suggestions: cannot save the index", extra={'error': str(e)})
+
+    def _file_lock(self):
+        return _FileLock(f"{self.path}.lock" if self.path and fcntl else None)
+
+    def _reload_if_changed(self):
+        """Load the shared file if another worker saved a newer version"""
+        mtime = self._mtime()
+        if mtime is None or mtime == self._loaded_mtime:
+            return
+        index, _ = TemplateIndex.load(self.path)
+        if index is not None:
+            self.index = index
+            self._loaded_mtime = mtime
+            self._counters['reloads'] += 1
+
+    def _apply(self, change):
+        """Apply a change to the latest index and save it for the other workers"""
+        # Loaded first, so the change is not lost when the saved index is written back
+        if not self.ensure_loaded():
+            return
+        try:
+            with self._file_lock(), self._lock:
+                self._reload_if_changed()
+                change(self.index)
+                self._counters['updates'] += 1
+                self._save(_database_signature())
+        except Exception as e:
+            # The database is the source of truth; the next start rebuilds a stale index
+            logger.warning("Template suggestions: index update failed", extra={'error': str(e)})
+
+    def update_template(self, template):
+        """Index a created or changed template (call after the commit)"""
+        self.update_many([_template_fields(template)])
+
+    def update_many(self, entries):
+        """
+        Index many created or changed templates with a single save (call after the commit).
+
+        Args:
+            entries (list): (template_id, title, content, tag names) tuples
+        """
+        def change(index):
+            for entry in entries:
+                index.upsert(*entry)
+        self._apply(change)
+
+    def remove_template(self, template_id):
+        """Remove a deleted template (call after the commit)"""
+        self._apply(lambda index: index.remove(template_id))
+
+    def suggest(self, text, limit=SUGGEST_LIMIT):
+        """
+        Suggest templates for an email.
+
+        Returns:
+            list: (template_id, score, matched terms) tuples, best match first
+        """
+        if not self.ensure_loaded():
+            return []
+        start = time.perf_counter()
+        with self._lock:
+            self._reload_if_changed()
+            results = self.index.search(text, limit)
+            elapsed = time.perf_counter() - start
+            self._counters['suggestions'] += 1
+            self._counters['search_seconds'] += elapsed
+            self._counters['max_search_seconds'] = max(self._counters['max_search_seconds'], elapsed)
+        return results
+
+    def stats(self):
+        """Return index size and search latency as a dictionary"""
+        with self._lock:
+            counters = dict(self._counters)
+            index = self.index
+            sizes = {
+                'templates': index.size,
+                'rows': index.total_rows,
+                'terms': len(index.terms),
+                'entries': int(len(index.indices)),
+                'array_bytes': int(sum(array.nbytes for array in (
+                    index.doc_ids, index.doc_len, index.alive, index.indptr, index.indices,
+                    index.data, index.df, index._rows))),
+            } if index is not None else {}
+        searches = counters['suggestions']
+        counters['mean_search_ms'] = round(counters['search_seconds'] / searches * 1000, 3) if searches else None
+        counters['max_search_ms'] = round(counters.pop('max_search_seconds') * 1000, 3)
+        counters['search_seconds'] = round(counters['search_seconds'], 3)
+        return {'enabled': self.enabled, 'load_pending': self._app is not None, 'path': self.path,
+                **sizes, **counters}
+
+
+class _FileLock:
+    """Exclusive lock on a file, so only one worker at a time changes the saved index"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        if self.path:
+            self._file = open(self.path, 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+# Index shared by every request in this process
+recommender = TemplateRecommender()
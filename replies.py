@@ -0,0 +1,317 @@
+"""
+Stored replies and reuse for near-duplicate emails.
+Every generated response is kept as a draft reply next to the email it
+answers, both zlib-compressed; when an agent approves the final version it
+can answer later emails. Emails are normalized (compacted, lowercased,
+numbers, addresses and links masked) and fingerprinted with a 64-bit
+SimHash; the masked identifiers are kept as a digest of their own. A new
+email whose fingerprint is within REPLY_REUSE_MAX_DISTANCE bits of an
+approved reply's, and whose identifiers (order numbers, amounts,
+addresses, links) are exactly the same, gets that reply back instead of a
+generation, so a reply about one customer's order never answers another's.
+The fingerprint is split into four 16-bit bands, each indexed: two
+fingerprints that differ in at most three bits share at least one band, so
+a lookup is one indexed query plus a Hamming distance per candidate.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_
+
+from compaction import compact_email
+from models import db, Reply
+
+logger = logging.getLogger(__name__)
+
+REPLY_REUSE_ENABLED = os.environ.get('REPLY_REUSE_ENABLED', '1') != '0'
+
+# Most differing SimHash bits (of 64) for an email to count as a near-duplicate; 3 at most with 4 bands
+REPLY_REUSE_MAX_DISTANCE = min(int(os.environ.get('REPLY_REUSE_MAX_DISTANCE', 3)), 3)
+
+# Shorter emails ("Thanks!", "Where is my order?") say too little to reuse a reply for
+REPLY_REUSE_MIN_WORDS = int(os.environ.get('REPLY_REUSE_MIN_WORDS', 8))
+
+# Candidates sharing a band that are compared per lookup (most recently approved first)
+REPLY_REUSE_MAX_CANDIDATES = 200
+
+# Draft replies that were never approved are deleted after this many days
+REPLY_DRAFT_TTL_DAYS = int(os.environ.get('REPLY_DRAFT_TTL_DAYS', 30))
+
+BANDS = 4
+BAND_BITS = 64 // BANDS
+
+_EMAIL_ADDRESS = re.compile(r"\S+@\S+\.\w+")
+_URL = re.compile(r"(?:https?://|www\.)\S+")
+_NUMBER = re.compile(r"\d+(?:[.,:/-]\d+)*")
+_NON_WORD = re.compile(r"[^\w#@]+")
+
+_stats_lock = threading.Lock()
+_stats = {
+    'lookups': 0,
+    'reused': 0,
+    'skipped': 0,
+    'saved': 0,
+    'approved': 0,
+    'lookup_seconds': 0.0,
+    'max_lookup_seconds': 0.0,
+}
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def compress(text):
+    return zlib.compress(text.encode('utf-8'), 6)
+
+
+def decompress(data):
+    return zlib.decompress(data).decode('utf-8')
+
+
+def normalize_email(text):
+    """
+    Reduce an email to the words that identify what it asks.
+
+    Quoted history, signatures and boilerplate are removed as for the prompt;
+    email addresses, links and numbers (order numbers, dates, amounts) are
+    masked so they do not make otherwise identical emails differ.
+    """
+    text, _ = compact_email(text, None)
+    text = text.lower()
+    text = _EMAIL_ADDRESS.sub(" @ ", text)
+    text = _URL.sub(" url ", text)
+    text = _NUMBER.sub(" # ", text)
+    return " ".join(_NON_WORD.sub(" ", text).split())
+
+
+def simhash(words):
+    """
+    Return the 64-bit SimHash of a list of words, each weighted by its count.
+
+    Single words rather than shingles: customer emails are short, and a
+    changed word would otherwise change two or three features.
+    """
+    features = Counter(words)
+    totals = [0] * 64
+    for feature, weight in features.items():
+        value = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(64):
+            totals[bit] += weight if value >> bit & 1 else -weight
+    return sum(1 << bit for bit in range(64) if totals[bit] > 0)
+
+
+def bands(fingerprint):
+    """Split a fingerprint into its BANDS indexed parts"""
+    mask = (1 << BAND_BITS) - 1
+    return [(fingerprint >> (band * BAND_BITS)) & mask for band in range(BANDS)]
+
+
+def _signed(fingerprint):
+    # SQLite and PostgreSQL integers are signed 64-bit
+    return fingerprint - (1 << 64) if fingerprint >= 1 << 63 else fingerprint
+
+
+def _unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def email_identifiers(text):
+    """
+    Return a digest of the identifiers normalize_email masks.
+
+    Email addresses, links and numbers (order numbers, dates, amounts) are
+    what ties a reply to one customer's case, so two emails only share a
+    reply if they have exactly the same ones. Emails without any share a
+    digest too.
+    """
+    text, _ = compact_email(text, None)
+    text = text.lower()
+    identifiers = set(_EMAIL_ADDRESS.findall(text))
+    text = _EMAIL_ADDRESS.sub(" ", text)
+    identifiers.update(_URL.findall(text))
+    text = _URL.sub(" ", text)
+    identifiers.update(_NUMBER.findall(text))
+    return hashlib.blake2b("\n".join(sorted(identifiers)).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def fingerprint_email(params):
+    """
+    Return the SimHash of the request's email, or None if it is too short to match.
+
+    Computed once per request and kept in params['fingerprint'], with the
+    digest of its identifiers in params['identifiers'].
+    """
+    if 'fingerprint' not in params:
+        words = normalize_email(params['customer_email']).split()
+        params['fingerprint'] = simhash(words) if len(words) >= REPLY_REUSE_MIN_WORDS else None
+        params['identifiers'] = email_identifiers(params['customer_email'])
+    return params['fingerprint']
+
+
+def find_reusable_reply(params):
+    """
+    Look for an approved reply to a near-duplicate of the request's email.
+
+    The email's identifiers must be the same as those of the reply's email
+    (see email_identifiers). Revisions, requests with customer notes and
+    requests with "regenerate": true always generate. A template selected in
+    the request must match the one the reply was written with. The lookup
+    only reads; record_reply_use counts a reply once it is served.
+
+    Args:
+        params (dict): Parameters from parse_generation_request
+
+    Returns:
+        dict or None: {"reply_id", "response", "similarity" (0-1), "distance"
+                       (differing bits), "approved_at"}, or None
+    """
+    if (not REPLY_REUSE_ENABLED or params['draft_id'] or params['modification_request']
+            or params['customer_notes'] or params['regenerate']):
+        _count('skipped')
+        return None
+
+    started = time.perf_counter()
+    fingerprint = fingerprint_email(params)
+    best = None
+    if fingerprint is not None:
+        query = Reply.query.filter(
+            Reply.status == 'approved',
+            # Replies approved before identifiers were stored have none and are never reused
+            Reply.identifiers == params['identifiers'],
+            or_(*(getattr(Reply, f"band{band}") == value for band, value in enumerate(bands(fingerprint)))),
+        )
+        if params['template_id']:
+            query = query.filter(Reply.template_id == params['template_id'])
+        candidates = (query.with_entities(Reply.id, Reply.simhash, Reply.approved_at)
+                      .order_by(Reply.approved_at.desc()).limit(REPLY_REUSE_MAX_CANDIDATES).all())
+        for reply_id, value, approved_at in candidates:
+            distance = bin(fingerprint ^ _unsigned(value)).count('1')
+            # Closest first; candidates come newest first, so ties go to the latest approval
+            if distance <= REPLY_REUSE_MAX_DISTANCE and (best is None or distance < best[1]):
+                best = (reply_id, distance, approved_at)
+
+    match = None
+    if best is not None:
+        reply = db.session.get(Reply, best[0])
+        match = {
+            'reply_id': reply.id,
+            'response': decompress(reply.reply_body),
+            'similarity': round(1 - best[1] / 64, 3),
+            'distance': best[1],
+            'approved_at': reply.approved_at.isoformat(),
+        }
+
+    elapsed = time.perf_counter() - started
+    with _stats_lock:
+        _stats['lookups'] += 1
+        _stats['lookup_seconds'] += elapsed
+        _stats['max_lookup_seconds'] = max(_stats['max_lookup_seconds'], elapsed)
+        if match:
+            _stats['reused'] += 1
+    if match:
+        logger.info("Reusing approved reply", extra={'reply_id': match['reply_id'], 'distance': match['distance'],
+                                                      'lookup_ms': round(elapsed * 1000, 2)})
+    return match
+
+
+def save_reply(params, response):
+    """
+    Store a generated response as a draft reply.
+
+    A revision updates the reply of its draft session (unless that was
+    already approved); an initial generation adds a new reply.
+
+    Args:
+        params (dict): Parameters of the finished generation
+        response (str): The response shown to the user
+
+    Returns:
+        int or None: The reply id (None for a revision whose reply is unknown)
+    """
+    if params['modification_request']:
+        reply = Reply.query.filter_by(draft_id=params['draft_id']).first() if params['draft_id'] else None
+        if reply is None:
+            return None
+        if reply.status == 'draft':
+            reply.reply_body = compress(response)
+            db.session.commit()
+        return reply.id
+
+    purge_expired_replies()
+    # A reply to an email too short to fingerprint gets 0, which no lookup comes near
+    fingerprint = fingerprint_email(params) or 0
+    reply = Reply(status='draft', mode=params['model'], template_id=params['template_id'] or None,
+                  draft_id=params['draft_id'], email_body=compress(params['customer_email']),
+                  reply_body=compress(response), simhash=_signed(fingerprint),
+                  identifiers=params.get('identifiers'), uses=0,
+                  **{f"band{band}": value for band, value in enumerate(bands(fingerprint))})
+    db.session.add(reply)
+    db.session.commit()
+    _count('saved')
+    return reply.id
+
+
+def approve_reply(reply_id, response):
+    """
+    Record the final version of a reply, as sent by an agent.
+
+    A reply that is already approved (e.g. one that was reused) is left as
+    it is, since other emails may have been answered with it; the new text
+    is stored as a new approved reply to the same email.
+
+    Args:
+        reply_id (int): The reply to approve
+        response (str): The final text (may differ from the generated one)
+
+    Returns:
+        Reply or None: The approved reply, or None if it does not exist
+    """
+    reply = db.session.get(Reply, reply_id)
+    if reply is None:
+        return None
+    if reply.status == 'approved':
+        reply = Reply(mode=reply.mode, template_id=reply.template_id, draft_id=reply.draft_id,
+                      email_body=reply.email_body, simhash=reply.simhash, identifiers=reply.identifiers,
+                      band0=reply.band0, band1=reply.band1, band2=reply.band2, band3=reply.band3, uses=0)
+        db.session.add(reply)
+    reply.reply_body = compress(response)
+    reply.status = 'approved'
+    reply.approved_at = datetime.utcnow()
+    db.session.commit()
+    _count('approved')
+    return reply
+
+
+def record_reply_use(reply_id):
+    """Count a use of an approved reply that was served in place of a generation"""
+    Reply.query.filter_by(id=reply_id).update({Reply.uses: Reply.uses + 1}, synchronize_session=False)
+    db.session.commit()
+
+
+def purge_expired_replies():
+    """Delete draft replies older than REPLY_DRAFT_TTL_DAYS (in the current session)"""
+    cutoff = datetime.utcnow() - timedelta(days=REPLY_DRAFT_TTL_DAYS)
+    Reply.query.filter(Reply.status == 'draft', Reply.updated_at < cutoff).delete(synchronize_session=False)
+
+
+def reply_stats():
+    """Return lookup, reuse and approval counts and lookup latency (this worker only)"""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['lookups']
+    stats['reuse_rate'] = round(stats['reused'] / lookups, 3) if lookups else 0.0
+    stats['mean_lookup_ms'] = round(stats.pop('lookup_seconds') / lookups * 1000, 3) if lookups else 0.0
+    stats['max_lookup_ms'] = round(stats.pop('max_lookup_seconds') * 1000, 3)
+    stats['enabled'] = REPLY_REUSE_ENABLED
+    stats['max_distance'] = REPLY_REUSE_MAX_DISTANCE
+    return stats
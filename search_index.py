@@ -0,0 +1,224 @@
+"""
+Full-text search for templates.
+Keeps a SQLite FTS5 index over template titles, content and tags, updated
+incrementally whenever a template is created, updated or deleted, and returns
+BM25-ranked results with snippets. When FTS5 is not available (e.g. on a
+non-SQLite database) the caller falls back to a LIKE query.
+"""
+
+import logging
+import re
+
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import selectinload
+
+from models import db, Template
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'template_fts'
+
+# BM25 column weights: a match in the title or tags counts more than in the body
+TITLE_WEIGHT = 10.0
+CONTENT_WEIGHT = 1.0
+TAGS_WEIGHT = 5.0
+
+# Approximate number of words in a result snippet
+SNIPPET_WORDS = 16
+
+# Set by init_search_index once the FTS table is known to work
+_fts_enabled = False
+
+
+def fts_enabled():
+    """Return True if the FTS5 index is available for searching"""
+    return _fts_enabled
+
+
+def init_search_index(app):
+    """
+    Create the FTS5 table if needed and fill it if it is out of sync.
+
+    Args:
+        app (Flask): The application (the database must already be initialized)
+    """
+    global _fts_enabled
+    with app.app_context():
+        if db.engine.dialect.name != 'sqlite':
+            logger.info("Template search: FTS5 needs SQLite, using LIKE search instead")
+            return
+        try:
+            # Standalone FTS table whose rowid is the template id
+            db.session.execute(text(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+                f"USING fts5(title, content, tags, tokenize='porter unicode61')"
+            ))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning("Template search: FTS5 is not available, using LIKE search instead", extra={'error': str(e)})
+            return
+
+        _fts_enabled = True
+
+        # Rebuild if templates were changed without the index (e.g. before it existed)
+        indexed = db.session.execute(text(f"SELECT COUNT(*) FROM {FTS_TABLE}")).scalar()
+        total = db.session.query(Template.id).count()
+        if indexed != total:
+            logger.info("Template search: rebuilding index", extra={'indexed': indexed, 'templates': total})
+            rebuild_index()
+            db.session.commit()
+
+
+def attach_search_index(app):
+    """
+    Use the FTS5 table if it already exists, without creating or syncing it.
+
+    For workers that leave schema work to "flask db-upgrade" (DB_AUTO_MIGRATE=0),
+    which runs init_search_index; costs one read.
+    """
+    global _fts_enabled
+    with app.app_context():
+        if db.engine.dialect.name != 'sqlite':
+            logger.info("Template search: FTS5 needs SQLite, using LIKE search instead")
+            return
+        _fts_enabled = inspect(db.engine).has_table(FTS_TABLE)
+        if not _fts_enabled:
+            logger.warning("Template search: no index yet (run flask db-upgrade), using LIKE search instead")
+
+
+def _tags_text(template):
+    return " ".join(tag.name for tag in template.tags)
+
+
+def index_template(template):
+    """
+    Add or refresh a template in the index.
+
+    Runs in the current session, so the index change is committed (or rolled
+    back) together with the template itself. The template must have an id,
+    i.e. the session must have been flushed for new templates.
+    """
+    index_templates([template])
+
+
+def index_templates(templates):
+    """Add or refresh many templates with one statement each for all rows (see index_template)"""
+    if not _fts_enabled or not templates:
+        return
+    rows = [{'id': template.id, 'title': template.title, 'content': template.content,
+             'tags': _tags_text(template)} for template in templates]
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), [{'id': row['id']} for row in rows])
+    db.session.execute(
+        text(f"INSERT INTO {FTS_TABLE} (rowid, title, content, tags) VALUES (:id, :title, :content, :tags)"),
+        rows
+    )
+
+
+def remove_template(template_id):
+    """Remove a template from the index (in the current session)"""
+    if not _fts_enabled:
+        return
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), {'id': template_id})
+
+
+def rebuild_index():
+    """Re-index every template (in the current session)"""
+    if not _fts_enabled:
+        return
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    index_templates(Template.query.options(selectinload(Template.tags)).all())
+
+
+def build_match_query(search_term):
+    """
+    Turn free text from the search box into an FTS5 MATCH expression.
+
+    Every word must match, and the last word of a type-ahead search may be
+    incomplete, so each word is used as a quoted prefix term. Quoting also
+    keeps FTS5 operators in user input from being interpreted.
+
+    Returns:
+        str or None: The MATCH expression, or None if the term has no words
+    """
+    words = re.findall(r"\w+", search_term, flags=re.UNICODE)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def _match_filter(search_term, tag_id):
+    """
+    Build the WHERE clause shared by search_templates and count_matches.
+
+    Returns:
+        tuple: (sql, params), or (None, None) if the term has no words
+    """
+    match_query = build_match_query(search_term)
+    if match_query is None:
+        return None, None
+    sql = f"{FTS_TABLE} MATCH :query"
+    params = {'query': match_query}
+    if tag_id is not None:
+        sql += " AND rowid IN (SELECT template_id FROM template_tags WHERE tag_id = :tag_id)"
+        params['tag_id'] = tag_id
+    return sql, params
+
+
+def search_templates(search_term, limit=None, offset=0, tag_id=None):
+    """
+    Search the index, one page at a time.
+
+    Ranking, the tag filter and the page window all run in SQLite; snippets
+    are only built for the rows of the page.
+
+    Args:
+        search_term (str): Free text to search for
+        limit (int): Maximum number of results (default: all)
+        offset (int): Number of ranked results to skip
+        tag_id (int): Only return templates with this tag
+
+    Returns:
+        list: (template_id, score, snippet) tuples, best match first.
+              Lower BM25 scores are better; the score returned is negated so
+              that higher is better.
+    """
+    where, params = _match_filter(search_term, tag_id)
+    if where is None:
+        return []
+
+    sql = (
+        f"SELECT rowid, bm25({FTS_TABLE}, :title_weight, :content_weight, :tags_weight) AS rank "
+        f"FROM {FTS_TABLE} WHERE {where} ORDER BY rank LIMIT :limit OFFSET :offset"
+    )
+    params.update({
+        'title_weight': TITLE_WEIGHT,
+        'content_weight': CONTENT_WEIGHT,
+        'tags_weight': TAGS_WEIGHT,
+        # SQLite treats a negative LIMIT as no limit
+        'limit': limit if limit is not None else -1,
+        'offset': offset,
+    })
+    ranked = db.session.execute(text(sql), params).fetchall()
+    if not ranked:
+        return []
+
+    # snippet() is evaluated for every row it is selected with, before the
+    # LIMIT applies, so it is built in a second query for this page only
+    page_ids = {row[0]: index for index, row in enumerate(ranked)}
+    snippets = dict(db.session.execute(
+        text(f"SELECT rowid, snippet({FTS_TABLE}, 1, '', '', '...', :snippet_words) "
+             f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :query "
+             f"AND rowid IN ({', '.join(f':id{index}' for index in page_ids.values())})"),
+        {'query': params['query'], 'snippet_words': SNIPPET_WORDS,
+         **{f"id{index}": template_id for template_id, index in page_ids.items()}}
+    ).fetchall())
+    return [(row[0], round(-row[1], 4), snippets.get(row[0], '')) for row in ranked]
+
+
+def count_matches(search_term, tag_id=None):
+    """Return the number of templates matching a search (and tag), without ranking them"""
+    where, params = _match_filter(search_term, tag_id)
+    if where is None:
+        return 0
+    return db.session.execute(text(f"SELECT COUNT(*) FROM {FTS_TABLE} WHERE {where}"), params).scalar()
@@ -0,0 +1,474 @@
+"""
+Coalescing and cancellation of in-flight OpenAI calls.
+Identical requests (same completion cache key) that arrive while one is
+still running share that call instead of paying for their own: blocking
+callers wait for its result, and streams are fanned out chunk by chunk to
+every subscriber, late joiners first replaying what was already received.
+The upstream call is closed as soon as nobody is reading it any more. Cancel
+tokens let a newer request for the same draft stop the one it replaces; a
+blocking call's connection is shut down once every request waiting for it
+has been cancelled.
+Everything here is per worker process.
+"""
+
+import asyncio
+import threading
+
+# How often a caller waiting for another request's call checks its own cancel token (seconds)
+FOLLOWER_POLL_INTERVAL = 0.05
+
+
+class CancelToken:
+    """Flag that a request should stop, with callbacks to interrupt it"""
+
+    def __init__(self):
+        self.cancelled = False
+        self.reason = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add_callback(self, callback):
+        """Call callback() on cancel (immediately if already cancelled)"""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self, reason):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class CallCancelled(Exception):
+    """An API call that was interrupted because every request waiting for it was cancelled"""
+
+
+class CallGuard:
+    """
+    Interrupts one upstream call once every request waiting for it is cancelled.
+
+    Each waiting request is watched through its cancel token; a waiter
+    without a token keeps the call alive. The transport attaches the
+    connection the call is sent on, and detaches it when the connection goes
+    back to the pool; interrupting shuts that connection down, which stops a
+    blocking send or read in the calling thread.
+    """
+
+    def __init__(self):
+        self.aborted = False
+        self._waiting = 0
+        self._keep = False
+        self._connection = None
+        self._abort_connection = None
+        self._lock = threading.Lock()
+
+    def watch(self, token):
+        """Count a request waiting for the call (token None = one that cannot be cancelled)"""
+        with self._lock:
+            if token is None:
+                self._keep = True
+                return
+            self._waiting += 1
+        token.add_callback(self._cancelled)
+
+    def _cancelled(self):
+        with self._lock:
+            self._waiting -= 1
+            if self._keep or self._waiting > 0 or self.aborted:
+                return
+            self.aborted = True
+            connection, abort = self._connection, self._abort_connection
+        if connection is not None:
+            abort(connection)
+
+    def attach(self, connection, abort):
+        """Set the connection the call is using and how to interrupt it (at once if already aborted)"""
+        with self._lock:
+            self._connection = connection
+            self._abort_connection = abort
+            aborted = self.aborted
+        if aborted:
+            abort(connection)
+
+    def detach(self, connection):
+        """Forget a connection that was released, so interrupting never touches its next user"""
+        with self._lock:
+            if self._connection is connection:
+                self._connection = None
+
+    def check(self):
+        """Raise CallCancelled if the call was interrupted"""
+        if self.aborted:
+            raise CallCancelled("Call cancelled: every request waiting for it was cancelled")
+
+
+class _Flight:
+    """A blocking call in progress and the callers waiting for it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.guard = CallGuard()
+
+
+class _SharedStream:
+    """
+    One upstream stream read by several subscribers.
+
+    There is no reader thread: a subscriber that needs a chunk nobody has
+    received yet pulls it from upstream while the others wait for it.
+    Subscribers that join while the first one is still opening the upstream
+    call wait for it (and get its error if that fails).
+    """
+
+    def __init__(self, owner, key):
+        self.owner = owner
+        self.key = key
+        self.source = None
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.pulling = False
+        self.subscribers = 0
+        self.condition = threading.Condition()
+        self.guard = CallGuard()
+
+    def _finish(self, error=None):
+        # Called with the condition held
+        self.done = True
+        self.error = error
+        self.condition.notify_all()
+        self.owner._forget_stream(self.key, self)
+
+    def start(self, source):
+        with self.condition:
+            self.source = source
+            self.condition.notify_all()
+
+    def fail(self, error):
+        with self.condition:
+            self._finish(error)
+
+    def subscribe(self):
+        with self.condition:
+            self.subscribers += 1
+        return self._read()
+
+    def _read(self):
+        index = 0
+        try:
+            while True:
+                with self.condition:
+                    while (index >= len(self.chunks) and not self.done
+                           and (self.pulling or self.source is None)):
+                        self.condition.wait()
+                    if index < len(self.chunks):
+                        chunk = self.chunks[index]
+                        index += 1
+                    elif self.done:
+                        if self.error is not None:
+                            raise self.error
+                        return
+                    else:
+                        self.pulling = True
+                        chunk = None
+
+                if chunk is None:
+                    # Read the next chunk outside the lock so others can replay what is buffered
+                    try:
+                        chunk = next(self.source)
+                    except StopIteration:
+                        with self.condition:
+                            self.pulling = False
+                            self._finish()
+                        continue
+                    except Exception as e:
+                        with self.condition:
+                            self.pulling = False
+                            self._finish(e)
+                        raise
+                    with self.condition:
+                        self.chunks.append(chunk)
+                        self.pulling = False
+                        self.condition.notify_all()
+                    index += 1
+                yield chunk
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+                abandoned = self.subscribers == 0 and not self.done
+                if abandoned:
+                    self._finish(RuntimeError("Stream closed by all readers"))
+            if abandoned and self.source is not None:
+                # Nobody reads the rest, so stop paying for it
+                self.source.close()
+
+
+class _AsyncSharedStream:
+    """Async version of _SharedStream (for one event loop)"""
+
+    def __init__(self, owner, key):
+        self.owner = owner
+        self.key = key
+        self.source = None
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.pulling = False
+        self.subscribers = 0
+        self.condition = asyncio.Condition()
+
+    def _finish(self, error=None):
+        self.done = True
+        self.error = error
+        self.condition.notify_all()
+        self.owner._forget_stream(self.key, self)
+
+    async def start(self, source):
+        async with self.condition:
+            self.source = source
+            self.condition.notify_all()
+
+    async def fail(self, error):
+        async with self.condition:
+            self._finish(error)
+
+    def subscribe(self):
+        self.subscribers += 1
+        return self._read()
+
+    async def _read(self):
+        index = 0
+        try:
+            while True:
+                async with self.condition:
+                    while (index >= len(self.chunks) and not self.done
+                           and (self.pulling or self.source is None)):
+                        await self.condition.wait()
+                    if index < len(self.chunks):
+                        chunk = self.chunks[index]
+                        index += 1
+                    elif self.done:
+                        if self.error is not None:
+                            raise self.error
+                        return
+                    else:
+                        self.pulling = True
+                        chunk = None
+
+                if chunk is None:
+                    try:
+                        chunk = await self.source.__anext__()
+                    except StopAsyncIteration:
+                        async with self.condition:
+                            self.pulling = False
+                            self._finish()
+                        continue
+                    except BaseException as e:
+                        async with self.condition:
+                            self.pulling = False
+                            if isinstance(e, Exception):
+                                self._finish(e)
+                            else:
+                                # This reader was cancelled mid-read; another one takes over
+                                self.condition.notify_all()
+                        raise
+                    async with self.condition:
+                        self.chunks.append(chunk)
+                        self.pulling = False
+                        self.condition.notify_all()
+                    index += 1
+                yield chunk
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.done = True
+                self.error = RuntimeError("Stream closed by all readers")
+                self.owner._forget_stream(self.key, self)
+                if self.source is not None:
+                    await self.source.aclose()
+
+
+class SingleFlight:
+    """Registry of the calls in progress in this process, keyed by completion cache key"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._streams = {}
+        self._async_streams = {}
+        self._async_calls = {}
+        self._counters = {
+            'calls': 0,
+            'coalesced': 0,
+            'streams': 0,
+            'coalesced_streams': 0,
+            'cancelled_calls': 0,
+            'superseded': 0,
+        }
+
+    def count(self, name, amount=1):
+        """Add to a counter (cancelled_calls is counted by the API clients)"""
+        with self._lock:
+            self._counters[name] += amount
+
+    def call(self, key, function, cancel=None):
+        """
+        Return function(guard), or the result of an identical call already running.
+
+        The call's CallGuard interrupts it once every caller's cancel token
+        (cancel, None = not cancellable) has been cancelled. A caller waiting
+        for another one's call stops waiting as soon as its own token is
+        cancelled (raising CallCancelled); the call goes on for the others.
+        """
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._calls[key] = _Flight()
+            self._counters['calls' if leader else 'coalesced'] += 1
+        flight.guard.watch(cancel)
+
+        if not leader:
+            while not flight.done.wait(FOLLOWER_POLL_INTERVAL):
+                if cancel is not None and cancel.cancelled:
+                    raise CallCancelled(f"Stopped waiting for a shared call: {cancel.reason}")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function(flight.guard)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            flight.done.set()
+
+    def stream(self, key, open_stream, cancel=None):
+        """
+        Return an iterator over a stream, shared with identical streams in progress.
+
+        open_stream(guard) is called (in this thread) only if no identical
+        stream is running; an error it raises goes to every caller waiting
+        for it. The guard interrupts the stream once every subscriber's
+        cancel token has been cancelled (see call).
+        """
+        with self._lock:
+            shared = self._streams.get(key)
+            leader = shared is None
+            if leader:
+                shared = self._streams[key] = _SharedStream(self, key)
+            self._counters['streams' if leader else 'coalesced_streams'] += 1
+            # Subscribe while holding the registry lock so the stream cannot be abandoned in between
+            reader = shared.subscribe()
+        shared.guard.watch(cancel)
+        if leader:
+            try:
+                shared.start(open_stream(shared.guard))
+            except BaseException as e:
+                shared.fail(e if isinstance(e, Exception) else RuntimeError("Stream was cancelled"))
+                raise
+        return reader
+
+    async def acall(self, key, function):
+        """
+        Async version of call(): await function(), or an identical call already running.
+
+        The call runs as its own task, so one caller going away does not
+        cancel it for the others; it is cancelled when all of them are gone.
+        """
+        entry = self._async_calls.get(key)
+        if entry is None:
+            entry = {'task': asyncio.ensure_future(function()), 'waiters': 0}
+            self._async_calls[key] = entry
+            entry['task'].add_done_callback(lambda task: self._forget_call(key, entry))
+            self.count('calls')
+        else:
+            self.count('coalesced')
+        entry['waiters'] += 1
+        try:
+            return await asyncio.shield(entry['task'])
+        finally:
+            entry['waiters'] -= 1
+            if entry['waiters'] == 0 and not entry['task'].done():
+                entry['task'].cancel()
+
+    async def astream(self, key, open_stream):
+        """Async version of stream(); open_stream is a coroutine function returning an async iterator"""
+        shared = self._async_streams.get(key)
+        leader = shared is None
+        if leader:
+            shared = self._async_streams[key] = _AsyncSharedStream(self, key)
+        self.count('streams' if leader else 'coalesced_streams')
+        reader = shared.subscribe()
+        if leader:
+            try:
+                await shared.start(await open_stream())
+            except BaseException as e:
+                await shared.fail(e if isinstance(e, Exception) else RuntimeError("Stream was cancelled"))
+                raise
+        return reader
+
+    def _forget_call(self, key, entry):
+        if self._async_calls.get(key) is entry:
+            del self._async_calls[key]
+
+    def _forget_stream(self, key, shared):
+        with self._lock:
+            for streams in (self._streams, self._async_streams):
+                if streams.get(key) is shared:
+                    del streams[key]
+
+    def stats(self):
+        """Return coalescing and cancellation counters and the calls in progress"""
+        with self._lock:
+            counters = dict(self._counters)
+            in_flight = len(self._calls) + len(self._streams) + len(self._async_streams)
+        return {**counters, 'in_flight': in_flight + len(self._async_calls)}
+
+
+class DraftRequests:
+    """The request currently working on each draft; a newer one cancels the older"""
+
+    def __init__(self, flights):
+        self.flights = flights
+        self._lock = threading.Lock()
+        self._active = {}
+
+    def begin(self, draft_id):
+        """Return a cancel token for a new request, cancelling the previous one for this draft"""
+        token = CancelToken()
+        if not draft_id:
+            return token
+        with self._lock:
+            previous = self._active.get(draft_id)
+            self._active[draft_id] = token
+        if previous is not None:
+            previous.cancel("a newer request for this draft was made")
+            self.flights.count('superseded')
+        return token
+
+    def end(self, draft_id, token):
+        """Forget a finished request (unless a newer one has taken its place)"""
+        if not draft_id:
+            return
+        with self._lock:
+            if self._active.get(draft_id) is token:
+                del self._active[draft_id]
+
+
+# Calls and draft requests of this process
+single_flight = SingleFlight()
+draft_requests = DraftRequests(single_flight)
@@ -14,6 +14,8 @@ document.addEventListener('DOMContentLoaded', function() {
     const modificationRequestInput = document.getElementById('modificationRequest');
     const generateButton = document.getElementById('generateBtn');
     const modifyButton = document.getElementById('modifyBtn');
+    const approveButton = document.getElementById('approveBtn');
+    const regenerateButton = document.getElementById('regenerateBtn');
     const statusElement = document.getElementById('status');
     
     // Template selection elements
@@ -21,11 +23,23 @@ document.addEventListener('DOMContentLoaded', function() {
     const templateSearchInput = document.getElementById('templateSearchInput');
     const tagFilter = document.getElementById('tagFilter');
     const searchTemplatesBtn = document.getElementById('searchTemplatesBtn');
+    const suggestTemplatesBtn = document.getElementById('suggestTemplatesBtn');
     const templatePreview = document.getElementById('templatePreview');
     
     // Model selection elements
     const modelOptions = document.querySelectorAll('input[name="model-selection"]');
     const tokenLimitSelect = document.getElementById('token-limit');
+    const bypassCacheCheckbox = document.getElementById('bypassCache');
+    const keepOriginalCheckbox = document.getElementById('keepOriginal');
+    
+    // Server-side draft of the current response; modifications only send the change
+    let currentDraft = null;
+    
+    // Stored reply of the current response; approving it lets near-duplicate emails reuse it
+    let currentReplyId = null;
+    
+    // Aborts the generation in progress (a new one replaces it, Escape or leaving the page stops it)
+    let activeGeneration = null;
     
     // Template management elements
     const templateIdInput = document.getElementById('templateId');
@@ -41,6 +55,12 @@ document.addEventListener('DOMContentLoaded', function() {
     const templateListSearch = document.getElementById('templateListSearch');
     const templateListTagFilter = document.getElementById('templateListTagFilter');
     const searchTemplateListBtn = document.getElementById('searchTemplateListBtn');
+    const loadMoreTemplatesBtn = document.getElementById('loadMoreTemplatesBtn');
+    
+    // Template listings are paginated; these hold the cursor for the next page
+    const LOAD_MORE_VALUE = '__load_more__';
+    let selectorNextCursor = null;
+    let listNextCursor = null;
     
     // Tab navigation elements
     const tabButtons = document.querySelectorAll('.tab-btn');
@@ -130,7 +150,8 @@ document.addEventListener('DOMContentLoaded', function() {
     // ========== EMAIL GENERATION FUNCTIONS ==========
     
     // Function to handle the initial generation of an AI response
-    function handleGenerateResponse() {
+    // (regenerate skips the approved reply of a near-duplicate email)
+    function handleGenerateResponse(regenerate = false) {
         // get notes
         const customerNotes = customerNotesInput.value.trim();
 
@@ -171,33 +192,35 @@ document.addEventListener('DOMContentLoaded', function() {
             customer_email: customerEmail,
             template_id: selectedTemplateId,
             model: selectedModel,
-            token_limit: tokenLimit
+            token_limit: tokenLimit,
+            bypass_cache: bypassCacheCheckbox ? bypassCacheCheckbox.checked : false,
+            keep_original: keepOriginalCheckbox ? keepOriginalCheckbox.checked : false,
+            regenerate: regenerate
         };
         
-        // Send the API request
-        fetch('/generate_response', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify(data)
-        })
-        .then(response => {
-            // First check if the response is OK (status 200-299)
-            if (!response.ok) {
-                return response.json().then(errorData => {
-                    throw new Error(errorData.error || 'Unknown error occurred');
-                });
+        // Stream the response into the output box as it is generated
+        aiResponseOutput.value = '';
+        currentDraft = null;
+        currentReplyId = null;
+        regenerateButton.style.display = 'none';
+        streamGeneration(data)
+        .then(result => {
+            rememberDraft(result, data);
+            currentReplyId = result.reply_id;
+            if (result.reused) {
+                // Offer a fresh generation in case the approved reply does not fit this email
+                regenerateButton.style.display = '';
+                const similarity = Math.round(result.reused.similarity * 100);
+                setStatus(`Reused an approved reply to a similar email (${similarity}% similar).`, 'status-success');
+                return;
             }
-            // If response is OK, parse the JSON
-            return response.json();
-        })
-        .then(data => {
-            // Display the generated response
-            aiResponseOutput.value = data.response;
-            setStatus('Response generated successfully!', 'status-success');
+            setStatus(`Response generated successfully!${compactionNote(result)}${fallbackNote(result)}`, 'status-success');
         })
         .catch(error => {
+            if (error.name === 'AbortError') {
+                setStatus('Generation stopped.', 'status-error');
+                return;
+            }
             // Handle any errors that occurred during the fetch
             console.error('Error:', error);
             setStatus(`Error: ${error.message}`, 'status-error');
@@ -258,57 +281,247 @@ document.addEventListener('DOMContentLoaded', function() {
             previous_response: previousResponse,
             modification_request: modificationRequest,
             model: selectedModel,
-            token_limit: tokenLimit
+            token_limit: tokenLimit,
+            bypass_cache: bypassCacheCheckbox ? bypassCacheCheckbox.checked : false,
+            keep_original: keepOriginalCheckbox ? keepOriginalCheckbox.checked : false
         };
         
-        // Send the API request
-        fetch('/generate_response', {
+        // Stream the modified response into the output box as it is generated
+        aiResponseOutput.value = '';
+        streamGeneration(draftRevision(data))
+        .catch(error => {
+            // The draft expired on the server: fall back to sending everything
+            if (error.status === 404 && currentDraft) {
+                currentDraft = null;
+                aiResponseOutput.value = '';
+                return streamGeneration(data);
+            }
+            throw error;
+        })
+        .then(result => {
+            rememberDraft(result, data);
+            currentReplyId = result.reply_id;
+            regenerateButton.style.display = 'none';
+            // Clear the modification request input
+            modificationRequestInput.value = '';
+            setStatus(`Response modified successfully!${compactionNote(result)}${fallbackNote(result)}`, 'status-success');
+        })
+        .catch(error => {
+            // Handle any errors; keep the previous response so it can be retried
+            aiResponseOutput.value = previousResponse;
+            if (error.name === 'AbortError') {
+                setStatus('Modification stopped.', 'status-error');
+                return;
+            }
+            console.error('Error:', error);
+            setStatus(`Error: ${error.message}`, 'status-error');
+        })
+        .finally(() => {
+            // Re-enable buttons
+            setButtonsEnabled(true);
+        });
+    }
+    
+    // Function to approve the response as shown, so near-duplicate emails get it back
+    function handleApproveReply() {
+        const finalResponse = aiResponseOutput.value.trim();
+        if (!currentReplyId || !finalResponse) {
+            setStatus('No response to approve. Please generate a response first.', 'status-error');
+            return;
+        }
+        
+        setStatus('Approving reply...', 'status-loading');
+        setButtonsEnabled(false);
+        fetch(`/api/replies/${currentReplyId}/approve`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify(data)
+            body: JSON.stringify({ response: finalResponse })
         })
-        .then(response => {
-            // Check if the response is OK
+        .then(response => response.json().then(result => {
             if (!response.ok) {
-                return response.json().then(errorData => {
-                    throw new Error(errorData.error || 'Unknown error occurred');
-                });
+                throw new Error(result.error || 'Unknown error occurred');
             }
-            return response.json();
-        })
-        .then(data => {
-            // Display the modified response
-            aiResponseOutput.value = data.response;
-            // Clear the modification request input
-            modificationRequestInput.value = '';
-            setStatus('Response modified successfully!', 'status-success');
-        })
+            // An approved (e.g. reused) reply is kept; approving it again stored a new one
+            currentReplyId = result.id;
+            setStatus('Reply approved! Similar emails will get it without a new generation.', 'status-success');
+        }))
         .catch(error => {
-            // Handle any errors
             console.error('Error:', error);
             setStatus(`Error: ${error.message}`, 'status-error');
         })
         .finally(() => {
-            // Re-enable buttons
             setButtonsEnabled(true);
         });
     }
     
-    // ========== TEMPLATE SELECTOR FUNCTIONS ==========
+    // Function to remember the draft a response belongs to
+    function rememberDraft(result, data) {
+        if (!result || !result.draft_id) {
+            currentDraft = null;
+            return;
+        }
+        currentDraft = {
+            id: result.draft_id,
+            model: data.model,
+            customerEmail: data.customer_email,
+            customerNotes: data.customer_notes,
+            response: result.response
+        };
+    }
     
-    // Function to load templates for the selector dropdown
-    function loadTemplatesForSelector() {
-        // Clear existing options except the first one (no template)
-        while (templateSelector.options.length > 1) {
-            templateSelector.remove(1);
+    // Function to turn a modification into a draft revision when the draft still matches
+    // the form (same email, notes and model); only the change is sent to the server
+    function draftRevision(data) {
+        if (!currentDraft ||
+            currentDraft.model !== data.model ||
+            currentDraft.customerEmail !== data.customer_email ||
+            currentDraft.customerNotes !== data.customer_notes) {
+            return data;
         }
-        
-        // Get search term and tag filter if any
-        const searchTerm = templateSearchInput.value.trim();
-        const tagFilterValue = tagFilter.value;
-        
+        const revision = {
+            draft_id: currentDraft.id,
+            modification_request: data.modification_request,
+            model: data.model,
+            token_limit: data.token_limit,
+            bypass_cache: data.bypass_cache
+        };
+        // Send the response text only if it was edited by hand
+        if (data.previous_response !== currentDraft.response.trim()) {
+            revision.previous_response = data.previous_response;
+        }
+        return revision;
+    }
+    
+    // Function to describe how much of the email was left out of the prompt
+    function compactionNote(result) {
+        if (!result || !result.compaction || !result.compaction.tokens_saved) {
+            return '';
+        }
+        return ` (${result.compaction.tokens_saved} tokens of quoted text, signatures and footers left out)`;
+    }
+
+    // Note a stage answered by a fallback model instead of the selected one (see hedging.py)
+    function fallbackNote(result) {
+        const stages = (result && result.stages) || [];
+        const stage = stages.find(stage => stage.answered_by && stage.answered_by !== stage.model);
+        if (!stage) {
+            return '';
+        }
+        return ` Answered by ${stage.answered_by} instead of ${stage.model}.`;
+    }
+    
+    // Function to stop the generation in progress; the server stops the OpenAI call too
+    function stopGeneration() {
+        if (activeGeneration) {
+            activeGeneration.abort();
+            activeGeneration = null;
+        }
+    }
+    
+    // Function to request a response from the streaming endpoint
+    // Text is appended to the output box as it arrives; the promise resolves
+    // with the final "done" event once the server sends the cleaned-up response
+    // (or rejects with an AbortError if the generation is stopped)
+    function streamGeneration(data) {
+        stopGeneration();
+        const controller = new AbortController();
+        activeGeneration = controller;
+        return fetch('/generate_response/stream', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(data),
+            signal: controller.signal
+        })
+        .then(response => {
+            // Validation errors are returned as regular JSON before the stream starts
+            if (!response.ok) {
+                return response.json().then(errorData => {
+                    const error = new Error(errorData.error || 'Unknown error occurred');
+                    error.status = response.status;
+                    throw error;
+                });
+            }
+            
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let finished = false;
+            let result = null;
+            
+            // Read chunks until the stream ends
+            function readChunk() {
+                return reader.read().then(({ done, value }) => {
+                    if (value) {
+                        buffer += decoder.decode(value, { stream: true });
+                    }
+                    
+                    // Events are separated by a blank line
+                    let separatorIndex;
+                    while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+                        const rawEvent = buffer.slice(0, separatorIndex);
+                        buffer = buffer.slice(separatorIndex + 2);
+                        handleStreamEvent(rawEvent);
+                        if (finished) {
+                            return result;
+                        }
+                    }
+                    
+                    if (done) {
+                        throw new Error('Connection closed before the response was complete');
+                    }
+                    return readChunk();
+                });
+            }
+            
+            // Apply a single server-sent event to the UI
+            function handleStreamEvent(rawEvent) {
+                let eventName = 'message';
+                let eventData = '';
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event: ')) {
+                        eventName = line.slice(7);
+                    } else if (line.startsWith('data: ')) {
+                        eventData += line.slice(6);
+                    }
+                });
+                const payload = eventData ? JSON.parse(eventData) : {};
+                
+                if (eventName === 'delta') {
+                    aiResponseOutput.value += payload.content;
+                    aiResponseOutput.scrollTop = aiResponseOutput.scrollHeight;
+                } else if (eventName === 'stage') {
+                    const stageLabel = payload.cached ? `${payload.label} (reused)` : payload.label;
+                    setStatus(`${stageLabel} with ${payload.model}...`, 'status-loading');
+                } else if (eventName === 'done') {
+                    // Replace the raw text with the cleaned-up version
+                    aiResponseOutput.value = payload.response;
+                    result = payload;
+                    finished = true;
+                    reader.cancel();
+                } else if (eventName === 'error') {
+                    finished = true;
+                    reader.cancel();
+                    throw new Error(payload.error || 'Unknown error occurred');
+                }
+            }
+            
+            return readChunk();
+        })
+        .finally(() => {
+            if (activeGeneration === controller) {
+                activeGeneration = null;
+            }
+        });
+    }
+    
+    // ========== TEMPLATE SELECTOR FUNCTIONS ==========
+    
+    // Function to fetch one page of template summaries (no content)
+    function fetchTemplatePage(searchTerm, tagFilterValue, cursor) {
         // Construct query string
         let url = '/api/templates';
         const queryParams = [];
@@ -321,26 +534,70 @@ document.addEventListener('DOMContentLoaded', function() {
             queryParams.push(`tag=${encodeURIComponent(tagFilterValue)}`);
         }
         
+        if (cursor) {
+            queryParams.push(`cursor=${encodeURIComponent(cursor)}`);
+        }
+        
         if (queryParams.length > 0) {
             url += '?' + queryParams.join('&');
         }
         
-        // Fetch templates from the server
-        fetch(url)
+        return fetch(url)
             .then(response => {
                 if (!response.ok) {
                     throw new Error('Failed to load templates');
                 }
                 return response.json();
-            })
-            .then(templates => {
+            });
+    }
+    
+    // Function to load templates for the selector dropdown
+    // Pass true to append the next page instead of starting over
+    function loadTemplatesForSelector(append) {
+        const isAppend = append === true;
+        
+        if (isAppend) {
+            // Remove the "load more" entry; it is re-added if there are more pages
+            const loadMoreOption = templateSelector.querySelector(`option[value="${LOAD_MORE_VALUE}"]`);
+            if (loadMoreOption) {
+                loadMoreOption.remove();
+            }
+        } else {
+            // Clear existing options except the first one (no template)
+            while (templateSelector.options.length > 1) {
+                templateSelector.remove(1);
+            }
+            selectorNextCursor = null;
+        }
+        
+        // Get search term and tag filter if any
+        const searchTerm = templateSearchInput.value.trim();
+        const tagFilterValue = tagFilter.value;
+        
+        // Fetch templates from the server
+        fetchTemplatePage(searchTerm, tagFilterValue, isAppend ? selectorNextCursor : null)
+            .then(page => {
                 // Add each template as an option in the selector
-                templates.forEach(template => {
+                page.templates.forEach(template => {
                     const option = document.createElement('option');
                     option.value = template.id;
                     option.textContent = template.title;
+                    // Search results include a snippet of the matching text
+                    if (template.snippet) {
+                        option.title = template.snippet;
+                    }
                     templateSelector.appendChild(option);
                 });
+                
+                // Offer to load the next page if there is one
+                selectorNextCursor = page.next_cursor;
+                if (selectorNextCursor) {
+                    const option = document.createElement('option');
+                    option.value = LOAD_MORE_VALUE;
+                    option.textContent = 'Load more templates...';
+                    option.className = 'load-more-option';
+                    templateSelector.appendChild(option);
+                }
             })
             .catch(error => {
                 console.error('Error loading templates:', error);
@@ -348,10 +605,70 @@ document.addEventListener('DOMContentLoaded', function() {
             });
     }
     
+    // Function to fill the selector with the templates that best match the customer email
+    function suggestTemplatesForSelector() {
+        const customerEmail = customerEmailInput.value.trim();
+        if (!customerEmail) {
+            setStatus('Paste the customer email first to get template suggestions', 'status-error');
+            return;
+        }
+        
+        fetch('/api/templates/suggest', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ customer_email: customerEmail })
+        })
+        .then(response => {
+            return response.json().then(data => {
+                if (!response.ok) {
+                    throw new Error(data.error || 'Failed to suggest templates');
+                }
+                return data;
+            });
+        })
+        .then(data => {
+            // Clear existing options except the first one (no template)
+            while (templateSelector.options.length > 1) {
+                templateSelector.remove(1);
+            }
+            selectorNextCursor = null;
+            
+            data.templates.forEach(template => {
+                const option = document.createElement('option');
+                option.value = template.id;
+                option.textContent = template.title;
+                option.title = `Matches: ${template.matched.join(', ')}`;
+                templateSelector.appendChild(option);
+            });
+            
+            if (data.templates.length === 0) {
+                setStatus('No matching templates found', 'status-error');
+            } else {
+                // Preview the best match
+                templateSelector.value = data.templates[0].id;
+                previewTemplate();
+            }
+        })
+        .catch(error => {
+            console.error('Error suggesting templates:', error);
+            setStatus(`Error: ${error.message}`, 'status-error');
+        });
+    }
+    
     // Function to preview the selected template
     function previewTemplate() {
         const selectedTemplateId = templateSelector.value;
         
+        // The "load more" entry fetches the next page instead of selecting a template
+        if (selectedTemplateId === LOAD_MORE_VALUE) {
+            templateSelector.value = '';
+            loadTemplatesForSelector(true);
+            templatePreview.innerHTML = '<p class="no-preview">Select a template to see preview</p>';
+            return;
+        }
+        
         // If no template is selected, show the "no preview" message
         if (!selectedTemplateId) {
             templatePreview.innerHTML = '<p class="no-preview">Select a template to see preview</p>';
@@ -449,41 +766,26 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
-    // Function to load all templates for the management table
-    function loadTemplates() {
-        // Clear existing table rows
-        templatesTable.innerHTML = '';
+    // Function to load templates for the management table
+    // Pass true to append the next page instead of starting over
+    function loadTemplates(append) {
+        const isAppend = append === true;
+        
+        if (!isAppend) {
+            // Clear existing table rows
+            templatesTable.innerHTML = '';
+            listNextCursor = null;
+        }
+        loadMoreTemplatesBtn.style.display = 'none';
         
         // Get search term and tag filter if any
         const searchTerm = templateListSearch.value.trim();
         const tagFilterValue = templateListTagFilter.value;
         
-        // Construct query string
-        let url = '/api/templates';
-        const queryParams = [];
-        
-        if (searchTerm) {
-            queryParams.push(`search=${encodeURIComponent(searchTerm)}`);
-        }
-        
-        if (tagFilterValue) {
-            queryParams.push(`tag=${encodeURIComponent(tagFilterValue)}`);
-        }
-        
-        if (queryParams.length > 0) {
-            url += '?' + queryParams.join('&');
-        }
-        
         // Fetch templates from the server
-        fetch(url)
-            .then(response => {
-                if (!response.ok) {
-                    throw new Error('Failed to load templates');
-                }
-                return response.json();
-            })
-            .then(templates => {
-                if (templates.length === 0) {
+        fetchTemplatePage(searchTerm, tagFilterValue, isAppend ? listNextCursor : null)
+            .then(page => {
+                if (page.templates.length === 0 && !isAppend) {
                     // No templates found
                     const row = templatesTable.insertRow();
                     const cell = row.insertCell(0);
@@ -495,12 +797,18 @@ document.addEventListener('DOMContentLoaded', function() {
                 }
                 
                 // Add each template as a row in the table
-                templates.forEach(template => {
+                page.templates.forEach(template => {
                     const row = templatesTable.insertRow();
                     
                     // Title cell
                     const titleCell = row.insertCell(0);
                     titleCell.textContent = template.title;
+                    if (template.snippet) {
+                        const snippet = document.createElement('div');
+                        snippet.className = 'template-snippet';
+                        snippet.textContent = template.snippet;
+                        titleCell.appendChild(snippet);
+                    }
                     
                     // Tags cell
                     const tagsCell = row.insertCell(1);
@@ -534,6 +842,12 @@ document.addEventListener('DOMContentLoaded', function() {
                     actionsCell.appendChild(editBtn);
                     actionsCell.appendChild(deleteBtn);
                 });
+                
+                // Show the "load more" button if there is another page
+                listNextCursor = page.next_cursor;
+                if (listNextCursor) {
+                    loadMoreTemplatesBtn.style.display = '';
+                }
             })
             .catch(error => {
                 console.error('Error loading templates:', error);
@@ -683,17 +997,31 @@ document.addEventListener('DOMContentLoaded', function() {
     function setButtonsEnabled(enabled) {
         generateButton.disabled = !enabled;
         modifyButton.disabled = !enabled;
+        regenerateButton.disabled = !enabled;
+        // Only a response with a stored reply can be approved
+        approveButton.disabled = !enabled || !currentReplyId;
     }
     
     // ========== EVENT LISTENERS ==========
     
     // Email generation buttons
-    generateButton.addEventListener('click', handleGenerateResponse);
+    generateButton.addEventListener('click', () => handleGenerateResponse());
     modifyButton.addEventListener('click', handleModifyResponse);
+    approveButton.addEventListener('click', handleApproveReply);
+    regenerateButton.addEventListener('click', () => handleGenerateResponse(true));
+    
+    // Escape stops a generation; leaving the page stops it so nobody pays for an unread response
+    document.addEventListener('keydown', function(event) {
+        if (event.key === 'Escape') {
+            stopGeneration();
+        }
+    });
+    window.addEventListener('pagehide', stopGeneration);
     
     // Template selector events
     templateSelector.addEventListener('change', previewTemplate);
     searchTemplatesBtn.addEventListener('click', loadTemplatesForSelector);
+    suggestTemplatesBtn.addEventListener('click', suggestTemplatesForSelector);
     
     // Token limit change event
     if (tokenLimitSelect) {
@@ -706,6 +1034,7 @@ document.addEventListener('DOMContentLoaded', function() {
     saveTemplateBtn.addEventListener('click', saveTemplate);
     clearTemplateBtn.addEventListener('click', clearTemplateForm);
     searchTemplateListBtn.addEventListener('click', loadTemplates);
+    loadMoreTemplatesBtn.addEventListener('click', () => loadTemplates(true));
     
     // Clear the status when the user starts typing in any field
     [customerEmailInput, modificationRequestInput].forEach(element => {
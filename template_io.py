@@ -0,0 +1,336 @@
+"""
+Bulk import and export of templates.
+Templates are read from and written to JSONL or CSV as streams, so files of
+any size use constant memory. Imports work in batches: each batch looks up
+its existing templates (by title) and tags with one query each, inserts the
+missing tags and new templates in bulk and commits once, then updates the
+search and suggestion indexes for the whole batch.
+"""
+
+import csv
+import io
+import json
+import logging
+import os
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload
+
+import search_index
+from models import db, Tag, Template, template_tags
+from recommend import recommender
+
+logger = logging.getLogger(__name__)
+
+# Templates per import transaction and per export query
+IMPORT_BATCH_SIZE = int(os.environ.get('TEMPLATE_IMPORT_BATCH_SIZE', 500))
+EXPORT_BATCH_SIZE = 500
+
+# Column order of CSV exports; imports only need title and content
+CSV_FIELDS = ['id', 'title', 'content', 'tags', 'created_at', 'updated_at']
+
+# Template.title is a String(100)
+MAX_TITLE_LENGTH = 100
+
+# Import errors listed in the summary (the count covers all of them)
+MAX_REPORTED_ERRORS = 100
+
+# Size of the chunks an export is streamed in
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+FORMATS = ('jsonl', 'csv')
+
+# Databases with INSERT ... ON CONFLICT DO NOTHING, for tags created by two workers at once
+_UPSERT_DIALECTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def detect_format(filename=None, requested=None):
+    """
+    Pick the file format from an explicit choice or a file name.
+
+    Returns:
+        str: "jsonl" or "csv"
+
+    Raises:
+        ValueError: If the requested format is not supported
+    """
+    if requested:
+        requested = requested.lower()
+        if requested == 'ndjson':
+            requested = 'jsonl'
+        if requested not in FORMATS:
+            raise ValueError(f"Unsupported format {requested!r} (use jsonl or csv)")
+        return requested
+    if filename and filename.lower().endswith('.csv'):
+        return 'csv'
+    return 'jsonl'
+
+
+def resolve_tags(names):
+    """
+    Return the tags with the given names, creating the missing ones.
+
+    Runs one SELECT for all names and inserts the missing tags with one
+    statement that skips names another worker created in the meantime.
+
+    Args:
+        names (iterable): Tag names; blanks are ignored
+
+    Returns:
+        dict: Tag by name
+    """
+    names = {name.strip() for name in names if isinstance(name, str) and name.strip()}
+    if not names:
+        return {}
+    tags = {tag.name: tag for tag in Tag.query.filter(Tag.name.in_(names))}
+    missing = sorted(names - tags.keys())
+    if not missing:
+        return tags
+    dialect = db.engine.dialect.name
+    if dialect in _UPSERT_DIALECTS:
+        insert = _UPSERT_DIALECTS[dialect]
+        db.session.execute(insert(Tag).values([{'name': name} for name in missing])
+                           .on_conflict_do_nothing(index_elements=['name']))
+        tags.update((tag.name, tag) for tag in Tag.query.filter(Tag.name.in_(missing)))
+    else:
+        new_tags = [Tag(name=name) for name in missing]
+        db.session.add_all(new_tags)
+        tags.update((tag.name, tag) for tag in new_tags)
+    return tags
+
+
+def tag_list(tags):
+    """Normalize tags given as a list or a comma-separated string (order kept, duplicates removed)"""
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    seen = []
+    for name in tags or []:
+        name = name.strip() if isinstance(name, str) else ''
+        if name and name not in seen:
+            seen.append(name)
+    return seen
+
+
+def _validate(item):
+    """Return (fields, None) for a usable import record or (None, error)"""
+    if not isinstance(item, dict):
+        return None, "not an object"
+    title = item.get('title')
+    content = item.get('content')
+    if not isinstance(title, str) or not title.strip() or not isinstance(content, str) or not content.strip():
+        return None, "title and content are required"
+    title = title.strip()
+    if len(title) > MAX_TITLE_LENGTH:
+        return None, f"title is longer than {MAX_TITLE_LENGTH} characters"
+    tags = item.get('tags')
+    if tags is not None and not isinstance(tags, (str, list)):
+        return None, "tags must be a list or a comma-separated string"
+    return {'title': title, 'content': content, 'tags': tag_list(tags)}, None
+
+
+def read_jsonl(lines):
+    """
+    Parse JSONL import records.
+
+    Yields:
+        tuple: (line number, fields or None, error or None)
+    """
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_number, None, f"invalid JSON: {e}"
+            continue
+        fields, error = _validate(item)
+        yield line_number, fields, error
+
+
+def read_csv(text_file):
+    """
+    Parse CSV import records (header row with at least title and content).
+
+    Yields:
+        tuple: (line number, fields or None, error or None)
+    """
+    reader = csv.DictReader(text_file)
+    for row in reader:
+        fields, error = _validate(row)
+        yield reader.line_num, fields, error
+
+
+def read_records(stream, file_format):
+    """Parse a binary stream of JSONL or CSV import records (see read_jsonl)"""
+    text_file = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='' if file_format == 'csv' else None)
+    return read_csv(text_file) if file_format == 'csv' else read_jsonl(text_file)
+
+
+def _import_batch(batch):
+    """Upsert one batch of (line number, fields) in a single transaction; returns per-record counts"""
+    counts = {'created': 0, 'updated': 0, 'unchanged': 0, 'duplicates': 0}
+
+    # The last record wins when a title appears twice in the batch
+    by_title = {}
+    for _, fields in batch:
+        by_title[fields['title']] = fields
+
+    # Existing templates with these titles; the oldest one is updated when titles repeat
+    existing = {}
+    for template in (Template.query.options(selectinload(Template.tags))
+                     .filter(Template.title.in_(by_title)).order_by(Template.id)):
+        existing.setdefault(template.title, template)
+    tags = resolve_tags(name for fields in by_title.values() for name in fields['tags'])
+
+    changed = []
+    for title, fields in by_title.items():
+        template = existing.get(title)
+        template_tags_list = [tags[name] for name in fields['tags']]
+        if template is None:
+            template = Template(title=title, content=fields['content'], tags=template_tags_list)
+            db.session.add(template)
+            counts['created'] += 1
+        elif template.content == fields['content'] and {tag.name for tag in template.tags} == set(fields['tags']):
+            counts['unchanged'] += 1
+            continue
+        else:
+            template.content = fields['content']
+            template.tags = template_tags_list
+            counts['updated'] += 1
+        changed.append(template)
+    # Records replaced by a later record with the same title
+    counts['duplicates'] = len(batch) - len(by_title)
+
+    try:
+        # Flushed first so new templates have ids for the search index
+        db.session.flush()
+        search_index.index_templates(changed)
+        entries = [(template.id, template.title, template.content, [tag.name for tag in template.tags])
+                   for template in changed]
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if entries:
+        recommender.update_many(entries)
+    # Keep memory flat over large imports
+    db.session.expunge_all()
+    return counts
+
+
+def import_templates(records, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Create or update templates, matched by title.
+
+    Needs an app context. Each batch is one transaction, so a failure leaves
+    earlier batches imported.
+
+    Args:
+        records (iterable): (line number, fields or None, error or None) from read_records
+        batch_size (int): Records per transaction
+
+    Returns:
+        dict: Counts of created, updated, unchanged, duplicate (same title
+              later in the batch) and invalid records, and the first errors
+              as {"line": ..., "error": ...}
+    """
+    summary = {'created': 0, 'updated': 0, 'unchanged': 0, 'duplicates': 0, 'invalid': 0, 'errors': []}
+    batch = []
+
+    def flush():
+        for key, count in _import_batch(batch).items():
+            summary[key] += count
+        batch.clear()
+
+    for line_number, fields, error in records:
+        if error:
+            summary['invalid'] += 1
+            if len(summary['errors']) < MAX_REPORTED_ERRORS:
+                summary['errors'].append({'line': line_number, 'error': error})
+            continue
+        batch.append((line_number, fields))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    logger.info("Templates imported", extra={f"templates_{key}": value for key, value in summary.items()
+                                             if key != 'errors'})
+    return summary
+
+
+def export_records(batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield every template as a dictionary, oldest first.
+
+    Reads plain rows in id order, one page and one tag query at a time,
+    so no ORM objects pile up in the session. Needs an app context.
+    """
+    last_id = 0
+    while True:
+        rows = (db.session.query(Template.id, Template.title, Template.content,
+                                 Template.created_at, Template.updated_at)
+                .filter(Template.id > last_id).order_by(Template.id).limit(batch_size).all())
+        if not rows:
+            return
+        ids = [row.id for row in rows]
+        tags = {}
+        for template_id, name in (db.session.query(template_tags.c.template_id, Tag.name)
+                                  .join(Tag, Tag.id == template_tags.c.tag_id)
+                                  .filter(template_tags.c.template_id.in_(ids)).order_by(Tag.name)):
+            tags.setdefault(template_id, []).append(name)
+        for row in rows:
+            yield {
+                'id': row.id,
+                'title': row.title,
+                'content': row.content,
+                'tags': tags.get(row.id, []),
+                'created_at': row.created_at.isoformat() if row.created_at else None,
+                'updated_at': row.updated_at.isoformat() if row.updated_at else None,
+            }
+        last_id = ids[-1]
+
+
+def _chunked(pieces, size=EXPORT_CHUNK_SIZE):
+    """Join small strings into chunks of about size characters"""
+    buffer = []
+    length = 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield "".join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def _jsonl_lines(records):
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def _csv_lines(records):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(dict(record, tags=", ".join(record['tags'])))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_templates(file_format, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Stream every template as JSONL or CSV text (see export_records).
+
+    Yields:
+        str: Chunks of the file
+    """
+    records = export_records(batch_size)
+    lines = _csv_lines(records) if file_format == 'csv' else _jsonl_lines(records)
+    return _chunked(lines)
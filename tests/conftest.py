@@ -0,0 +1,50 @@
+"""
+Shared fixtures. The app reads its configuration from the environment when
+it is imported, so every path it writes to is pointed at a temporary
+directory before the first import.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_work_dir = tempfile.mkdtemp(prefix='email-assistant-tests-')
+os.environ.update(
+    DATABASE_URL=f"sqlite:///{os.path.join(_work_dir, 'test.db')}",
+    RECOMMEND_INDEX_PATH=os.path.join(_work_dir, 'template_index.npz'),
+    RATE_LIMIT_DB=os.path.join(_work_dir, 'ratelimits.db'),
+    JOBS_DB_PATH=os.path.join(_work_dir, 'jobs.db'),
+    OPENAI_API_KEY='test-key',
+    APP_USERNAME='admin',
+    APP_PASSWORD='test-password',
+    COMPLETION_CACHE_ENABLED='0',
+    LOG_LEVEL='WARNING',
+)
+os.environ.pop('APP_PASSWORD_HASH', None)
+os.environ.pop('METRICS_TOKEN', None)
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    import app
+    app.app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    """A test client that is logged in"""
+    client = app_module.app.test_client()
+    response = client.post('/login', data={'username': 'admin', 'password': 'test-password'})
+    assert response.status_code == 302
+    return client
+
+
+@pytest.fixture
+def anonymous_client(app_module):
+    return app_module.app.test_client()
@@ -0,0 +1,151 @@
+import json
+import select
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import generation
+import hedging
+import transport
+from direct_api import direct_openai_call
+from generation import GenerationError, generate, parse_generation_request
+from singleflight import CallCancelled, CancelToken, draft_requests
+
+
+class SlowCompletions(BaseHTTPRequestHandler):
+    """Holds every request until released, noting requests whose client hung up first"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        with server.lock:
+            server.received += 1
+        deadline = time.monotonic() + 10
+        while not server.release.is_set() and time.monotonic() < deadline:
+            readable, _, _ = select.select([self.connection], [], [], 0.02)
+            if readable and not self.connection.recv(1, 0x2):  # MSG_PEEK: b'' means closed
+                with server.lock:
+                    server.disconnected += 1
+                return
+        body = json.dumps({'choices': [{'message': {'content': 'Done'}}],
+                           'usage': {'prompt_tokens': 5, 'completion_tokens': 1}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def slow_api(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowCompletions)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.release = threading.Event()
+    server.received = 0
+    server.disconnected = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(transport.transport, 'base_url', f"http://127.0.0.1:{server.server_address[1]}/v1")
+    monkeypatch.setattr(hedging, 'HEDGE_MODELS', {})
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def call_in_thread(**kwargs):
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = direct_openai_call(api_key='test', **kwargs)
+        except BaseException as e:
+            outcome['error'] = e
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+
+def messages(text):
+    return [{'role': 'user', 'content': text}]
+
+
+def test_cancel_closes_blocking_call(slow_api):
+    token = CancelToken()
+    thread, outcome = call_in_thread(messages=messages('cancel me'), use_cache=False, cancel=token)
+    assert wait_for(lambda: slow_api.received == 1)
+
+    started = time.monotonic()
+    token.cancel("a newer request for this draft was made")
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert time.monotonic() - started < 2
+    assert isinstance(outcome.get('error'), CallCancelled)
+    assert wait_for(lambda: slow_api.disconnected == 1)
+
+
+def test_shared_call_continues_while_one_caller_waits(slow_api):
+    leader, follower = CancelToken(), CancelToken()
+    leader_thread, _ = call_in_thread(messages=messages('shared call'), cancel=leader)
+    assert wait_for(lambda: slow_api.received == 1)
+    follower_thread, follower_outcome = call_in_thread(messages=messages('shared call'), cancel=follower)
+    time.sleep(0.1)
+
+    # The cancelled follower stops waiting; the call goes on for the leader
+    follower.cancel("gone")
+    follower_thread.join(2)
+    assert not follower_thread.is_alive()
+    assert isinstance(follower_outcome.get('error'), CallCancelled)
+    time.sleep(0.2)
+    assert slow_api.disconnected == 0
+    assert leader_thread.is_alive()
+
+    leader.cancel("gone too")
+    leader_thread.join(5)
+    assert wait_for(lambda: slow_api.disconnected == 1)
+    assert slow_api.received == 1
+
+
+def test_superseded_generation_stops_its_api_call(app_module, slow_api, monkeypatch):
+    # A revision whose prompt is already built, so only the API call remains
+    monkeypatch.setattr(generation, '_prepare_pipeline',
+                        lambda params: (generation.get_pipeline('gpt-4.1'), "", messages('revise')))
+    params = parse_generation_request({'draft_id': 'draft-1', 'modification_request': 'shorter',
+                                       'bypass_cache': True})
+    params['cancel'] = draft_requests.begin('draft-1')
+    outcome = {}
+
+    def run():
+        with app_module.app.app_context():
+            try:
+                generate('test', params, keep_draft=False)
+            except BaseException as e:
+                outcome['error'] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert wait_for(lambda: slow_api.received == 1)
+    newer = draft_requests.begin('draft-1')
+    thread.join(5)
+    draft_requests.end('draft-1', newer)
+
+    assert isinstance(outcome.get('error'), GenerationError)
+    assert outcome['error'].status_code == 409
+    assert wait_for(lambda: slow_api.disconnected == 1)
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import pytest
+
+import hedging
+from direct_api import OpenAIError
+from hedging import hedged_call
+from observability import LatencyWindow
+
+
+class FakeAPI:
+    """Stands in for direct_openai_call: each model answers (or fails) after its own delay"""
+
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.calls = []
+        self.cancelled = []
+        self.lock = threading.Lock()
+
+    def __call__(self, api_key, messages, model, max_tokens, stream=False, use_cache=True, on_usage=None,
+                 cancel=None):
+        with self.lock:
+            self.calls.append((model, stream))
+        delay, outcome = self.behaviour[model]
+        deadline = time.monotonic() + delay
+        while time.monotonic() < deadline:
+            if cancel is not None and cancel.cancelled:
+                with self.lock:
+                    self.cancelled.append(model)
+                raise OpenAIError("cancelled")
+            time.sleep(0.005)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return iter([outcome]) if stream else outcome
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    monkeypatch.setattr(hedging, 'HEDGE_ENABLED', True)
+    monkeypatch.setattr(hedging, 'HEDGE_MODELS', {'gpt-4.1': 'gpt-4.1-mini'})
+
+    def install(behaviour):
+        api = FakeAPI(behaviour)
+        monkeypatch.setattr(hedging, 'direct_openai_call', api)
+        return api
+    return install
+
+
+def call(stream=False):
+    return hedged_call('test', [{'role': 'user', 'content': 'Hi'}], 'gpt-4.1', 100, stream=stream,
+                       latency_budget=0.05)
+
+
+def test_models_have_no_fallback_unless_configured(monkeypatch):
+    monkeypatch.setattr(hedging, 'HEDGE_MODELS', {})
+    assert hedging.fallback_model('gpt-4.1') is None
+    assert hedging.fallback_model('o4-mini') is None
+
+
+def test_blocking_call_stays_blocking_and_names_the_model_that_answered(fake_api):
+    api = fake_api({'gpt-4.1': (2, 'Primary'), 'gpt-4.1-mini': (0, 'Fallback')})
+    result, answer = call()
+    assert result == 'Fallback'
+    assert answer['model'] == 'gpt-4.1-mini'
+    assert answer['hedge'] == 'slow'
+    assert {stream for _, stream in api.calls} == {False}
+    # The losing blocking call is stopped rather than left to run
+    assert wait_until(lambda: 'gpt-4.1' in api.cancelled)
+
+
+def test_stream_call_stays_streamed(fake_api):
+    api = fake_api({'gpt-4.1': (0, 'Primary'), 'gpt-4.1-mini': (0, 'Fallback')})
+    chunks, answer = call(stream=True)
+    assert list(chunks) == ['Primary']
+    assert answer == {'model': 'gpt-4.1'}
+    assert api.calls == [('gpt-4.1', True)]
+
+
+def test_non_transient_primary_error_is_raised_while_the_hedge_is_pending(fake_api):
+    rejected = OpenAIError("Invalid request", status_code=400)
+    api = fake_api({'gpt-4.1': (0.15, rejected), 'gpt-4.1-mini': (1, 'Fallback')})
+    with pytest.raises(OpenAIError) as error:
+        call()
+    assert error.value is rejected
+    assert wait_until(lambda: 'gpt-4.1-mini' in api.cancelled)
+
+
+def test_transient_primary_error_falls_back(fake_api):
+    fake_api({'gpt-4.1': (0, OpenAIError("Overloaded", status_code=503, transient=True)),
+              'gpt-4.1-mini': (0, 'Fallback')})
+    result, answer = call()
+    assert result == 'Fallback'
+    assert answer == {'model': 'gpt-4.1-mini', 'hedge': 'error'}
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_abandoned_primary_counts_towards_the_latency_window(fake_api, monkeypatch):
+    window = LatencyWindow()
+    monkeypatch.setattr(hedging, 'COMPLETION_WINDOW', window)
+    fake_api({'gpt-4.1': (2, 'Primary'), 'gpt-4.1-mini': (0.1, 'Fallback')})
+    call()
+    waited = window.values('gpt-4.1')
+    assert len(waited) == 1
+    assert waited[0] >= 0.1
@@ -0,0 +1,38 @@
+import sqlite3
+import time
+
+from jobs import JobQueue
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_worker_survives_an_error_while_recording_a_failed_job(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'), workers=1)
+
+    def fail(payload):
+        raise ValueError("handler failed")
+    queue.register('fail', fail)
+    queue.register('echo', lambda payload: payload)
+
+    finish = queue._finish
+    broken = []
+
+    def finish_once_broken(conn, job_id, result=None, error=None):
+        if error is not None and not broken:
+            broken.append(job_id)
+            raise sqlite3.OperationalError("database is locked")
+        return finish(conn, job_id, result=result, error=error)
+    queue._finish = finish_once_broken
+
+    queue.submit('fail', {})
+    assert wait_for(lambda: broken)
+    job_id = queue.submit('echo', {'value': 1})
+    assert wait_for(lambda: queue.get(job_id)['status'] == 'completed')
+    assert all(thread.is_alive() for thread in queue._threads)
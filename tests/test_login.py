@@ -0,0 +1,21 @@
+import auth
+
+
+def login(client, username, password):
+    return client.post('/login', data={'username': username, 'password': password})
+
+
+def test_failures_under_another_name_do_not_lock_out_the_login(app_module, anonymous_client, monkeypatch):
+    monkeypatch.setattr(app_module, 'login_throttle', auth.LoginThrottle(max_failures=2, window=60))
+    for _ in range(3):
+        login(anonymous_client, 'intruder', 'guess')
+    assert login(anonymous_client, 'intruder', 'guess').status_code == 429
+    assert login(anonymous_client, 'admin', 'test-password').status_code == 302
+
+
+def test_password_is_checked_for_an_unknown_name(monkeypatch):
+    checked = []
+    monkeypatch.setattr(auth, 'check_password_hash', lambda hashed, password: checked.append(password) or True)
+    assert not auth.check_credentials('intruder', 'test-password')
+    assert checked == ['test-password']
+    assert auth.check_credentials('admin', 'test-password')
@@ -0,0 +1,25 @@
+import observability
+
+
+def test_metrics_rejects_anonymous_requests_without_token(anonymous_client, monkeypatch):
+    monkeypatch.setattr(observability, 'METRICS_TOKEN', None)
+    assert anonymous_client.get('/metrics').status_code == 401
+
+
+def test_metrics_rejects_wrong_or_query_string_token(anonymous_client, monkeypatch):
+    monkeypatch.setattr(observability, 'METRICS_TOKEN', 'scrape-secret')
+    assert anonymous_client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    # Tokens in the query string would end up in access logs
+    assert anonymous_client.get('/metrics?token=scrape-secret').status_code == 401
+
+
+def test_metrics_accepts_bearer_token(anonymous_client, monkeypatch):
+    monkeypatch.setattr(observability, 'METRICS_TOKEN', 'scrape-secret')
+    response = anonymous_client.get('/metrics', headers={'Authorization': 'Bearer scrape-secret'})
+    assert response.status_code == 200
+    assert b'email_assistant_http_request_duration_seconds' in response.data
+
+
+def test_metrics_readable_when_logged_in(client, monkeypatch):
+    monkeypatch.setattr(observability, 'METRICS_TOKEN', None)
+    assert client.get('/metrics').status_code == 200
@@ -0,0 +1,30 @@
+from sqlalchemy import create_engine, inspect
+
+from models import db
+
+
+def describe(engine):
+    inspector = inspect(engine)
+    schema = {}
+    for table in inspector.get_table_names():
+        if table == 'schema_version' or table.startswith('template_fts'):
+            continue
+        schema[table] = {
+            'columns': sorted((column['name'], str(column['type']), column['nullable'])
+                              for column in inspector.get_columns(table)),
+            'indexes': sorted((index['name'], tuple(index['column_names']))
+                              for index in inspector.get_indexes(table)),
+            'unique': sorted(tuple(constraint['column_names'])
+                             for constraint in inspector.get_unique_constraints(table)),
+            'primary_key': inspector.get_pk_constraint(table)['constrained_columns'],
+        }
+    return schema
+
+
+def test_migrations_build_the_schema_of_the_models(app_module, tmp_path):
+    # The test database was set up by the migrations when the app was imported
+    with app_module.app.app_context():
+        migrated = describe(db.engine)
+    reference = create_engine(f"sqlite:///{tmp_path / 'reference.db'}")
+    db.metadata.create_all(reference)
+    assert migrated == describe(reference)
@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+import generation
+from models import db, Reply
+from replies import decompress
+
+EMAIL = ("Hello, I placed order {order} last week and the tracking page still shows the parcel "
+         "waiting at the depot. Could you check what is holding up the shipment please?")
+
+
+@pytest.fixture
+def pipeline_runs(monkeypatch):
+    """Replace the API pipeline with one that always writes the same response; counts its runs"""
+    runs = []
+
+    def run_pipeline(api_key, params, stream):
+        runs.append(params['customer_email'])
+        params.update(compaction=None, stages=[], prompt=None)
+        yield "delta", {"content": "Freshly generated reply"}
+    monkeypatch.setattr(generation, '_run_pipeline', run_pipeline)
+    return runs
+
+
+def generate(client, order, **extra):
+    response = client.post('/generate_response', json={'customer_email': EMAIL.format(order=order), **extra})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def approve(client, reply_id, text):
+    response = client.post(f'/api/replies/{reply_id}/approve', json={'response': text})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def reply_uses(app_module, reply_id):
+    with app_module.app.app_context():
+        return db.session.get(Reply, reply_id).uses
+
+
+def test_near_duplicate_gets_the_approved_reply_without_a_generation(app_module, client, pipeline_runs):
+    first = generate(client, '40001')
+    assert first['reused'] is None
+    approve(client, first['reply_id'], "Order 40001 left the depot this morning.")
+    assert reply_uses(app_module, first['reply_id']) == 0
+
+    second = generate(client, '40001')
+    assert second['response'] == "Order 40001 left the depot this morning."
+    assert second['reused']['reply_id'] == first['reply_id']
+    assert second['reused']['similarity'] == 1.0
+    assert len(pipeline_runs) == 1
+    assert reply_uses(app_module, first['reply_id']) == 1
+
+    # "Regenerate anyway" skips the lookup
+    third = generate(client, '40001', regenerate=True)
+    assert third['response'] == "Freshly generated reply"
+    assert third['reused'] is None
+
+
+def test_streamed_reuse_is_a_single_done_event(client, pipeline_runs):
+    first = generate(client, '45001')
+    approve(client, first['reply_id'], "Order 45001 left the depot this morning.")
+
+    response = client.post('/generate_response/stream', json={'customer_email': EMAIL.format(order='45001')})
+    events = [line[len('event: '):] for line in response.get_data(as_text=True).splitlines()
+              if line.startswith('event: ')]
+    assert events == ['done']
+    data = [json.loads(line[len('data: '):]) for line in response.get_data(as_text=True).splitlines()
+            if line.startswith('data: ')]
+    assert data[-1]['response'] == "Order 45001 left the depot this morning."
+    assert len(pipeline_runs) == 1
+
+
+def test_reply_is_not_reused_for_a_different_order_number(app_module, client, pipeline_runs):
+    first = generate(client, '50001')
+    approve(client, first['reply_id'], "Order 50001 left the depot this morning.")
+
+    other = generate(client, '50002')
+    assert other['response'] == "Freshly generated reply"
+    assert other['reused'] is None
+    assert len(pipeline_runs) == 2
+    assert reply_uses(app_module, first['reply_id']) == 0
+
+
+def test_approving_a_reused_reply_adds_a_new_reply(app_module, client, pipeline_runs):
+    first = generate(client, '60001')
+    original = approve(client, first['reply_id'], "Order 60001 left the depot this morning.")
+    assert original['id'] == first['reply_id']
+
+    reused = generate(client, '60001')
+    assert reused['reply_id'] == first['reply_id']
+    revised = approve(client, reused['reply_id'], "Order 60001 is out for delivery today.")
+    assert revised['id'] != first['reply_id']
+    assert revised['status'] == 'approved'
+    with app_module.app.app_context():
+        assert decompress(db.session.get(Reply, first['reply_id']).reply_body) == \
+            "Order 60001 left the depot this morning."
+        assert decompress(db.session.get(Reply, revised['id']).reply_body) == "Order 60001 is out for delivery today."
@@ -0,0 +1,50 @@
+import socket
+import threading
+
+import pytest
+import requests
+
+import transport
+from transport import OpenAITransport
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(transport.time, 'sleep', lambda seconds: None)
+
+
+def test_dropped_connection_after_sending_is_not_retried(no_backoff):
+    # A server that reads the request and hangs up without answering
+    listener = socket.create_server(('127.0.0.1', 0))
+    received = []
+
+    def serve():
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except OSError:
+                return
+            received.append(connection.recv(65536))
+            connection.close()
+    threading.Thread(target=serve, daemon=True).start()
+
+    client = OpenAITransport(base_url=f"http://127.0.0.1:{listener.getsockname()[1]}/v1", max_retries=3)
+    try:
+        with pytest.raises(requests.exceptions.ConnectionError):
+            client.post('/chat/completions', {'messages': []})
+    finally:
+        listener.close()
+    assert len(received) == 1
+    assert client.stats()['retries'] == 0
+
+
+def test_refused_connection_is_retried(no_backoff):
+    # A port nobody listens on
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    client = OpenAITransport(base_url=f"http://127.0.0.1:{port}/v1", max_retries=2)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post('/chat/completions', {'messages': []})
+    assert client.stats()['attempts'] == 3
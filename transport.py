@@ -0,0 +1,353 @@
+"""
+Shared HTTP transport for calls to the OpenAI API.
+Keeps a pooled keep-alive session per process, applies connect/read timeouts
+and retries 429/5xx responses and failed connection attempts with jittered
+exponential backoff. Calls are
+paced by the shared rate limiter so they wait for budget instead of failing.
+A call sent with a CallGuard (singleflight.py) has its connection shut down
+when the guard is cancelled, which interrupts the blocked thread.
+"""
+
+import os
+import random
+import socket
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError, NewConnectionError
+
+from rate_limiter import estimate_request_tokens, rate_limiter
+from singleflight import CallCancelled
+
+# Base URL for the chat completions API
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com/v1').rstrip('/')
+
+# Timeouts in seconds (connect, read)
+CONNECT_TIMEOUT = float(os.environ.get('OPENAI_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('OPENAI_READ_TIMEOUT', 120))
+
+# Retry/backoff settings
+MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', 3))
+BACKOFF_BASE = float(os.environ.get('OPENAI_BACKOFF_BASE', 0.5))
+BACKOFF_MAX = float(os.environ.get('OPENAI_BACKOFF_MAX', 20))
+RETRY_AFTER_MAX = float(os.environ.get('OPENAI_RETRY_AFTER_MAX', 60))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Connection pool size (should cover the number of threads per worker)
+POOL_MAXSIZE = int(os.environ.get('OPENAI_POOL_MAXSIZE', 10))
+
+
+def connection_failed(error):
+    """
+    Return True if a requests ConnectionError happened while connecting, before anything was sent.
+
+    Other connection errors ("Connection aborted", RemoteDisconnected, resets)
+    can happen after the request body went out, when the completion may
+    already be generated and billed.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def parse_retry_after(headers):
+    """
+    Read the delay requested by the server from the response headers.
+
+    Args:
+        headers (Mapping): Response headers
+
+    Returns:
+        float or None: Delay in seconds, or None if the server did not ask for one
+    """
+    # OpenAI sends a millisecond variant alongside the standard header
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return max(float(retry_after_ms) / 1000.0, 0.0)
+        except ValueError:
+            pass
+
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+
+    # Retry-After may also be an HTTP date
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        return max(retry_at.timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Compute how long to wait before the next attempt.
+
+    Uses "full jitter" exponential backoff, but never waits less than the
+    server asked for through Retry-After.
+
+    Args:
+        attempt (int): Number of the attempt that just failed (0 for the first)
+        retry_after (float): Delay requested by the server, if any
+
+    Returns:
+        float: Delay in seconds
+    """
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, RETRY_AFTER_MAX))
+    return delay
+
+
+# The CallGuard of the request this thread is sending (see OpenAITransport.post)
+_sending = threading.local()
+
+
+def _shutdown_connection(connection):
+    # Called from the cancelling thread; shutdown() wakes a send or recv blocked in the calling thread
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class _GuardedPoolMixin:
+    """Connection pool that gives each connection to the CallGuard of the request sent on it"""
+
+    def _make_request(self, conn, *args, **kwargs):
+        guard = getattr(_sending, 'guard', None)
+        if guard is not None:
+            conn.call_guard = guard
+            guard.attach(conn, _shutdown_connection)
+        return super()._make_request(conn, *args, **kwargs)
+
+    def _put_conn(self, conn):
+        # The response was read or closed; the connection may now serve another call
+        guard = getattr(conn, 'call_guard', None)
+        if guard is not None:
+            conn.call_guard = None
+            guard.detach(conn)
+        super()._put_conn(conn)
+
+
+class _GuardedHTTPConnectionPool(_GuardedPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _GuardedHTTPSConnectionPool(_GuardedPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _GuardedAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools report their connections to the sending call's guard"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _GuardedHTTPConnectionPool,
+                                                   'https': _GuardedHTTPSConnectionPool}
+
+
+class OpenAITransport:
+    """Pooled keep-alive transport with timeouts, retries and statistics"""
+
+    def __init__(self, base_url=OPENAI_BASE_URL, pool_maxsize=POOL_MAXSIZE,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), max_retries=MAX_RETRIES):
+        self.base_url = base_url
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+        self._lock = threading.Lock()
+        self._session = None
+        self._adapter = None
+        self._pid = None
+        self._counters = {
+            'requests': 0,
+            'attempts': 0,
+            'retries': 0,
+            'failures': 0,
+            'timeouts': 0,
+            'connection_errors': 0,
+            'backoff_seconds': 0.0,
+        }
+        self._retries_by_status = {}
+
+    def _get_session(self):
+        """Return the session for this process, creating it after a fork"""
+        pid = os.getpid()
+        with self._lock:
+            if self._session is None or self._pid != pid:
+                # Never share sockets with a parent process (gunicorn --preload)
+                session = requests.Session()
+                adapter = _GuardedAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.pool_maxsize,
+                    pool_block=False,
+                    max_retries=0  # Retries are handled by post() below
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+                self._adapter = adapter
+                self._pid = pid
+            return self._session
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def post(self, path, payload, headers=None, stream=False, guard=None):
+        """
+        POST a JSON payload to the API, retrying transient failures.
+
+        Args:
+            path (str): Path relative to the base URL (e.g. "/chat/completions")
+            payload (dict): JSON body
+            headers (dict): Extra request headers (e.g. Authorization)
+            stream (bool): Leave the response body unread for the caller
+            guard (CallGuard): Shuts the connection down when the call is cancelled
+                (for a stream, until the response is closed)
+
+        Returns:
+            requests.Response: The final response (possibly an error status)
+
+        Raises:
+            requests.exceptions.RequestException: If the request could not be sent
+            CallCancelled: If the guard interrupted the call
+        """
+        session = self._get_session()
+        url = f"{self.base_url}{path}"
+        self._count('requests')
+
+        # Budgets are tracked per model, so only model calls are paced
+        model = payload.get('model')
+        estimated_tokens = estimate_request_tokens(payload) if model else 0
+
+        attempt = 0
+        while True:
+            if model:
+                rate_limiter.acquire(model, estimated_tokens)
+            if guard is not None:
+                guard.check()
+            self._count('attempts')
+            try:
+                response = self._send(session, url, payload, headers, stream, guard)
+            except requests.exceptions.ConnectionError as e:
+                is_timeout = isinstance(e, requests.exceptions.ConnectTimeout)
+                self._count('timeouts' if is_timeout else 'connection_errors')
+                # Only a connection that was never established is retried: after a dropped
+                # connection the server may already be generating (and billing) the completion
+                if not connection_failed(e) or attempt >= self.max_retries:
+                    self._count('failures')
+                    raise
+                delay = backoff_delay(attempt)
+            except requests.exceptions.Timeout:
+                # Read timeouts are not retried: the completion may still be billed
+                self._count('timeouts')
+                self._count('failures')
+                raise
+            else:
+                retry_after = parse_retry_after(response.headers)
+                if model:
+                    rate_limiter.update_from_headers(model, response.headers)
+                    if response.status_code == 429:
+                        # Hold back every worker's calls to this model, not just this one
+                        rate_limiter.block(model, min(retry_after if retry_after is not None
+                                                      else BACKOFF_BASE, RETRY_AFTER_MAX))
+
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    if response.status_code >= 400:
+                        self._count('failures')
+                    return response
+
+                delay = backoff_delay(attempt, retry_after)
+                with self._lock:
+                    status = response.status_code
+                    self._retries_by_status[status] = self._retries_by_status.get(status, 0) + 1
+                # Release the connection back to the pool before sleeping
+                response.close()
+
+            self._count('retries')
+            self._count('backoff_seconds', delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def _send(self, session, url, payload, headers, stream, guard):
+        """One attempt of post(); the guard learns which connection it is sent on"""
+        _sending.guard = guard
+        try:
+            return session.post(url, json=payload, headers=headers, timeout=self.timeout, stream=stream)
+        except requests.exceptions.RequestException:
+            if guard is not None and guard.aborted:
+                # The connection was shut down on purpose, so this is not worth a retry
+                raise CallCancelled("Call cancelled while waiting for the API")
+            raise
+        finally:
+            _sending.guard = None
+
+    def pool_stats(self):
+        """Return connection pool statistics for this process"""
+        stats = {
+            'pool_maxsize': self.pool_maxsize,
+            'pools': 0,
+            'connections_opened': 0,
+            'requests_sent': 0,
+            'idle_connections': 0,
+        }
+        with self._lock:
+            adapter = self._adapter if self._pid == os.getpid() else None
+        if adapter is None:
+            return stats
+
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats['pools'] += 1
+            stats['connections_opened'] += pool.num_connections
+            stats['requests_sent'] += pool.num_requests
+            # The pool queue is pre-filled with None placeholders for unopened slots
+            if pool.pool is not None:
+                stats['idle_connections'] += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+
+        # Every request beyond the first on a connection skipped a TCP+TLS handshake
+        if stats['requests_sent']:
+            reused = stats['requests_sent'] - stats['connections_opened']
+            stats['connection_reuse_ratio'] = round(max(reused, 0) / stats['requests_sent'], 3)
+        else:
+            stats['connection_reuse_ratio'] = 0.0
+        return stats
+
+    def stats(self):
+        """Return retry and pool statistics as a dictionary"""
+        with self._lock:
+            counters = dict(self._counters)
+            retries_by_status = {str(k): v for k, v in self._retries_by_status.items()}
+        counters['backoff_seconds'] = round(counters['backoff_seconds'], 3)
+        return {
+            'base_url': self.base_url,
+            'timeout': {'connect': self.timeout[0], 'read': self.timeout[1]},
+            'max_retries': self.max_retries,
+            **counters,
+            'retries_by_status': retries_by_status,
+            'pool': self.pool_stats(),
+        }
+
+
+# Transport shared by every call in this process
+transport = OpenAITransport()
@@ -0,0 +1,94 @@
+"""
+Token usage statistics for OpenAI API calls.
+Records the usage block of every completion, including the prompt tokens
+served from OpenAI's prompt cache (usage.prompt_tokens_details.cached_tokens),
+and compares latency of calls with and without a prompt cache hit.
+"""
+
+import threading
+
+
+def _new_model_stats():
+    return {
+        'calls': 0,
+        'prompt_tokens': 0,
+        'cached_tokens': 0,
+        'completion_tokens': 0,
+        'prompt_cache_hits': 0,
+        # Estimated from MODEL_PRICES; 0 for models without prices
+        'cost_usd': 0.0,
+        # Latency sums by (kind, hit): time to first token for streams, total time otherwise
+        'latency': {},
+    }
+
+
+class UsageStats:
+    """Per-model token counters, costs and prompt cache hit rates (per worker)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def record(self, model, usage, latency=None, streamed=False, cost=None):
+        """
+        Record the usage of one completion.
+
+        Args:
+            model (str): Model that answered
+            usage (dict): The "usage" object of the API response
+            latency (float): Seconds until the first token (streamed) or the full response
+            streamed (bool): Whether latency is a time to first token
+            cost (float): Estimated cost of the completion in USD, if known
+        """
+        if not usage:
+            return
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+
+        with self._lock:
+            stats = self._models.setdefault(model, _new_model_stats())
+            stats['calls'] += 1
+            stats['prompt_tokens'] += prompt_tokens
+            stats['cached_tokens'] += cached_tokens
+            stats['completion_tokens'] += usage.get('completion_tokens') or 0
+            if cached_tokens:
+                stats['prompt_cache_hits'] += 1
+            if cost:
+                stats['cost_usd'] += cost
+            if latency is not None:
+                key = ('first_token' if streamed else 'response', bool(cached_tokens))
+                total, count = stats['latency'].get(key, (0.0, 0))
+                stats['latency'][key] = (total + latency, count + 1)
+
+    def stats(self):
+        """Return token counts, prompt cache hit rates and latencies per model"""
+        with self._lock:
+            models = {model: dict(stats, latency=dict(stats['latency'])) for model, stats in self._models.items()}
+
+        result = {}
+        for model, stats in models.items():
+            latency = stats.pop('latency')
+            stats['cost_usd'] = round(stats['cost_usd'], 6)
+            stats['cached_token_ratio'] = (
+                round(stats['cached_tokens'] / stats['prompt_tokens'], 3) if stats['prompt_tokens'] else 0.0
+            )
+            stats['prompt_cache_hit_ratio'] = round(stats['prompt_cache_hits'] / stats['calls'], 3)
+
+            for kind in ('first_token', 'response'):
+                means = {}
+                for hit in (True, False):
+                    total, count = latency.get((kind, hit), (0.0, 0))
+                    means[hit] = total / count if count else None
+                stats[f'{kind}_ms'] = {
+                    'prompt_cache_hit': round(means[True] * 1000, 1) if means[True] is not None else None,
+                    'prompt_cache_miss': round(means[False] * 1000, 1) if means[False] is not None else None,
+                }
+                # Mean latency difference between calls with and without a prompt cache hit
+                if means[True] is not None and means[False] is not None:
+                    stats[f'{kind}_ms']['saved_by_prompt_cache'] = round((means[False] - means[True]) * 1000, 1)
+            result[model] = stats
+        return result
+
+
+# Statistics shared by every call in this process
+usage_stats = UsageStats()